@@ -6,7 +6,6 @@ import dataclasses
 import time
 import logging
 import threading
-import collections
 import queue
 import json
 import re
@@ -17,15 +16,24 @@ import pathlib
 import requests  # type: ignore
 
 from .version import VERSION
-from .utils import SentryWrapper, fix_rrf_filename
+from .utils import SentryWrapper, ExpiringSet, fix_rrf_filename
+from . import metrics
 from .webcam_capture import JpegPoster
+from .webcam_worker import WebcamWorker, isolated_process_supported
+from .mjpeg_relay import start_mjpeg_relay
+from .timelapse import TimelapseRecorder
+from .telemetry import TelemetryPublisher
+from .timeseries import TimeSeries
+from .thermal_anomaly import ThermalAnomalyDetector
 from .logger import setup_logging
 from .printer import PrinterState
 from .config import ServerConfig, Config
 from .server_conn import ServerConn
 from .janus import JanusConn
 from .tunnel import LocalTunnel
-from .passthru_targets import FileDownloader, Printer, FileOperations, RepRapFirmwareApi
+from .ws import use_asyncio_client
+from .passthru_targets import FileDownloader, Printer, FileOperations, RepRapFirmwareApi, Metrics
+from .passthru_dispatch import PassthruDispatcher
 from  .reprapfirmware_connection_factory import get_connection
 
 _logger = logging.getLogger('obico.app')
@@ -43,7 +51,7 @@ class App(object):
         remote_status: Dict
         linked_printer: Dict
         printer_state: PrinterState
-        seen_refs: collections.deque
+        seen_refs: ExpiringSet
 
         def is_configured(self):
             return True  # FIXME
@@ -55,6 +63,7 @@ class App(object):
         self.server_conn = None
         self.rrfconn = None
         self.jpeg_poster = None
+        self.webcam_worker = None
         self.janus = None
         self.local_tunnel = None
         self.target_file_downloader = None
@@ -62,6 +71,9 @@ class App(object):
         self.q: queue.Queue = queue.Queue(maxsize=1000)
         self.target_file_operations = None
         self.target_moonraker_api = None # This has to be called this for now because of the server reflective API call
+        self.target_timeseries = None
+        self.target_metrics = Metrics()
+        self.passthru_dispatcher = None
 
     def push_event(self, event):
         if self.shutdown:
@@ -101,7 +113,7 @@ class App(object):
             remote_status={'viewing': False, 'should_watch': False},
             linked_printer=linked_printer,
             printer_state=PrinterState(config),
-            seen_refs=collections.deque(maxlen=100),
+            seen_refs=ExpiringSet(ACKREF_EXPIRE_SECS),
         )
         self.sentry = SentryWrapper(config=config)
 
@@ -116,21 +128,33 @@ class App(object):
 
         _cfg = self.model.config._config
         _logger.debug(f'reprapfirmware-obico configurations: { {section: dict(_cfg[section]) for section in _cfg.sections()} }')
+        use_asyncio_client(self.model.config.websocket_client == 'asyncio')
         self.rrfconn = get_connection(self.model.config, self.push_event)
         self.model.printer_state.set_connection(self.rrfconn)  # set the connection to collect printer information
         self.server_conn = ServerConn(self.model.config, self.model.printer_state, self.process_server_msg, self.sentry)
-        self.janus = JanusConn(self.model, self.server_conn, self.sentry)
-        self.jpeg_poster = JpegPoster(self.model, self.server_conn, self.sentry)
+        if self.model.config.webcam.isolated_process and not isolated_process_supported():
+            _logger.warning('isolated_process requires Python 3.8 or later. Running the webcam in the main process.')
+        if self.model.config.webcam.isolated_process and isolated_process_supported():
+            self.webcam_worker = WebcamWorker(self.model, self.server_conn, self.sentry)
+        else:
+            self.jpeg_poster = JpegPoster(self.model, self.server_conn, self.sentry)
+        self.janus = JanusConn(self.model, self.server_conn, self.sentry, webcam_worker=self.webcam_worker, process_client_msg=self.process_server_msg)
         self.target_file_downloader = FileDownloader(self.model, self.rrfconn, self.server_conn, self.sentry)
         self.target__printer = Printer(self.model, self.rrfconn, self.server_conn)
         self.target_file_operations = FileOperations(self.model, self.rrfconn, self.sentry)
         self.target_moonraker_api = RepRapFirmwareApi(self.model, self.rrfconn, self.sentry)
+        self.target_timeseries = TimeSeries(self.model, self.rrfconn)
+        self.target_timeseries.start()
+        if self.model.config.thermal_anomaly.enabled:
+            ThermalAnomalyDetector(self.model, self.rrfconn, self.server_conn).start()
+        self.passthru_dispatcher = PassthruDispatcher(self.sentry)
 
         self.local_tunnel = LocalTunnel(
             tunnel_config=self.model.config.tunnel,
             on_http_response=self.server_conn.send_ws_msg_to_server,
             on_ws_message=self.server_conn.send_ws_msg_to_server,
-            sentry=self.sentry)
+            sentry=self.sentry,
+            webcam_config=self.model.config.webcam)
 
         #self.rrfconn.update_webcam_config_from_moonraker()
         self.model.printer_state.thermal_presets = self.rrfconn.find_all_thermal_presets()
@@ -144,9 +168,20 @@ class App(object):
         thread.daemon = True
         thread.start()
 
-        jpeg_post_thread = threading.Thread(target=self.jpeg_poster.pic_post_loop)
-        jpeg_post_thread.daemon = True
-        jpeg_post_thread.start()
+        if not self.webcam_worker:  # Otherwise the worker runs these, next to the webcam pipeline
+            if self.model.config.webcam.mjpeg_relay:
+                start_mjpeg_relay(self.model.config.webcam)
+            if self.model.config.timelapse.enabled:
+                TimelapseRecorder(self.model, self.server_conn, self.sentry).start()
+
+        if self.webcam_worker:
+            webcam_worker_thread = threading.Thread(target=self.webcam_worker.run_forever)
+            webcam_worker_thread.daemon = True
+            webcam_worker_thread.start()
+        else:
+            jpeg_post_thread = threading.Thread(target=self.jpeg_poster.pic_post_loop)
+            jpeg_post_thread.daemon = True
+            jpeg_post_thread.start()
 
         thread = threading.Thread(target=self.event_loop)
         thread.daemon = True
@@ -157,6 +192,11 @@ class App(object):
         janus_thread.daemon = True
         janus_thread.start()
 
+        if self.model.config.telemetry.enabled:
+            telemetry_thread = threading.Thread(target=TelemetryPublisher(self.model, self.rrfconn, self.janus).run)
+            telemetry_thread.daemon = True
+            telemetry_thread.start()
+
         def handler():
             self.rrfconn.stop()
 
@@ -182,6 +222,10 @@ class App(object):
             self.rrfconn.stop()
         if self.janus:
             self.janus.shutdown()
+        if self.webcam_worker:
+            self.webcam_worker.shutdown()
+        if self.passthru_dispatcher:
+            self.passthru_dispatcher.shutdown()
 
     # TODO: This doesn't work as ffmpeg seems to mess with signals as well
     def interrupted(self, signum, frame):
@@ -380,11 +424,14 @@ class App(object):
 
         self.server_conn.post_status_update_to_server()
 
-    def process_server_msg(self, msg):
+    # reply: Set when msg came from the WebRTC data channel. Passthru responses go back through it when they fit.
+    def process_server_msg(self, msg, reply=None):
         if 'remote_status' in msg:
             self.model.remote_status.update(msg['remote_status'])
-            if self.model.remote_status['viewing']:
-                self.jpeg_poster.need_viewing_boost.set()
+            if self.webcam_worker:
+                self.webcam_worker.update_remote_status(self.model.remote_status)  # The worker requests the viewing boost itself
+            elif self.model.remote_status['viewing']:
+                self.jpeg_poster.scheduler.request_viewing_boost()
 
         if 'commands' in msg:
             _logger.debug(f'Received commands from server: {msg}')
@@ -404,31 +451,32 @@ class App(object):
             ack_ref = passthru.get('ref')
             if ack_ref is not None:
                 # same msg may arrive through both ws and datachannel
-                if ack_ref in self.model.seen_refs:
+                if not self.model.seen_refs.check_and_add(ack_ref):
+                    metrics.counter('passthru.duplicate_refs').inc()
                     _logger.debug('Ignoring already processed passthru message')
                     return
-                # no need to remove item or check size
-                # as deque manages that when maxlen is set
-                self.model.seen_refs.append(ack_ref)
-
-            error = None
-            try:
-                target = getattr(self, 'target_' + passthru.get('target'))
-                func = getattr(target, passthru['func'], None)
-                ret_value, error = func(*(passthru.get("args", [])), **(passthru.get("kwargs", {})))
-            except AttributeError:
-                error = 'Request not supported. Please make sure moonraker-obico is updated to the latest version. If moonraker-obico is already up to date and you still see this error, please contact Obico support at support@obico.io'
-            except Exception as e:
-                error = str(e)
-                self.sentry.captureException()
 
-            if ack_ref is not None:
+            def send_resp(ret_value, error):
+                if ack_ref is None:
+                    return
                 if error:
                     resp = {'ref': ack_ref, 'error': error}
                 else:
                     resp = {'ref': ack_ref, 'ret': ret_value}
 
-                self.server_conn.send_ws_msg_to_server({'passthru': resp})
+                if not reply or not reply({'passthru': resp}):
+                    self.server_conn.send_ws_msg_to_server({'passthru': resp})
+
+            try:
+                target = getattr(self, 'target_' + passthru.get('target'))
+                func = getattr(target, passthru['func'])
+            except (AttributeError, TypeError):
+                send_resp(None, 'Request not supported. Please make sure moonraker-obico is updated to the latest version. If moonraker-obico is already up to date and you still see this error, please contact Obico support at support@obico.io')
+            else:
+                # Runs off this thread, so that a slow printer doesn't hold up the other server messages
+                self.passthru_dispatcher.submit(
+                    passthru['target'], passthru['func'], func,
+                    passthru.get('args', []), passthru.get('kwargs', {}), send_resp)
 
         if msg.get('janus') and self.janus:
             _logger.debug(f'Received janus from server: {msg}')
@@ -0,0 +1,127 @@
+"""
+    Replays print jobs through EtaEstimator, and compares how far off its time-left estimate is at each stage
+    of the print with RRF's file-based estimate and with the slicer's estimate.
+
+    python3 -m reprapfirmware_obico.benchmarks.eta [job.jsonl ...]
+
+    A recorded job is a jsonl file with one RRF status per line, as the agent receives it ({"job": ..., ...}),
+    optionally with "slicer_time" set on any line to what rr_fileinfo reported as printTime.
+    Simulated jobs, with slicer estimates that are off by up to 25%, are replayed when none are given.
+"""
+import argparse
+import json
+import random
+import time
+
+from ..eta import EtaEstimator
+
+CHECKPOINTS = (0.02, 0.05, 0.1, 0.25, 0.5, 0.75, 0.9)
+POLL_SECS = 5
+
+
+def simulate_job(seed):
+    """
+        Layers whose print time doesn't follow their size in bytes: a slow first layer, a minimum layer time on
+        small layers, and travel-heavy layers that take long for few bytes.
+    """
+    rnd = random.Random(seed)
+    num_layers = rnd.randint(80, 400)
+    shape = rnd.choice(('tower', 'cone', 'vase', 'bulge'))
+    layers = []
+    for i in range(num_layers):
+        h = i / num_layers
+        area = {'tower': 1.0, 'cone': 1.0 - 0.95 * h, 'vase': 0.3 + 0.2 * h, 'bulge': 0.2 + 4 * h * (1 - h)}[shape]
+        travel = rnd.uniform(0.5, 2.0) if rnd.random() < 0.2 else 1.0
+        secs = max(area * 60 * travel, 8.0) * (2.0 if i == 0 else 1.0)
+        num_bytes = int(area * 40000 * rnd.uniform(0.9, 1.1))
+        layers.append((secs, num_bytes))
+
+    total_secs = sum(secs for (secs, _) in layers)
+    total_bytes = sum(num_bytes for (_, num_bytes) in layers)
+    slicer_time = total_secs * rnd.uniform(0.75, 1.25)
+
+    statuses = []
+    done_secs = done_bytes = 0
+    completed = []
+    for (i, (secs, num_bytes)) in enumerate(layers):
+        for t in range(0, int(secs), POLL_SECS):
+            pos = done_bytes + int(num_bytes * t / secs)
+            statuses.append(dict(
+                job=dict(
+                    duration=done_secs + t,
+                    filePosition=pos,
+                    layer=i + 1,
+                    layers=list(completed),
+                    file=dict(fileName='0:/gcodes/sim{}.gcode'.format(seed), size=total_bytes, numLayers=num_layers),
+                    timesLeft=dict(file=(done_secs + t) * (total_bytes - pos) / pos if pos else None),
+                ),
+                slicer_time=slicer_time,
+            ))
+        done_secs += secs
+        done_bytes += num_bytes
+        completed.append(dict(duration=secs, fractionPrinted=done_bytes / total_bytes))
+    return statuses, total_secs
+
+
+def load_job(path):
+    with open(path) as f:
+        statuses = [json.loads(line) for line in f if line.strip()]
+    statuses = [s for s in statuses if s.get('job', {}).get('duration') is not None]
+    return statuses, statuses[-1]['job']['duration']
+
+
+def replay(statuses, total_secs):
+    estimator = EtaEstimator()
+    errors = {'rrf': {}, 'slicer': {}, 'blended': {}}
+    slicer_time = next((s['slicer_time'] for s in statuses if s.get('slicer_time')), None)
+    elapsed = 0.0
+    for status in statuses:
+        job = status['job']
+        file = job.get('file', {})
+        completion = job.get('filePosition', 0) / file['size'] if file.get('size') else None
+
+        start = time.perf_counter()
+        blended = estimator.update(
+            (file.get('fileName'), file.get('size')), completion, job['duration'],
+            layers=job.get('layers'), total_layers=file.get('numLayers'), slicer_time=slicer_time,
+            rrf_time_left=job.get('timesLeft', {}).get('file'))
+        elapsed += time.perf_counter() - start
+
+        actual_left = total_secs - job['duration']
+        progress = job['duration'] / total_secs
+        for checkpoint in CHECKPOINTS:
+            if progress >= checkpoint and checkpoint not in errors['blended']:
+                candidates = {
+                    'rrf': job.get('timesLeft', {}).get('file'),
+                    'slicer': slicer_time * (1 - completion) if slicer_time and completion is not None else None,
+                    'blended': blended,
+                }
+                for (name, estimate) in candidates.items():
+                    errors[name][checkpoint] = abs(estimate - actual_left) / actual_left if estimate is not None and actual_left > 0 else None
+    return errors, elapsed / len(statuses)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('jobs', nargs='*', help='jsonl files of recorded RRF statuses, one job per file')
+    parser.add_argument('-n', '--num-simulated', type=int, default=50)
+    args = parser.parse_args()
+
+    jobs = [load_job(path) for path in args.jobs] if args.jobs else [simulate_job(seed) for seed in range(args.num_simulated)]
+
+    results = {'rrf': {c: [] for c in CHECKPOINTS}, 'slicer': {c: [] for c in CHECKPOINTS}, 'blended': {c: [] for c in CHECKPOINTS}}
+    per_update = []
+    for (statuses, total_secs) in jobs:
+        (errors, per_tick) = replay(statuses, total_secs)
+        per_update.append(per_tick)
+        for (name, by_checkpoint) in errors.items():
+            for (checkpoint, error) in by_checkpoint.items():
+                if error is not None:
+                    results[name][checkpoint].append(error)
+
+    print('Mean absolute error of the time left, as a % of the actual time left, over {} jobs'.format(len(jobs)))
+    print('{:<10}'.format('progress') + ''.join('{:>8.0%}'.format(c) for c in CHECKPOINTS))
+    for (name, by_checkpoint) in results.items():
+        cells = ['{:>8.1f}'.format(100 * sum(e) / len(e)) if e else '{:>8}'.format('-') for e in by_checkpoint.values()]
+        print('{:<10}'.format(name) + ''.join(cells))
+    print('{:.1f}us per update'.format(sum(per_update) / len(per_update) * 1e6))
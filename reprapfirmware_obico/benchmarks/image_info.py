@@ -0,0 +1,125 @@
+"""
+    Compares utils.get_image_info with the implementation it replaced, which decoded the whole image to a str.
+
+    python3 -m reprapfirmware_obico.benchmarks.image_info [frame.jpg ...]
+
+    Pass real camera frames when possible. Synthetic 1080p jpegs are generated when none are given (requires Pillow).
+"""
+import argparse
+import io
+import struct
+import time
+import tracemalloc
+from io import BytesIO
+
+from ..utils import get_image_info
+
+
+# The implementation before the memoryview parser, kept verbatim as the baseline
+
+def legacy_get_image_info(data):
+    data_bytes = data
+    if not isinstance(data, str):
+        data = data.decode('iso-8859-1')
+    size = len(data)
+    height = -1
+    width = -1
+    content_type = ''
+
+    # handle GIFs
+    if (size >= 10) and data[:6] in ('GIF87a', 'GIF89a'):
+        # Check to see if content_type is correct
+        content_type = 'image/gif'
+        w, h = struct.unpack("<HH", data[6:10])
+        width = int(w)
+        height = int(h)
+
+    # See PNG 2. Edition spec (http://www.w3.org/TR/PNG/)
+    # Bytes 0-7 are below, 4-byte chunk length, then 'IHDR'
+    # and finally the 4-byte width, height
+    elif ((size >= 24) and data.startswith('\211PNG\r\n\032\n')
+          and (data[12:16] == 'IHDR')):
+        content_type = 'image/png'
+        w, h = struct.unpack(">LL", data[16:24])
+        width = int(w)
+        height = int(h)
+
+    # Maybe this is for an older PNG version.
+    elif (size >= 16) and data.startswith('\211PNG\r\n\032\n'):
+        # Check to see if we have the right content type
+        content_type = 'image/png'
+        w, h = struct.unpack(">LL", data[8:16])
+        width = int(w)
+        height = int(h)
+
+    # handle JPEGs
+    elif (size >= 2) and data.startswith('\377\330'):
+        content_type = 'image/jpeg'
+        jpeg = BytesIO(data_bytes)
+        jpeg.read(2)
+        b = jpeg.read(1)
+        try:
+            while (b and ord(b) != 0xDA):
+                while (ord(b) != 0xFF):
+                    b = jpeg.read(1)
+                while (ord(b) == 0xFF):
+                    b = jpeg.read(1)
+                if (ord(b) >= 0xC0 and ord(b) <= 0xC3):
+                    jpeg.read(3)
+                    h, w = struct.unpack(">HH", jpeg.read(4))
+                    break
+                else:
+                    jpeg.read(int(struct.unpack(">H", jpeg.read(2))[0])-2)
+                b = jpeg.read(1)
+            width = int(w)
+            height = int(h)
+        except struct.error:
+            pass
+        except ValueError:
+            pass
+
+    return content_type, width, height
+
+
+def synthetic_frames(count):
+    from PIL import Image
+    frames = []
+    for i in range(count):
+        out = io.BytesIO()
+        Image.effect_noise((1920, 1080), 40 + i * 5).convert('RGB').save(out, format='JPEG', quality=90)
+        frames.append(out.getvalue())
+    return frames
+
+
+def bench(func, frames, repeats):
+    tracemalloc.start()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for f in frames:
+            result = func(f)
+    elapsed = time.perf_counter() - start
+    (_, peak) = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed / (repeats * len(frames)), peak, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('frames', nargs='*', help='jpeg/png/gif files captured from the camera')
+    parser.add_argument('-r', '--repeats', type=int, default=200)
+    args = parser.parse_args()
+
+    frames = []
+    for path in args.frames:
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+    frames = frames or synthetic_frames(4)
+
+    for f in frames:
+        assert get_image_info(f) == legacy_get_image_info(f), 'Results differ: {} vs {}'.format(get_image_info(f), legacy_get_image_info(f))
+
+    print('{} frames, {:.0f} bytes on average'.format(len(frames), sum(len(f) for f in frames) / len(frames)))
+    print('{:<12} {:>14} {:>16}'.format('impl', 'us/frame', 'peak alloc bytes'))
+    for (name, func) in (('legacy', legacy_get_image_info), ('memoryview', get_image_info)):
+        (per_frame, peak, _) = bench(func, frames, args.repeats)
+        print('{:<12} {:>14.1f} {:>16}'.format(name, per_frame * 1e6, peak))
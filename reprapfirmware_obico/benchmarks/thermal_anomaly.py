@@ -0,0 +1,138 @@
+"""
+    Replays heater traces through the thermal anomaly detector, and reports what it detected, how long after the
+    fault it did, and what each reading costs.
+
+    python3 -m reprapfirmware_obico.benchmarks.thermal_anomaly [trace.csv ...]
+
+    A trace is a csv of ts,heater,type,actual,target[,state], where state is the RRF heater state.
+    A fault_at column, if present on any row, marks when the fault was injected.
+    Simulated traces of healthy and failing heaters are replayed when none are given.
+"""
+import argparse
+import csv
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+
+from ..thermal_anomaly import HeaterWatch, LIMITS, effective_target
+
+AMBIENT = 25.0
+
+
+def simulate(heater_type, target, secs, fault=None, fault_at=None, seed=0):
+    """
+        A first-order heater model under a proportional controller.
+        fault: None, 'dead' (no power), 'loose' (the thermistor reads less and less), 'stuck_on' (full power),
+        'open' (the thermistor reads -273.1), or 'oscillating' (bang-bang control with a wide hysteresis).
+    """
+    rnd = random.Random(seed)
+    (max_power, loss, capacity) = (60.0, 0.25, 15.0) if heater_type == 'tool' else (250.0, 1.5, 400.0)
+    temp = AMBIENT
+    heating = True
+    rows = []
+    for t in range(secs):
+        faulty = fault is not None and t >= fault_at
+        error = target - temp
+        power = max(0.0, min(1.0, error / 10.0 + loss * (temp - AMBIENT) / max_power)) if target > 0 else 0.0
+        reading = temp
+        if faulty and fault == 'dead':
+            power = 0.0
+        elif faulty and fault == 'stuck_on':
+            power = 1.0
+        elif faulty and fault == 'oscillating':
+            heating = temp < target + 8 if heating else temp < target - 8
+            power = 1.0 if heating else 0.0
+        elif faulty and fault == 'loose':
+            reading = temp - (temp - AMBIENT) * min((t - fault_at) / 120.0, 0.6)  # Reads closer and closer to the air around it
+            power = 1.0 if reading < target else power
+        elif faulty and fault == 'open':
+            reading = -273.1
+
+        temp += (power * max_power - loss * (temp - AMBIENT)) / capacity
+        rows.append((float(t), reading + rnd.gauss(0, 0.2) if reading > -273 else reading, target))
+    return rows
+
+
+SCENARIOS = [
+    # (label, heater type, target, seconds, fault, fault_at, expected anomaly or None)
+    ('healthy hotend', 'tool', 210, 1800, None, None, None),
+    ('healthy bed', 'bed', 60, 1800, None, None, None),
+    ('dead hotend heater', 'tool', 210, 600, 'dead', 0, 'not_heating'),
+    ('dead bed heater', 'bed', 60, 900, 'dead', 0, 'not_heating'),
+    ('loose hotend thermistor', 'tool', 210, 1200, 'loose', 600, 'runaway'),
+    ('stuck-on bed heater', 'bed', 0, 1800, 'stuck_on', 300, 'uncontrolled_heating'),
+    ('stuck-on hotend heater', 'tool', 0, 600, 'stuck_on', 300, 'uncontrolled_heating'),
+    ('open hotend thermistor', 'tool', 210, 900, 'open', 600, 'sensor'),
+    ('oscillating hotend', 'tool', 210, 1800, 'oscillating', 600, 'unstable'),
+]
+
+
+def load_traces(paths):
+    traces = []
+    for path in paths:
+        heaters = {}
+        with open(path, newline='') as f:
+            for row in csv.DictReader(f):
+                heater = SimpleNamespace(target=float(row['target']), state=row.get('state') or None)
+                trace = heaters.setdefault(row['heater'], dict(type=row['type'], rows=[], fault_at=None))
+                trace['rows'].append((float(row['ts']), float(row['actual']), effective_target(heater)))
+                if row.get('fault_at'):
+                    trace['fault_at'] = float(row['fault_at'])
+        for (name, trace) in heaters.items():
+            traces.append(('{}:{}'.format(path, name), trace['type'], trace['rows'], trace['fault_at'], None))
+    return traces
+
+
+def replay(heater_type, rows):
+    watch = HeaterWatch(LIMITS.get(heater_type, LIMITS['tool']))
+    found = []
+    start = time.perf_counter()
+    for (ts, actual, target) in rows:
+        if target is None:
+            continue
+        for (kind, _) in watch.update(actual, target, ts):
+            found.append((ts, kind))
+    return found, (time.perf_counter() - start) / len(rows)
+
+
+def watch_size(heater_type, rows):
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    watch = HeaterWatch(LIMITS[heater_type])
+    for (ts, actual, target) in rows:
+        watch.update(actual, target, ts)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('traces', nargs='*', help='csv traces of ts,heater,type,actual,target[,state][,fault_at]')
+    args = parser.parse_args()
+
+    if args.traces:
+        traces = load_traces(args.traces)
+    else:
+        traces = [(label, heater_type, simulate(heater_type, target, secs, fault, fault_at), fault_at, expected)
+                  for (label, heater_type, target, secs, fault, fault_at, expected) in SCENARIOS]
+
+    print('{:<28} {:>9} {:<24} {:>12} {:>10}'.format('trace', 'readings', 'detected', 'after fault', 'us/reading'))
+    missed = false_alarms = 0
+    for (label, heater_type, rows, fault_at, expected) in traces:
+        (found, per_reading) = replay(heater_type, rows)
+        kinds = ','.join(sorted(set(kind for (_, kind) in found))) or '-'
+        first = next((ts for (ts, kind) in found if expected is None or kind == expected), None)
+        after = '{:.0f}s'.format(first - fault_at) if first is not None and fault_at is not None else '-'
+        print('{:<28} {:>9} {:<24} {:>12} {:>10.2f}'.format(label, len(rows), kinds, after, per_reading * 1e6))
+
+        if expected and not any(kind == expected for (_, kind) in found):
+            missed += 1
+        if fault_at is None and expected is None and found:
+            false_alarms += 1
+
+    if not args.traces:
+        print('\n{} missed, {} false alarms'.format(missed, false_alarms))
+    rows = simulate('tool', 210, 3600)
+    print('{} bytes per heater after {} readings'.format(watch_size('tool', rows), len(rows)))
@@ -0,0 +1,76 @@
+"""
+    Compares bytes sent and CPU cost per frame with and without snapshot transcoding.
+
+    python3 -m reprapfirmware_obico.benchmarks.transcode [frame.jpg ...]
+
+    Pass real camera frames when possible. Synthetic 1080p frames are generated when none are given.
+"""
+import argparse
+import io
+import time
+
+from ..webcam_image import SnapshotTranscoder, Image
+
+
+class BenchWebcamConfig:
+    snapshot_transcode = True
+    rotation = 0
+
+
+SCENARIOS = [
+    # (label, viewing_boost, upload bandwidth in bytes/s or None for unknown)
+    ('periodic', False, None),
+    ('viewing boost', True, None),
+    ('periodic @ 1 Mbps', False, 125000),
+    ('viewing boost @ 1 Mbps', True, 125000),
+    ('viewing boost @ 256 kbps', True, 32000),
+]
+
+
+def synthetic_frames(count):
+    import random
+    frames = []
+    for i in range(count):
+        img = Image.effect_noise((1920, 1080), 40 + i * 5).convert('RGB')
+        img.paste((random.randint(0, 255), 128, 64), (200 + i * 40, 300, 900 + i * 40, 800))
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=92)
+        frames.append(out.getvalue())
+    return frames
+
+
+def run(frames, repeats):
+    print('{:<26} {:>12} {:>12} {:>14}'.format('scenario', 'bytes/frame', 'vs original', 'cpu ms/frame'))
+    original = sum(len(f) for f in frames) / len(frames)
+    print('{:<26} {:>12.0f} {:>11.0%} {:>14.1f}'.format('original', original, 1, 0))
+
+    for (label, viewing_boost, bytes_per_sec) in SCENARIOS:
+        transcoder = SnapshotTranscoder(BenchWebcamConfig())
+        transcoder.transcode(frames[0], viewing_boost=viewing_boost)  # Prime last_output
+        transcoder.bandwidth.bytes_per_sec = bytes_per_sec
+
+        total_bytes = 0
+        cpu_start = time.process_time()
+        for _ in range(repeats):
+            for f in frames:
+                total_bytes += len(transcoder.transcode(f, viewing_boost=viewing_boost))
+        cpu = time.process_time() - cpu_start
+
+        num = repeats * len(frames)
+        print('{:<26} {:>12.0f} {:>11.0%} {:>14.1f}'.format(label, total_bytes / num, total_bytes / num / original, cpu / num * 1000))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('frames', nargs='*', help='jpeg files captured from the camera')
+    parser.add_argument('-r', '--repeats', type=int, default=5)
+    args = parser.parse_args()
+
+    if Image is None:
+        raise SystemExit('Pillow is required for this benchmark.')
+
+    frames = []
+    for path in args.frames:
+        with open(path, 'rb') as f:
+            frames.append(f.read())
+    run(frames or synthetic_frames(4), args.repeats)
@@ -1,6 +1,7 @@
 import dataclasses
 from typing import Optional
 import re
+import os
 from configparser import ConfigParser
 from urllib.parse import urlparse
 import logging
@@ -72,8 +73,9 @@ class TunnelConfig:
 @dataclasses.dataclass
 class WebcamConfig:
 
-    def __init__(self, webcam_config_section):
+    def __init__(self, webcam_config_section, name=None):
         self.webcam_config_section = webcam_config_section
+        self.name = name  # None for the primary webcam, configured in [webcam]
         self.moonraker_webcam_config = {}
 
     @property
@@ -97,6 +99,100 @@ class WebcamConfig:
             fps = 25
         return min(fps, 25)
 
+    @property
+    def snapshot_max_age(self):
+        # Captures within this many seconds of each other share the same frame
+        try:
+            return max(self.webcam_config_section.getfloat('snapshot_max_age', 1.0), 0)
+        except:
+            _logger.warn(f'Invalid snapshot_max_age value. Using default.')
+            return 1.0
+
+    @property
+    def snapshot_transcode(self):
+        try:
+            return self.webcam_config_section.getboolean('snapshot_transcode', False)
+        except:
+            _logger.warn(f'Invalid snapshot_transcode value. Using default.')
+            return False
+
+    @property
+    def scene_change_gate(self):
+        try:
+            return self.webcam_config_section.getboolean('scene_change_gate', False)
+        except:
+            _logger.warn(f'Invalid scene_change_gate value. Using default.')
+            return False
+
+    @property
+    def scene_change_threshold(self):
+        # Mean absolute luminance difference (0-255) below which a frame is considered unchanged
+        try:
+            return self.webcam_config_section.getfloat('scene_change_threshold', 2.0)
+        except:
+            _logger.warn(f'Invalid scene_change_threshold value. Using default.')
+            return 2.0
+
+    @property
+    def scene_change_max_staleness(self):
+        try:
+            return self.webcam_config_section.getfloat('scene_change_max_staleness', 600.0)
+        except:
+            _logger.warn(f'Invalid scene_change_max_staleness value. Using default.')
+            return 600.0
+
+    @property
+    def snapshot_on_layer_change(self):
+        try:
+            return self.webcam_config_section.getboolean('snapshot_on_layer_change', True)
+        except:
+            _logger.warn(f'Invalid snapshot_on_layer_change value. Using default.')
+            return True
+
+    @property
+    def post_additional_webcams(self):
+        # Snapshots of [webcam <name>] sections are posted with a webcam_name field, which only some servers file separately
+        try:
+            return self.webcam_config_section.getboolean('post_additional_webcams', False)
+        except:
+            _logger.warn(f'Invalid post_additional_webcams value. Using default.')
+            return False
+
+    @property
+    def isolated_process(self):
+        # Run snapshot posting and streaming in a child process so that they don't compete with the printer connection for the GIL
+        try:
+            return self.webcam_config_section.getboolean('isolated_process', False)
+        except:
+            _logger.warn(f'Invalid isolated_process value. Using default.')
+            return False
+
+    @property
+    def mjpeg_relay(self):
+        # Share one connection to stream_url between snapshots, including tunneled ones, and ffmpeg
+        try:
+            return self.webcam_config_section.getboolean('mjpeg_relay', False) and bool(self.stream_url)
+        except:
+            _logger.warn(f'Invalid mjpeg_relay value. Using default.')
+            return False
+
+    @property
+    def mjpeg_relay_port(self):
+        try:
+            return self.webcam_config_section.getint('mjpeg_relay_port', 17740)
+        except:
+            _logger.warn(f'Invalid mjpeg_relay_port value. Using default.')
+            return 17740
+
+    @property
+    def streaming_governor(self):
+        # Adapt fps, bitrate and resolution to CPU load instead of only warning about it
+        try:
+            return self.webcam_config_section.getboolean('streaming_governor', True)
+        except:
+            _logger.warn(f'Invalid streaming_governor value. Using default.')
+            return True
+
     @property
     def snapshot_ssl_validation(self):
         return False
@@ -159,6 +255,26 @@ class WebcamConfig:
         return full_url
 
 
+@dataclasses.dataclass
+class TimelapseConfig:
+    enabled: bool = False
+    min_interval: float = 10.0  # seconds between recorded frames
+    fps: int = 30
+    max_disk_mb: int = 500
+    upload: bool = False  # The server has to accept chunks at TIMELAPSE_UPLOAD_URI
+
+
+@dataclasses.dataclass
+class TelemetryConfig:
+    enabled: bool = False
+    rate_hz: float = 5.0  # frames per second pushed to the WebRTC data channel while someone is viewing
+
+
+@dataclasses.dataclass
+class ThermalAnomalyConfig:
+    enabled: bool = True
+
+
 @dataclasses.dataclass
 class LoggingConfig:
     path: str
@@ -223,6 +339,41 @@ class Config:
 
         self.webcam = WebcamConfig(webcam_config_section=config['webcam'])
 
+        # Additional webcams are configured in [webcam <name>] sections. Only the primary webcam is streamed.
+        self.webcams = [self.webcam] + [
+            WebcamConfig(webcam_config_section=config[section], name=section[len('webcam'):].strip())
+            for section in config.sections() if section.startswith('webcam ') and section[len('webcam'):].strip()
+        ]
+
+        try:
+            self.timelapse = TimelapseConfig(
+                enabled=config.getboolean('timelapse', 'enabled', fallback=False),
+                min_interval=max(config.getfloat('timelapse', 'min_interval', fallback=TimelapseConfig.min_interval), 1.0),
+                fps=config.getint('timelapse', 'fps', fallback=TimelapseConfig.fps),
+                max_disk_mb=config.getint('timelapse', 'max_disk_mb', fallback=TimelapseConfig.max_disk_mb),
+                upload=config.getboolean('timelapse', 'upload', fallback=TimelapseConfig.upload),
+            )
+        except:
+            _logger.warn(f'Invalid [timelapse] values. Timelapse disabled.')
+            self.timelapse = TimelapseConfig()
+
+        try:
+            self.telemetry = TelemetryConfig(
+                enabled=config.getboolean('telemetry', 'enabled', fallback=False),
+                rate_hz=min(max(config.getfloat('telemetry', 'rate_hz', fallback=TelemetryConfig.rate_hz), 0.2), 20.0),
+            )
+        except:
+            _logger.warn(f'Invalid [telemetry] values. Telemetry disabled.')
+            self.telemetry = TelemetryConfig()
+
+        try:
+            self.thermal_anomaly = ThermalAnomalyConfig(
+                enabled=config.getboolean('thermal_anomaly', 'enabled', fallback=True),
+            )
+        except:
+            _logger.warn(f'Invalid [thermal_anomaly] values. Using default.')
+            self.thermal_anomaly = ThermalAnomalyConfig()
+
         self.logging = LoggingConfig(
             path=config.get(
                 'logging', 'path',
@@ -239,6 +390,17 @@ class Config:
             fallback='out'
         )
 
+        self.cache_dir = os.path.expanduser(config.get(
+            'misc', 'cache_dir',
+            fallback='~/.cache/reprapfirmware-obico'
+        ))
+
+        # 'threaded' (one thread per websocket connection) or 'asyncio' (all connections share one event loop thread)
+        self.websocket_client = config.get(
+            'misc', 'websocket_client',
+            fallback='threaded'
+        ).strip().lower()
+
         self._config = config
 
     def write(self) -> None:
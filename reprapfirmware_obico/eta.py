@@ -0,0 +1,111 @@
+import logging
+import math
+
+_logger = logging.getLogger('obico.eta')
+
+RATE_TAU_SECS = 600.0  # Time constant of the smoothed progress rate
+RECENT_RATE_WEIGHT = 0.3  # vs. the average rate since the start
+LAYER_EWMA_ALPHA = 0.3
+FINISH_TIME_EWMA_ALPHA = 0.2
+MIN_COMPLETION = 0.005  # Progress rates below this are mostly noise from the start gcode
+SLICER_FACTOR_RANGE = (0.5, 3.0)  # How far the printer may be off the slicer's pace before the slicer estimate is ignored
+RRF_SETTLED_COMPLETION = 0.25  # RRF's file-based estimate is way off early on, and beats the others from about here
+RRF_MAX_WEIGHT = 16.0
+
+
+class EtaEstimator:
+    """
+        Estimates the print time left from four sources, blended by how much each can be trusted so far:
+        - the slicer's estimate, rescaled by how far the print is ahead of or behind its pace, which is all there is at the start
+        - the smoothed rate of progress, which takes over as the print goes on
+        - the recent completed layers in job.layers, whose pace follows the print's geometry more closely than bytes do
+        - RRF's own file-based estimate, which is far off early on but the most accurate once it has settled,
+          so it is handed over to from RRF_SETTLED_COMPLETION on
+        The blended finish time is smoothed, so the estimate doesn't swing from one status to the next.
+        Each update is O(1): only the layers completed since the last update are looked at.
+    """
+
+    def __init__(self):
+        self.reset(None)
+
+    def reset(self, job_key):
+        self.job_key = job_key
+        self.last_print_time = None
+        self.last_completion = None
+        self.rate = None  # completion per second, smoothed
+        self.layers_seen = 0
+        self.layer_rate = None  # completion per second over recent layers, smoothed
+        self.layer_secs = None  # seconds per layer, smoothed, for when layers don't report fractionPrinted
+        self.layer_fraction = 0.0
+        self.finish_at = None  # print time at which the print is expected to finish, smoothed
+
+    # completion: 0-1. print_time: seconds printed so far. slicer_time: the slicer's total estimate, if any.
+    # rrf_time_left: RRF's timesLeft.file, if any.
+    # Return: Seconds left, or None if there is nothing to go on yet.
+    def update(self, job_key, completion, print_time, layers=None, total_layers=None, slicer_time=None, rrf_time_left=None):
+        if job_key != self.job_key or (self.last_print_time is not None and print_time < self.last_print_time):
+            self.reset(job_key)
+        if print_time is None or completion is None:
+            return None
+        completion = min(max(completion, 0.0), 1.0)
+
+        if self.last_print_time is not None and print_time > self.last_print_time and completion >= MIN_COMPLETION:
+            dt = print_time - self.last_print_time
+            instant = max(completion - self.last_completion, 0.0) / dt
+            if self.rate is None:
+                self.rate = completion / print_time if print_time > 0 else instant
+            alpha = 1.0 - math.exp(-dt / RATE_TAU_SECS)
+            self.rate += alpha * (instant - self.rate)
+        self.last_print_time = print_time
+        self.last_completion = completion
+
+        self._update_layers(layers or [])
+
+        estimates = []  # (seconds left, weight)
+        if slicer_time:
+            factor = 1.0
+            if completion >= MIN_COMPLETION:
+                factor = min(max(print_time / (slicer_time * completion), SLICER_FACTOR_RANGE[0]), SLICER_FACTOR_RANGE[1])
+                factor = 1.0 + (factor - 1.0) * min(completion / 0.1, 1.0)  # The first few percent say little about the pace
+            estimates.append((slicer_time * (1.0 - completion) * factor, max(1.0 - completion / 0.25, 0.02)))
+
+        if self.rate and completion >= MIN_COMPLETION:
+            # Recent pace, tempered by the average pace so far
+            rate = RECENT_RATE_WEIGHT * self.rate + (1.0 - RECENT_RATE_WEIGHT) * completion / print_time
+            estimates.append(((1.0 - completion) / rate, min(completion / 0.1, 1.0) ** 2 * min(print_time / 300.0, 1.0)))
+
+        if self.layer_rate:
+            estimates.append(((1.0 - completion) / self.layer_rate, min(self.layers_seen / 3.0, 1.0) * 0.5))
+        elif self.layer_secs and total_layers and self.layers_seen:
+            estimates.append((self.layer_secs * max(total_layers - self.layers_seen, 0), min(self.layers_seen / 3.0, 1.0) * 0.5))
+
+        if rrf_time_left is not None and completion >= MIN_COMPLETION:
+            estimates.append((rrf_time_left, RRF_MAX_WEIGHT * min(completion / RRF_SETTLED_COMPLETION, 1.0) ** 4))
+
+        total_weight = sum(w for (_, w) in estimates)
+        if total_weight <= 0:
+            return None
+
+        finish_at = print_time + sum(secs * w for (secs, w) in estimates) / total_weight
+        if self.finish_at is None:
+            self.finish_at = finish_at
+        else:
+            self.finish_at += FINISH_TIME_EWMA_ALPHA * (finish_at - self.finish_at)
+        return max(self.finish_at - print_time, 0.0)
+
+    def _update_layers(self, layers):
+        if len(layers) < self.layers_seen:  # RRF started the list over
+            self.layers_seen = 0
+            self.layer_fraction = 0.0
+
+        for layer in layers[self.layers_seen:]:
+            duration = layer.get('duration') or 0
+            fraction = layer.get('fractionPrinted')
+            if duration > 0:
+                self.layer_secs = duration if self.layer_secs is None else self.layer_secs + LAYER_EWMA_ALPHA * (duration - self.layer_secs)
+                if fraction is not None and fraction >= self.layer_fraction:
+                    rate = (fraction - self.layer_fraction) / duration
+                    self.layer_rate = rate if self.layer_rate is None else self.layer_rate + LAYER_EWMA_ALPHA * (rate - self.layer_rate)
+            if fraction is not None:
+                self.layer_fraction = fraction
+        self.layers_seen = len(layers)
@@ -0,0 +1,236 @@
+import array
+import bisect
+import hashlib
+import logging
+import os
+import re
+import struct
+import sys
+import threading
+
+from . import metrics
+
+_logger = logging.getLogger('obico.gcode_analyzer')
+
+INDEX_DIR = 'gcode_index'
+INDEX_MAGIC = b'OBGI'
+INDEX_VERSION = 1
+INDEX_HEADER = struct.Struct('<4sIIQdf')  # magic, version, number of layers, file size, total extrusion, max z
+
+MIN_LAYER_HEIGHT = 0.03  # Extruding at less than this above the current layer, e.g. in vase mode, doesn't start a new one
+MAX_CACHED_INDEXES = 8
+
+# Only the commands that move Z, extrude, or change how positions are interpreted. Everything after ';' is a comment.
+COMMAND_RE = re.compile(rb'^[ \t]*(G0|G1|G92|G90|G91|M82|M83)(?![0-9.])([^;\n]*)', re.MULTILINE)
+Z_RE = re.compile(rb'Z\s*(-?\d*\.?\d+)')
+E_RE = re.compile(rb'E\s*(-?\d*\.?\d+)')
+
+
+def file_signature(path, size, last_modified):
+    # Same file as RRF reports it in job.file and in rr_fileinfo: e.g. '0:/gcodes/a.gcode', 'gcodes/a.gcode' and 'a.gcode' are all 'a.gcode'
+    name = re.sub(r'^(\d+:)?/?(gcodes/)?', '', path or '')
+    if not name or not size or not last_modified:
+        return None
+    return hashlib.sha1('{}|{}|{}'.format(name, int(size), last_modified).encode('utf-8')).hexdigest()
+
+
+class GcodeIndex:
+    """
+        Where each layer starts in a g-code file: byte offset, Z height, and the filament extruded before it.
+        Looking up the layer, or the filament extruded, at a file position is a binary search.
+    """
+
+    def __init__(self, offsets, zs, extrusions, file_size, total_extrusion):
+        self.offsets = offsets  # array('Q')
+        self.zs = zs  # array('f')
+        self.extrusions = extrusions  # array('f')
+        self.file_size = file_size
+        self.total_extrusion = total_extrusion
+        self.max_z = max(zs) if zs else 0.0
+
+    @property
+    def num_layers(self):
+        return len(self.offsets)
+
+    # Return: The 1-based layer being printed at pos, 0 before the first layer.
+    def layer_at(self, pos):
+        return bisect.bisect_right(self.offsets, pos)
+
+    # Return: The filament extruded up to pos, interpolated by bytes within the layer.
+    def extrusion_at(self, pos):
+        layer = self.layer_at(pos)
+        if layer == 0:
+            return 0.0
+        start = self.offsets[layer - 1]
+        (end, end_e) = (self.offsets[layer], self.extrusions[layer]) if layer < len(self.offsets) else (self.file_size, self.total_extrusion)
+        start_e = self.extrusions[layer - 1]
+        if end <= start:
+            return start_e
+        return start_e + (end_e - start_e) * min(max((pos - start) / (end - start), 0.0), 1.0)
+
+    # Return: The fraction of the print done at pos, by filament extruded, or None if nothing is extruded.
+    def completion_at(self, pos):
+        if self.total_extrusion <= 0:
+            return None
+        return min(max(self.extrusion_at(pos) / self.total_extrusion, 0.0), 1.0)
+
+    def save(self, path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(INDEX_HEADER.pack(INDEX_MAGIC, INDEX_VERSION, len(self.offsets), self.file_size, self.total_extrusion, self.max_z))
+            for column in (self.offsets, self.zs, self.extrusions):
+                f.write(_little_endian(column).tobytes())
+        os.replace(path + '.tmp', path)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as f:
+            data = f.read()
+        (magic, version, num_layers, file_size, total_extrusion, _) = INDEX_HEADER.unpack_from(data, 0)
+        if magic != INDEX_MAGIC or version != INDEX_VERSION:
+            raise ValueError('Not a g-code index: {}'.format(path))
+
+        pos = INDEX_HEADER.size
+        columns = []
+        for typecode in ('Q', 'f', 'f'):
+            column = array.array(typecode)
+            size = column.itemsize * num_layers
+            column.frombytes(data[pos:pos + size])
+            columns.append(_little_endian(column))
+            pos += size
+        return cls(*columns, file_size=file_size, total_extrusion=total_extrusion)
+
+
+def _little_endian(column):
+    if sys.byteorder != 'little':
+        column = array.array(column.typecode, column)
+        column.byteswap()
+    return column
+
+
+class GcodeAnalyzer:
+    """
+        Builds a GcodeIndex from a g-code file as it streams by, in chunks of any size, without keeping the file.
+        A layer starts at the first extruding move at a Z above the current layer, so that Z hops and travel
+        moves don't count as layers whatever the slicer.
+    """
+
+    def __init__(self):
+        self.offsets = array.array('Q')
+        self.zs = array.array('f')
+        self.extrusions = array.array('f')
+        self.pos = 0  # File offset of self._rest
+        self._rest = b''
+
+        self.absolute_xyz = True
+        self.absolute_e = True
+        self.z = 0.0
+        self.e = 0.0  # Current E position, for absolute extrusion
+        self.extruded = 0.0  # Net filament extruded so far
+        self.layer_z = None
+
+    def feed(self, chunk):
+        data = self._rest + chunk if self._rest else chunk
+        end = data.rfind(b'\n') + 1
+        if end == 0:
+            self._rest = data
+            return
+        self._parse(data, end)
+        self.pos += end
+        self._rest = data[end:]
+
+    def finish(self):
+        if self._rest:
+            self._parse(self._rest, len(self._rest))
+            self.pos += len(self._rest)
+            self._rest = b''
+        return GcodeIndex(self.offsets, self.zs, self.extrusions, self.pos, self.extruded)
+
+    def _parse(self, data, end):
+        for m in COMMAND_RE.finditer(data, 0, end):
+            (cmd, params) = m.groups()
+            if cmd in (b'G1', b'G0'):
+                z = Z_RE.search(params)
+                if z:
+                    self.z = float(z.group(1)) if self.absolute_xyz else self.z + float(z.group(1))
+                e = E_RE.search(params)
+                if e:
+                    value = float(e.group(1))
+                    delta = value - self.e if self.absolute_e else value
+                    self.e = value if self.absolute_e else self.e + value
+                    if delta > 0 and (self.layer_z is None or self.z >= self.layer_z + MIN_LAYER_HEIGHT):
+                        self.layer_z = self.z
+                        self.offsets.append(self.pos + m.start())
+                        self.zs.append(self.z)
+                        self.extrusions.append(self.extruded)
+                    self.extruded += delta
+            elif cmd == b'G92':
+                e = E_RE.search(params)
+                if e:
+                    self.e = float(e.group(1))
+                z = Z_RE.search(params)
+                if z:
+                    self.z = float(z.group(1))
+            elif cmd == b'G90':
+                self.absolute_xyz = self.absolute_e = True
+            elif cmd == b'G91':
+                self.absolute_xyz = self.absolute_e = False
+            elif cmd == b'M82':
+                self.absolute_e = True
+            elif cmd == b'M83':
+                self.absolute_e = False
+
+
+class GcodeIndexCache:
+    """
+        Indexes by file signature, kept in memory and in cache_dir/gcode_index/.
+        Misses are remembered too, so that a file without an index costs one stat, not one per status update.
+    """
+
+    def __init__(self, cache_dir):
+        self.dir = os.path.join(cache_dir, INDEX_DIR)
+        self._mutex = threading.Lock()
+        self._indexes = {}  # signature -> GcodeIndex, or None if there is none
+
+    def put(self, signature, index):
+        try:
+            index.save(os.path.join(self.dir, signature))
+        except OSError as e:
+            _logger.warning('Failed to save g-code index - {}'.format(e))
+        self._remember(signature, index)
+
+    def get(self, signature):
+        if not signature:
+            return None
+        with self._mutex:
+            if signature in self._indexes:
+                return self._indexes[signature]
+
+        path = os.path.join(self.dir, signature)
+        index = None
+        if os.path.exists(path):
+            try:
+                index = GcodeIndex.load(path)
+            except (OSError, ValueError, struct.error) as e:
+                _logger.warning('Failed to load g-code index {} - {}'.format(path, e))
+        self._remember(signature, index)
+        return index
+
+    def _remember(self, signature, index):
+        with self._mutex:
+            self._indexes.pop(signature, None)
+            self._indexes[signature] = index
+            while len(self._indexes) > MAX_CACHED_INDEXES:
+                self._indexes.pop(next(iter(self._indexes)))
+        metrics.gauge('gcode_analyzer.cached_indexes').set(len(self._indexes))
+
+
+_caches = {}
+_caches_mutex = threading.Lock()
+
+
+def index_cache_for(cache_dir):
+    with _caches_mutex:
+        if cache_dir not in _caches:
+            _caches[cache_dir] = GcodeIndexCache(cache_dir)
+        return _caches[cache_dir]
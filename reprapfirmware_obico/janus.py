@@ -9,7 +9,8 @@ import socket
 import psutil
 
 from .utils import ExpoBackoff, pi_version, to_unicode, is_port_open
-from .ws import WebSocketClient
+from .ws import new_websocket_client
+from . import metrics
 from .webcam_stream import WebcamStreamer
 
 _logger = logging.getLogger('obico.janus')
@@ -21,6 +22,9 @@ JANUS_PRINTER_DATA_PORT = 17739
 MAX_PAYLOAD_SIZE = 1500  # hardcoded in streaming plugin
 CAMERA_STREAMER_RTSP_PORT = 8554
 
+# Data channel messages from the browser carry plugindata.data.thespaghettidetective. Any other message is relayed without parsing.
+DATA_CHANNEL_MARKER = '"thespaghettidetective"'
+
 
 class JanusNotSupportedException(Exception):
     pass
@@ -28,7 +32,7 @@ class JanusNotSupportedException(Exception):
 
 class JanusConn:
 
-    def __init__(self, app_model, server_conn, sentry):
+    def __init__(self, app_model, server_conn, sentry, webcam_worker=None, process_client_msg=None):
         self.config = app_model.config
         self.app_model = app_model
         self.server_conn = server_conn
@@ -38,6 +42,9 @@ class JanusConn:
         self.janus_proc = None
         self.shutting_down = False
         self.webcam_streamer = None
+        self.webcam_worker = webcam_worker  # When set, the worker process runs the webcam streamer
+        self.process_client_msg = process_client_msg  # process_client_msg(msg, reply) for messages from the WebRTC data channel
+        self.printer_data_sock = None
         self.use_camera_streamer_rtsp = False
 
     def start(self):
@@ -97,12 +104,16 @@ class JanusConn:
         self.use_camera_streamer_rtsp = self.app_model.linked_printer.get('is_pro') and is_port_open('127.0.0.1', CAMERA_STREAMER_RTSP_PORT)
         _logger.debug(f'Using camera streamer RSTP? {self.use_camera_streamer_rtsp}')
 
-        self.webcam_streamer = WebcamStreamer(self.app_model, self.server_conn, self.sentry)
-        if not self.config.webcam.disable_video_streaming and not self.use_camera_streamer_rtsp:
-            _logger.info('Starting webcam streamer')
-            stream_thread = Thread(target=self.webcam_streamer.video_pipeline)
-            stream_thread.daemon = True
-            stream_thread.start()
+        if self.webcam_worker:
+            if not self.config.webcam.disable_video_streaming and not self.use_camera_streamer_rtsp:
+                self.webcam_worker.start_streaming()
+        else:
+            self.webcam_streamer = WebcamStreamer(self.app_model, self.server_conn, self.sentry)
+            if not self.config.webcam.disable_video_streaming and not self.use_camera_streamer_rtsp:
+                _logger.info('Starting webcam streamer')
+                stream_thread = Thread(target=self.webcam_streamer.video_pipeline)
+                stream_thread.daemon = True
+                stream_thread.start()
 
         janus_proc_thread = Thread(target=run_janus_forever)
         janus_proc_thread.daemon = True
@@ -115,6 +126,30 @@ class JanusConn:
         if self.janus_ws and self.janus_ws.connected():
             self.janus_ws.send(msg)
 
+    # Send a message to the browser over the WebRTC data channel, through the printer data port of the Janus streaming plugin.
+    # Return: False if the message can't go through the data channel, and needs to be sent another way.
+    def send_msg_to_client(self, data):
+        if not self.janus_ws or not self.janus_ws.connected():
+            return False
+
+        msg = json.dumps(data, default=str).encode('utf8')
+        if len(msg) > MAX_PAYLOAD_SIZE:
+            metrics.counter('janus.data_channel_oversized').inc()
+            return False
+
+        return self.send_printer_data(msg)
+
+    def send_printer_data(self, payload):
+        try:
+            if self.printer_data_sock is None:
+                self.printer_data_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.printer_data_sock.sendto(payload, (JANUS_SERVER, JANUS_PRINTER_DATA_PORT))
+        except OSError as e:
+            _logger.debug('Failed to send to the data channel - {}'.format(e))
+            return False
+        metrics.counter('janus.data_channel_sent').inc()
+        return True
+
     @backoff.on_exception(backoff.expo, Exception, max_tries=10)
     def wait_for_janus(self):
         time.sleep(1)
@@ -132,7 +167,7 @@ class JanusConn:
             if self.process_janus_msg(msg):
                 self.janus_ws_backoff.reset()
 
-        self.janus_ws = WebSocketClient(
+        self.janus_ws = new_websocket_client(
             'ws://{}:{}/'.format(JANUS_SERVER, JANUS_WS_PORT),
             on_ws_msg=on_message,
             on_ws_close=on_close,
@@ -159,22 +194,37 @@ class JanusConn:
             self.webcam_streamer.restore()
 
     def process_janus_msg(self, raw_msg):
+        start = time.monotonic()
         try:
-            msg = json.loads(raw_msg)
-
-            # when plugindata.data.obico is set, this is a incoming message from webrtc data channel
-            # https://github.com/TheSpaghettiDetective/janus-gateway/commit/e0bcc6b40f145ce72e487204354486b2977393ea
-            to_plugin = msg.get('plugindata', {}).get('data', {}).get('thespaghettidetective', {})
-
-            if to_plugin:
-                _logger.debug('Processing WebRTC data channel msg from client:')
-                _logger.debug(msg)
-                # TODO: make data channel work again
-                # self.plugin.client_conn.on_message_to_plugin(to_plugin)
-                return
-
-            _logger.debug('Relaying Janus msg')
-            _logger.debug(msg)
-            self.server_conn.send_ws_msg_to_server(dict(janus=raw_msg))
+            raw_msg = to_unicode(raw_msg)
+
+            # Only json.loads messages that may be from the data channel. A false positive is harmless.
+            if DATA_CHANNEL_MARKER in raw_msg:
+                msg = json.loads(raw_msg)
+
+                # when plugindata.data.obico is set, this is a incoming message from webrtc data channel
+                # https://github.com/TheSpaghettiDetective/janus-gateway/commit/e0bcc6b40f145ce72e487204354486b2977393ea
+                to_plugin = msg.get('plugindata', {}).get('data', {}).get('thespaghettidetective', {})
+
+                if to_plugin:
+                    metrics.counter('janus.data_channel_msgs').inc()
+                    if _logger.isEnabledFor(logging.DEBUG):
+                        _logger.debug('Processing WebRTC data channel msg from client: {}'.format(raw_msg))
+                    if isinstance(to_plugin, str):
+                        to_plugin = json.loads(to_plugin)
+                    if self.process_client_msg:
+                        # Passthru calls may block. Keep them off the Janus websocket thread.
+                        thread = Thread(target=self.process_client_msg, args=(to_plugin, self.send_msg_to_client))
+                        thread.daemon = True
+                        thread.start()
+                    return
+
+            if _logger.isEnabledFor(logging.DEBUG):
+                _logger.debug('Relaying Janus msg: {}'.format(raw_msg))
+            # Same as send_ws_msg_to_server(dict(janus=raw_msg)), minus building and re-walking the dict in the sending thread
+            self.server_conn.send_serialized_ws_msg_to_server('{"janus": ' + json.dumps(raw_msg) + '}')
+            metrics.counter('janus.relay_msgs').inc()
+            metrics.counter('janus.relay_bytes').inc(len(raw_msg))
+            metrics.latency('janus.relay').record(time.monotonic() - start)
         except:
             self.sentry.captureException()
@@ -0,0 +1,122 @@
+import bisect
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+_lock = threading.Lock()
+_latencies = {}
+_counters = {}
+_gauges = {}
+_remote = {}  # prefix -> the last snapshot() of another process, e.g. the webcam worker
+
+# Upper bounds, in seconds, of the latency histogram buckets. The last bucket counts everything slower.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+class LatencyStats:
+
+    def __init__(self, name):
+        self.name = name
+        self._mutex = threading.Lock()
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+        self.last = None
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def record(self, seconds):
+        with self._mutex:
+            self.count += 1
+            self.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+            self.total += seconds
+            self.last = seconds
+            if self.min is None or seconds < self.min:
+                self.min = seconds
+            if self.max is None or seconds > self.max:
+                self.max = seconds
+
+    @contextmanager
+    def time(self):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.record(time.monotonic() - start)
+
+    def to_dict(self) -> Dict:
+        with self._mutex:
+            return dict(
+                count=self.count,
+                mean=self.total / self.count if self.count else None,
+                min=self.min,
+                max=self.max,
+                last=self.last,
+                histogram={('le_{}'.format(bound) if bound else 'inf'): n for (bound, n) in zip(LATENCY_BUCKETS + (None,), self.buckets)},
+            )
+
+
+class Counter:
+
+    def __init__(self, name):
+        self.name = name
+        self._mutex = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._mutex:
+            self.value += amount
+
+    def to_dict(self) -> Dict:
+        return dict(value=self.value)
+
+
+class Gauge:
+
+    def __init__(self, name):
+        self.name = name
+        self.value = None
+
+    def set(self, value):
+        self.value = value
+
+    def to_dict(self) -> Dict:
+        return dict(value=self.value)
+
+
+def latency(name) -> LatencyStats:
+    with _lock:
+        if name not in _latencies:
+            _latencies[name] = LatencyStats(name)
+        return _latencies[name]
+
+
+def counter(name) -> Counter:
+    with _lock:
+        if name not in _counters:
+            _counters[name] = Counter(name)
+        return _counters[name]
+
+
+def gauge(name) -> Gauge:
+    with _lock:
+        if name not in _gauges:
+            _gauges[name] = Gauge(name)
+        return _gauges[name]
+
+
+# Metrics recorded in another process, and sent over to this one, are included in snapshot() under `prefix`.
+def set_remote_snapshot(prefix, remote_snapshot: Dict):
+    with _lock:
+        _remote[prefix] = remote_snapshot
+
+
+def snapshot() -> Dict:
+    with _lock:
+        metrics = list(_latencies.values()) + list(_counters.values()) + list(_gauges.values())
+        remote = list(_remote.items())
+    result = {m.name: m.to_dict() for m in metrics}
+    for (prefix, remote_snapshot) in remote:
+        result.update({prefix + name: value for (name, value) in remote_snapshot.items()})
+    return result
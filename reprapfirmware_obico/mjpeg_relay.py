@@ -0,0 +1,161 @@
+import logging
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from . import metrics
+from .webcam_capture import mjpeg_subscriber_for
+
+_logger = logging.getLogger('obico.mjpeg_relay')
+
+BOUNDARY = b'obicorelayboundary'
+CLIENT_SEND_TIMEOUT_SECS = 10  # Drop a viewer that can't take a single frame in this long
+
+_relays = {}
+_relays_mutex = threading.Lock()
+_running_ports = set()  # Ports with a relay up, in this process or in the webcam worker process
+
+
+def relay_url(webcam_config, path):
+    return 'http://127.0.0.1:{}{}'.format(webcam_config.mjpeg_relay_port, path)
+
+
+def relay_stream_url(webcam_config):
+    return relay_url(webcam_config, '/stream')
+
+
+# Return: The relay url to use in place of url if url points to the webcam's snapshot, otherwise None.
+# Only the path and query are compared, as the tunnel and the webcam config may spell the host differently.
+# The stream isn't routed: the tunnel reads a response to the end, and an mjpeg stream never ends.
+def route_to_relay(webcam_config, url):
+    if not relay_running(webcam_config) or not webcam_config.snapshot_url:
+        return None
+
+    def path_and_query(u):
+        parsed = urlparse(u)
+        return (parsed.path or '/', parsed.query)
+
+    if path_and_query(url) == path_and_query(webcam_config.snapshot_url):
+        return relay_url(webcam_config, '/snapshot')
+    return None
+
+
+# Callers fall back to the webcam's own urls when the relay isn't running, e.g. the port is taken.
+def relay_running(webcam_config):
+    return webcam_config.mjpeg_relay and webcam_config.mjpeg_relay_port in _running_ports
+
+
+def set_relay_running(port, running):
+    with _relays_mutex:
+        if running:
+            _running_ports.add(port)
+        else:
+            _running_ports.discard(port)
+
+
+# Return: The relay, or None if it can't listen on its port.
+def start_mjpeg_relay(webcam_config):
+    with _relays_mutex:
+        port = webcam_config.mjpeg_relay_port
+        if port not in _relays:
+            try:
+                relay = MjpegRelay(webcam_config)
+            except OSError as e:
+                _logger.warning('Failed to start the mjpeg relay on port {}. Using the webcam urls directly - {}'.format(port, e))
+                return None
+            relay.start()
+            _relays[port] = relay
+            _running_ports.add(port)
+        return _relays[port]
+
+
+class MjpegRelayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.0'
+
+    def do_GET(self):
+        path = urlparse(self.path).path.rstrip('/')
+        if path == '/stream':
+            self.send_stream()
+        elif path == '/snapshot':
+            self.send_snapshot()
+        else:
+            self.send_error(404)
+
+    def send_snapshot(self):
+        try:
+            (jpeg, _) = self.server.subscriber.next_frame(0)
+        except Exception as e:
+            self.send_error(502, str(e))
+            return
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/jpeg')
+        self.send_header('Content-Length', str(len(jpeg)))
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.end_headers()
+        self.wfile.write(jpeg)
+
+    def send_stream(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'multipart/x-mixed-replace;boundary=' + BOUNDARY.decode())
+        self.send_header('Cache-Control', 'no-cache, private')
+        self.send_header('Pragma', 'no-cache')
+        self.end_headers()
+        self.connection.settimeout(CLIENT_SEND_TIMEOUT_SECS)
+
+        self.server.client_joined()
+        try:
+            seq = 0
+            while True:
+                # Each viewer waits for the newest frame after the one it last sent.
+                # A viewer that is slower than the camera skips frames rather than queueing them.
+                (jpeg, new_seq) = self.server.subscriber.next_frame(seq)
+                if seq and new_seq > seq + 1:
+                    metrics.counter('webcam.relay_frames_skipped').inc(new_seq - seq - 1)
+                seq = new_seq
+
+                self.wfile.write(b'--' + BOUNDARY + b'\r\nContent-Type: image/jpeg\r\nContent-Length: ' + str(len(jpeg)).encode() + b'\r\n\r\n')
+                self.wfile.write(jpeg)
+                self.wfile.write(b'\r\n')
+                metrics.counter('webcam.relay_bytes').inc(len(jpeg))
+        except (ConnectionError, socket.timeout) as e:
+            _logger.debug('MJPEG relay client {} disconnected - {}'.format(self.client_address, e))
+        except Exception as e:
+            _logger.warning('MJPEG relay stream to {} ended - {}'.format(self.client_address, e))
+        finally:
+            self.server.client_left()
+
+    def log_message(self, format, *args):
+        _logger.debug('MJPEG relay: ' + format % args)
+
+
+class MjpegRelay(ThreadingHTTPServer):
+    """
+        Re-broadcasts the webcam's mjpeg stream on 127.0.0.1 from a single upstream connection,
+        so that ffmpeg and snapshots, including tunneled ones, don't each open their own connection to the camera.
+        /stream serves the mjpeg stream. /snapshot serves the newest frame.
+    """
+
+    def __init__(self, webcam_config):
+        super().__init__(('127.0.0.1', webcam_config.mjpeg_relay_port), MjpegRelayHandler)
+        self.webcam_config = webcam_config
+        self.subscriber = mjpeg_subscriber_for(webcam_config.stream_url)
+        self._mutex = threading.Lock()
+        self.num_clients = 0
+
+    def start(self):
+        _logger.info('Relaying {} at {}'.format(self.webcam_config.stream_url, relay_stream_url(self.webcam_config)))
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def client_joined(self):
+        with self._mutex:
+            self.num_clients += 1
+            metrics.gauge('webcam.relay_clients').set(self.num_clients)
+
+    def client_left(self):
+        with self._mutex:
+            self.num_clients -= 1
+            metrics.gauge('webcam.relay_clients').set(self.num_clients)
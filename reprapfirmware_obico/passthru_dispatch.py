@@ -0,0 +1,174 @@
+import collections
+import concurrent.futures
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from . import metrics
+
+_logger = logging.getLogger('obico.passthru_dispatch')
+
+PASSTHRU_MAX_WORKERS = 4
+DEFAULT_TARGET_CONCURRENCY = 1
+# Calls beyond a target's limit wait in its queue. Targets that talk to the printer get 1, since the printer handles one request at a time anyway.
+TARGET_CONCURRENCY = {
+    'moonraker_api': 2,
+}
+MAX_PENDING_PER_TARGET = 32
+
+DEFAULT_PASSTHRU_TIMEOUT_SECS = 30
+# (target, func) -> seconds, for calls that are expected to take longer than the default
+PASSTHRU_TIMEOUTS = {
+    ('file_downloader', 'download'): 60,
+}
+
+TIMEOUT_ERROR = 'Timed out after {}s waiting for the printer to respond'
+BUSY_ERROR = 'Too many pending requests. Please try again later.'
+
+
+class PassthruCall:
+
+    def __init__(self, target, func_name, func, args, kwargs, on_done, deadline):
+        self.target = target
+        self.func_name = func_name
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.on_done = on_done
+        self.deadline = deadline
+        self.queued_at = time.monotonic()
+        self.future = None
+        self._mutex = threading.Lock()
+        self.done = False
+
+    # Return: True if this was the first outcome, which is the one reported through on_done.
+    def finish(self, ret_value, error):
+        with self._mutex:
+            if self.done:
+                return False
+            self.done = True
+        try:
+            self.on_done(ret_value, error)
+        except Exception:
+            _logger.exception('Failed to send passthru response')
+        return True
+
+
+class PassthruDispatcher:
+    """
+        Runs passthru calls on a bounded thread pool, so that a slow printer doesn't hold up the thread that
+        receives server messages. Each target runs at most TARGET_CONCURRENCY calls at a time and queues the rest.
+        A call that misses its deadline gets a timeout error in its ack right away. If it hasn't started yet it is
+        cancelled; if it has, it keeps its slot until it returns, and its late result is dropped.
+    """
+
+    def __init__(self, sentry, max_workers=PASSTHRU_MAX_WORKERS):
+        self.sentry = sentry
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='passthru')
+        self._cond = threading.Condition()
+        self._running = collections.Counter()
+        self._pending = collections.defaultdict(collections.deque)
+        self._deadlines = []  # heap of (deadline, seq, call)
+        self._seq = itertools.count()
+        self.shutting_down = False
+
+        thread = threading.Thread(target=self._deadline_loop)
+        thread.daemon = True
+        thread.start()
+
+    # on_done(ret_value, error) is called exactly once, from a pool thread or from the deadline thread.
+    def submit(self, target, func_name, func, args, kwargs, on_done, timeout=None):
+        if timeout is None:
+            timeout = PASSTHRU_TIMEOUTS.get((target, func_name), DEFAULT_PASSTHRU_TIMEOUT_SECS)
+        call = PassthruCall(target, func_name, func, args, kwargs, on_done, time.monotonic() + timeout)
+
+        with self._cond:
+            if self.shutting_down or len(self._pending[target]) >= MAX_PENDING_PER_TARGET:
+                metrics.counter('passthru.rejected').inc()
+                reject = True
+            else:
+                reject = False
+                self._pending[target].append(call)
+                heapq.heappush(self._deadlines, (call.deadline, next(self._seq), call))
+                self._schedule(target)
+                self._cond.notify()
+
+        if reject:
+            call.finish(None, BUSY_ERROR)
+
+    def shutdown(self):
+        with self._cond:
+            self.shutting_down = True
+            pending = [call for calls in self._pending.values() for call in calls]
+            self._pending.clear()
+            self._cond.notify()
+        for call in pending:
+            call.finish(None, 'Agent is shutting down')
+        self.executor.shutdown(wait=False)
+
+    def _limit(self, target):
+        return TARGET_CONCURRENCY.get(target, DEFAULT_TARGET_CONCURRENCY)
+
+    # Must be called with self._cond held
+    def _schedule(self, target):
+        pending = self._pending[target]
+        while pending and self._running[target] < self._limit(target) and not self.shutting_down:
+            call = pending.popleft()
+            if call.done:
+                continue
+            self._running[target] += 1
+            call.future = self.executor.submit(self._run, call)
+        metrics.gauge('passthru.pending').set(sum(len(calls) for calls in self._pending.values()))
+
+    def _run(self, call):
+        started_at = time.monotonic()
+        metrics.latency('passthru.queue_wait').record(started_at - call.queued_at)
+        try:
+            if call.done:  # Timed out while it was being handed to the pool
+                return
+            ret_value, error = None, None
+            try:
+                ret_value, error = call.func(*call.args, **call.kwargs)
+            except Exception as e:
+                error = str(e)
+                self.sentry.captureException()
+            metrics.latency('passthru.{}.{}'.format(call.target, call.func_name)).record(time.monotonic() - started_at)
+
+            if not call.finish(ret_value, error):
+                metrics.counter('passthru.late_results').inc()
+                _logger.debug('Dropped late result of passthru {}.{}'.format(call.target, call.func_name))
+        finally:
+            with self._cond:
+                self._running[call.target] -= 1
+                self._schedule(call.target)
+
+    def _deadline_loop(self):
+        while True:
+            expired = []
+            with self._cond:
+                while not self.shutting_down:
+                    now = time.monotonic()
+                    while self._deadlines and (self._deadlines[0][2].done or self._deadlines[0][0] <= now):
+                        (_, _, call) = heapq.heappop(self._deadlines)
+                        if not call.done:
+                            expired.append(call)
+                    if expired:
+                        break
+                    self._cond.wait(self._deadlines[0][0] - now if self._deadlines else None)
+                if self.shutting_down:
+                    return
+
+                for call in expired:
+                    if call.future is None:
+                        self._pending[call.target].remove(call)
+                    elif call.future.cancel():
+                        self._running[call.target] -= 1
+                        self._schedule(call.target)
+
+            for call in expired:
+                timeout = '{:g}'.format(round(call.deadline - call.queued_at, 1))
+                if call.finish(None, TIMEOUT_ERROR.format(timeout)):
+                    metrics.counter('passthru.timeouts').inc()
+                    _logger.warning('Passthru {}.{} timed out after {}s'.format(call.target, call.func_name, timeout))
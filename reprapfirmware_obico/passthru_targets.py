@@ -12,11 +12,14 @@ from .reprapfirmware_connection_base import RepRapFirmware_Connection_Base
 from datetime import datetime
 
 from .utils import sanitize_filename
+from . import metrics
 from .state_transition import call_func_with_state_transition
+from .gcode_analyzer import GcodeAnalyzer, file_signature, index_cache_for
 
 _logger = logging.getLogger('obico.file_downloader')
 
 MAX_GCODE_DOWNLOAD_SECONDS = 10 * 60
+DOWNLOAD_CHUNK_SIZE = 256 * 1024
 
 
 class FileDownloader:
@@ -35,20 +38,32 @@ class FileDownloader:
                     f'downloading from {g_code_file["url"]}')
 
                 safe_filename = sanitize_filename(g_code_file['safe_filename'])
-                r = requests.get(
+                analyzer = GcodeAnalyzer()  # Indexes layers as the file comes in, so it never has to be read again
+                content = io.BytesIO()
+                with requests.get(
                     g_code_file['url'],
                     allow_redirects=True,
-                    timeout=60 * 30
-                )
-                r.raise_for_status()
+                    timeout=60 * 30,
+                    stream=True,
+                ) as r:
+                    r.raise_for_status()
+                    for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        content.write(chunk)
+                        analyzer.feed(chunk)
                 _logger.info(f'uploading "{safe_filename}" to RRF')
-                resp_data = self.rrfconn.upload_file(safe_filename, r.content)
+                resp_data = self.rrfconn.upload_file(safe_filename, content.getvalue())
                 _logger.debug(f'upload response: {resp_data}')
                 time.sleep(1)
                 filepath_on_rrf = f'/gcodes/{safe_filename}'
                 file_metadata = self.rrfconn.get_file_info(filename=safe_filename)
                 file_metadata['url'] = g_code_file['url']
 
+                signature = file_signature(safe_filename, file_metadata.get('size'), file_metadata.get('lastModified'))
+                if signature:
+                    index = analyzer.finish()
+                    index_cache_for(self.model.config.cache_dir).put(signature, index)
+                    _logger.info(f'indexed {index.num_layers} layers in "{safe_filename}"')
+
                 basename = safe_filename  # filename in the response is actually the relative path
 
                 g_code_data = dict(
@@ -155,6 +170,15 @@ class FileOperations:
             return ret_value, error
 
 
+class Metrics:
+
+    # Passthru: get(prefix=None)
+    # Return: {name: {value} for counters and gauges, {count, mean, min, max, last, histogram} for latencies},
+    # of the metrics whose name starts with prefix. Those of the webcam worker process are prefixed with "webcam_worker.".
+    def get(self, prefix=None):
+        return {name: value for (name, value) in metrics.snapshot().items() if prefix is None or name.startswith(prefix)}, None
+
+
 class RepRapFirmwareApi:
     def __init__(self, model, rrfconn, sentry):
         self.model = model
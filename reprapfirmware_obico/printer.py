@@ -1,6 +1,6 @@
 import math
 import platform
-from typing import Optional, Dict
+from typing import Optional, Dict, NamedTuple
 import threading
 import time
 import pathlib
@@ -8,12 +8,42 @@ import pathlib
 from .config import Config
 from .version import VERSION
 from .utils import sanitize_filename
+from . import metrics
+from .gcode_analyzer import file_signature, index_cache_for
+from .eta import EtaEstimator
 from .reprapfirmware_connection_base import RepRapFirmware_Connection_Base
 import logging
 
 _logger = logging.getLogger('obico.printer')
 
 
+class StatusSnapshot(NamedTuple):
+    """
+        One polled RRF status, with the fields that readers need worked out when it arrives rather than on every read.
+        Immutable, so readers can hold on to it without taking PrinterState's lock.
+    """
+    raw: Dict
+    rrf_status: str
+    state: str
+    current_z: float
+    max_z: float
+    current_layer: Optional[int]
+    total_layers: Optional[int]
+    file_path: Optional[str]
+    file_name: Optional[str]
+    file_display_name: Optional[str]
+    completion: float
+    print_time: float
+    print_time_left: float
+    file_position: int
+    raw_extrusion: float
+    speed_factor: float
+
+    @property
+    def is_printing(self) -> bool:
+        return self.rrf_status == 'processing'
+
+
 class PrinterState:
     STATE_OFFLINE = 'Offline'
     STATE_OPERATIONAL = 'Operational'
@@ -36,7 +66,6 @@ class PrinterState:
     def __init__(self, app_config: Config):
         self._mutex = threading.RLock()
         self.app_config = app_config
-        self.status = {}
         self.current_print_ts = None
         self.obico_g_code_file_id = None
         self.transient_state = None
@@ -44,24 +73,51 @@ class PrinterState:
         self.installed_plugins = []
         self.current_file_metadata = None
         self.rrfconn: Optional[RepRapFirmware_Connection_Base] = None
+        self._status_listeners = []
+        self._status_changed = threading.Condition(self._mutex)
+        self._to_status_memo = None  # (key, status)
+        self.eta_estimator = EtaEstimator()  # Only updated by make_snapshot()
+        self.snapshot = self.make_snapshot({})
 
     def set_connection(self, rrfconn : RepRapFirmware_Connection_Base):
         self.rrfconn = rrfconn
 
+    # The raw RRF status of the latest snapshot
+    @property
+    def status(self) -> Dict:
+        return self.snapshot.raw
+
     def has_active_job(self) -> bool:
-        return PrinterState.get_state_from_status(self.status) in PrinterState.ACTIVE_STATES
+        return self.snapshot.state in PrinterState.ACTIVE_STATES
 
     def is_printing(self) -> bool:
-        with self._mutex:
-            return self.status.get('state',{}).get('status','unknown') == 'processing'
+        return self.snapshot.is_printing
+
+    # listener(old_status, new_status) is called after every status update, outside of the lock.
+    def add_status_listener(self, listener):
+        self._status_listeners.append(listener)
 
     # Return: The old status.
     def update_status(self, new_status: Dict) -> Dict:
+        snapshot = self.make_snapshot(new_status)
         with self._mutex:
             old_status = self.status
-            self.status = new_status
+            self.snapshot = snapshot
+            self._status_changed.notify_all()
+
+        for listener in self._status_listeners:
+            try:
+                listener(old_status, new_status)
+            except Exception:
+                _logger.exception('Error in status listener')
         return old_status
 
+    # Blocks until predicate(status) is true, checking on every status update rather than polling.
+    # Return: The result of the last predicate call, i.e. False if timed out.
+    def wait_for_status(self, predicate, timeout=None) -> bool:
+        with self._status_changed:
+            return self._status_changed.wait_for(lambda: predicate(self.status), timeout)
+
     # Return: The old current_print_ts.
     def set_current_print_ts(self, new_current_print_ts):
         with self._mutex:
@@ -84,6 +140,52 @@ class PrinterState:
         with self._mutex:
             return self.obico_g_code_file_id
 
+    def make_snapshot(self, status: Dict) -> StatusSnapshot:
+        job = status.get('job') or {}
+        file = job.get('file') or {}
+
+        z_axis = next((axis for axis in (status.get('move') or {}).get('axes', []) if axis.get('letter') == 'Z'), None)
+        filepath = file.get('fileName', '') if job else None
+        filename = pathlib.Path(filepath).name if filepath else None
+        index = self.get_gcode_index(file)
+        completion, print_time, print_time_left = self.get_time_info(job, index)
+
+        current_layer = job.get('layer', None)
+        total_layers = file.get('numLayers', None)
+        max_z = file.get('height', 0)
+        if index is not None and not total_layers:  # RRF couldn't tell from the file. The index built when it was downloaded can.
+            total_layers = index.num_layers
+            current_layer = index.layer_at(job.get('filePosition') or 0)
+            max_z = max_z or index.max_z
+
+        if filepath:
+            estimate = self.eta_estimator.update(
+                (filepath, file.get('size')), completion, job.get('duration'),
+                layers=job.get('layers'), total_layers=total_layers,
+                slicer_time=(self.current_file_metadata or {}).get('printTime') or file.get('printTime'),
+                rrf_time_left=(job.get('timesLeft') or {}).get('file'))
+            if estimate is not None:
+                print_time_left = estimate  # RRF's own estimate swings wildly early in a print, and is handed over to later
+
+        return StatusSnapshot(
+            raw=status,
+            rrf_status=status.get('state', {}).get('status', 'unknown'),
+            state=self.get_state_from_status(status),
+            current_z=float(z_axis.get('userPosition', 0)) if z_axis is not None else 0,
+            max_z=max_z,
+            current_layer=current_layer,
+            total_layers=total_layers,
+            file_path=filepath,
+            file_name=filename,
+            file_display_name=sanitize_filename(filename) if filename else None,
+            completion=completion,
+            print_time=print_time,
+            print_time_left=print_time_left,
+            file_position=job.get('filePosition', 0),
+            raw_extrusion=job.get('rawExtrusion', 0),
+            speed_factor=(status.get('move') or {}).get('speedFactor', 0),
+        )
+
     @classmethod
     def get_state_from_status(cls, data: Dict) -> str:
         return {
@@ -103,12 +205,13 @@ class PrinterState:
     def to_dict(
         self, print_event: Optional[str] = None, with_config: Optional[bool] = False
     ) -> Dict:
-        with self._mutex:
-            data = {
-                'current_print_ts': self.current_print_ts,
-                'status': self.to_status(),
-            } if self.current_print_ts is not None else {}  # Print status is un-deterministic when current_print_ts is None
+        current_print_ts = self.current_print_ts
+        data = {
+            'current_print_ts': current_print_ts,
+            'status': self.to_status(),
+        } if current_print_ts is not None else {}  # Print status is un-deterministic when current_print_ts is None
 
+        with self._mutex:
             if print_event:
                 data['event'] = {'event_type': print_event}
 
@@ -140,113 +243,121 @@ class PrinterState:
             return data
 
 # TODO Fix this to look at RRF properties
+    # The result is reused, with a fresh _ts, until the snapshot, the transient state, the g-code file id or the temperatures change.
+    # It is shared between callers, so it must not be modified.
     def to_status(self) -> Dict:
+        snapshot = self.snapshot
         with self._mutex:
-            state = self.get_state_from_status(self.status)
-
-            if self.transient_state is not None:
-                state = self.transient_state
-
-            has_error = ''  # self.status.get('print_stats', {}).get('state', '') == 'error'
-
-            temps = {}
-
-            rrf_state = self.status.get('state',{})
-            rrf_job = self.status.get('job', {})
-            rrf_move = self.status.get('move', {})
-
-            if self.rrfconn is not None:
-                for heater in self.rrfconn.get_current_heater_state():
-                    temps[heater.name] = {
-                        'actual': heater.actual,
-                        'offset': 0,
-                        'target': heater.target
-                    }
-
-            filepath = rrf_job.get('file', {}).get('fileName', '') if rrf_job else None
-            filename = pathlib.Path(filepath).name if filepath else None
-            file_display_name = sanitize_filename(filename) if filename else None
-
-            if state == PrinterState.STATE_OFFLINE:
-                return {}
-
-            completion, print_time, print_time_left = self.get_time_info(rrf_job)
-            current_z, max_z, total_layers, current_layer = self.get_z_info()
-            return {
-                '_ts': time.time(),
-                'state': {
-                    'text': state,
-                    'flags': {
-                        'operational': state not in [PrinterState.STATE_OFFLINE, PrinterState.STATE_GCODE_DOWNLOADING],
-                        'paused': state == PrinterState.STATE_PAUSED,
-                        'printing': state == PrinterState.STATE_PRINTING,
-                        'cancelling': state == PrinterState.STATE_CANCELLING,
-                        'pausing': state == PrinterState.STATE_PAUSING,
-                        'error': has_error,
-                        'ready': state == PrinterState.STATE_OPERATIONAL,
-                        'closedOrError': False,
-                        # OctoPrint uses this flag to indicate the printer is connectable. It should always be false until we support connecting moonraker to printer
-                    },
-                    'error': ''  # print_stats.get('message') if has_error else None
+            transient_state = self.transient_state
+            obico_g_code_file_id = self.obico_g_code_file_id
+
+        state = snapshot.state
+        if transient_state is not None:
+            state = transient_state
+
+        if state == PrinterState.STATE_OFFLINE:
+            return {}
+
+        has_error = ''  # self.status.get('print_stats', {}).get('state', '') == 'error'
+
+        temps = {}
+        if self.rrfconn is not None:
+            for heater in self.rrfconn.get_current_heater_state():
+                temps[heater.name] = {
+                    'actual': heater.actual,
+                    'offset': 0,
+                    'target': heater.target
+                }
+
+        key = (snapshot, transient_state, obico_g_code_file_id, temps)
+        memo = self._to_status_memo
+        if memo is not None and memo[0][0] is snapshot and memo[0][1:] == key[1:]:
+            metrics.counter('printer_state.to_status_cache_hits').inc()
+            return dict(memo[1], _ts=time.time())
+
+        current_z, max_z, total_layers, current_layer = self.get_z_info(snapshot, transient_state)
+        status = {
+            '_ts': time.time(),
+            'state': {
+                'text': state,
+                'flags': {
+                    'operational': state not in [PrinterState.STATE_OFFLINE, PrinterState.STATE_GCODE_DOWNLOADING],
+                    'paused': state == PrinterState.STATE_PAUSED,
+                    'printing': state == PrinterState.STATE_PRINTING,
+                    'cancelling': state == PrinterState.STATE_CANCELLING,
+                    'pausing': state == PrinterState.STATE_PAUSING,
+                    'error': has_error,
+                    'ready': state == PrinterState.STATE_OPERATIONAL,
+                    'closedOrError': False,
+                    # OctoPrint uses this flag to indicate the printer is connectable. It should always be false until we support connecting moonraker to printer
                 },
-                'currentZ': current_z,
-                'job': {
-                    'file': {
-                        'name': filename,
-                        'path': filepath,
-                        'display': file_display_name,
-                        'obico_g_code_file_id': self.get_obico_g_code_file_id(),
-                    },
-                    'estimatedPrintTime': None,
-                    'user': None,
+                'error': ''  # print_stats.get('message') if has_error else None
+            },
+            'currentZ': current_z,
+            'job': {
+                'file': {
+                    'name': snapshot.file_name,
+                    'path': snapshot.file_path,
+                    'display': snapshot.file_display_name,
+                    'obico_g_code_file_id': obico_g_code_file_id,
                 },
-                'progress': {
-                    'completion': completion * 100,
-                    'filepos': rrf_job.get('filePosition', 0),
-                    'printTime': print_time,
-                    'printTimeLeft': print_time_left,
-                    'filamentUsed': rrf_job.get('rawExtrusion', 0)
-                },
-                'temperatures': temps,
-                'file_metadata': {
-                    'analysis': {
-                        'printingArea': {
-                            'maxZ': max_z
-                        }
-                    },
-                    'obico': {
-                        'totalLayerCount': total_layers
+                'estimatedPrintTime': None,
+                'user': None,
+            },
+            'progress': {
+                'completion': snapshot.completion * 100,
+                'filepos': snapshot.file_position,
+                'printTime': snapshot.print_time,
+                'printTimeLeft': snapshot.print_time_left,
+                'filamentUsed': snapshot.raw_extrusion
+            },
+            'temperatures': temps,
+            'file_metadata': {
+                'analysis': {
+                    'printingArea': {
+                        'maxZ': max_z
                     }
                 },
-                'currentLayerHeight': current_layer,
-                'currentFeedRate': self.status.get('move',{}).get('speedFactor', 0),  # gcode_move.get('speed_factor'),
-                'currentFlowRate': 0,  # gcode_move.get('extrude_factor'),
-                'currentFanSpeed': 0  # fan.get('speed'),
-            }
-
-    def get_z_info(self):
-        is_not_printing = self.is_printing() is False or self.transient_state is not None
-        move = self.status.get('move')
-        job =self.status.get('job', {})
-        file = job.get('file', {})
-
-        z_axis = next((z for z in move['axes'] if z['letter'] == 'Z'), None)
-        current_z = float(z_axis.get('userPosition', 0)) if z_axis is not None else 0
-        max_z = file.get('height',0)
-
-        current_layer = job.get('layer', None)
-        total_layers = file.get('numLayers', None)
-
-        if is_not_printing:
-            current_layer = None
-            total_layers = None
-
-        return current_z, max_z, total_layers, current_layer
-
-    def get_time_info(self, job):
+                'obico': {
+                    'totalLayerCount': total_layers
+                }
+            },
+            'currentLayerHeight': current_layer,
+            'currentFeedRate': snapshot.speed_factor,  # gcode_move.get('speed_factor'),
+            'currentFlowRate': 0,  # gcode_move.get('extrude_factor'),
+            'currentFanSpeed': 0  # fan.get('speed'),
+        }
+
+        self._to_status_memo = (key, status)
+        return status
+
+    def get_z_info(self, snapshot=None, transient_state=None):
+        if snapshot is None:
+            snapshot = self.snapshot
+            transient_state = self.transient_state
+
+        if not snapshot.is_printing or transient_state is not None:
+            return snapshot.current_z, snapshot.max_z, None, None
+        return snapshot.current_z, snapshot.max_z, snapshot.total_layers, snapshot.current_layer
+
+    # Return: The index of the file being printed, built by the g-code analyzer when the file was downloaded, or None
+    def get_gcode_index(self, file: Dict):
+        if not file or self.app_config is None:
+            return None
+        signature = file_signature(file.get('fileName'), file.get('size'), file.get('lastModified'))
+        if signature is None:
+            return None
+        return index_cache_for(self.app_config.cache_dir).get(signature)
+
+    def get_time_info(self, job, index=None):
         try:
             completed = job.get('filePosition', 1) / job.get('file', {}).get('size', 1)
         except:
             completed = 0
+        if index is not None and job.get('filePosition') is not None:
+            # Filament extruded tracks progress more closely than bytes, which travel moves and comments skew
+            by_extrusion = index.completion_at(job['filePosition'])
+            if by_extrusion is not None:
+                completed = by_extrusion
         return completed, job.get('duration', 0), job.get('timesLeft', {}).get('file', 0)
         # return (completion, print_time, print_time_left)
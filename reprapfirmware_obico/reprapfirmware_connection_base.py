@@ -18,8 +18,12 @@ class HeaterModel:
     tool_idx: int  # tool number or bed number - necessary to set the temp on the correct target
     actual: Number
     target: Number
+    state: Optional[str] = None  # off, standby, active, fault, tuning or offline. target is the active temperature whatever the state.
+    read_ts: Optional[float] = None  # time.time() when actual, target and state were read
 
 class RepRapFirmware_Connection_Base(ABC):
+    max_telemetry_rate_hz: Optional[float] = None  # Caps the live telemetry rate, when each read costs the connection others
+
     @abstractmethod
     def __init__(self):
         pass
@@ -92,6 +96,11 @@ class RepRapFirmware_Connection_Base(ABC):
     def get_current_heater_state(self) -> List[HeaterModel]:
         pass
 
+    # Only the move model, without posting a status update, e.g. for live telemetry
+    @abstractmethod
+    def get_current_move_state(self) -> Dict:
+        pass
+
     @abstractmethod
     def execute_gcode(self, command: str):
         pass
@@ -76,11 +76,14 @@ class RepRapFirmware_Connection_HTTP(RepRapFirmware_Connection_Base):
 
     def update_heaters(self):
         resp = self.api_get("rr_model?key=heat").get('result', {}).get('heaters', [])
+        read_ts = time.time()
         for heat in self.heaters:
             try:
                 heater = resp[heat.heater_idx]
                 heat.target = heater['active']
                 heat.actual = heater['current']
+                heat.state = heater.get('state')
+                heat.read_ts = read_ts
             except:
                 _logger.error("Unable to find heater")
 
@@ -188,6 +191,9 @@ class RepRapFirmware_Connection_HTTP(RepRapFirmware_Connection_Base):
         self.update_heaters()
         return self.heaters
 
+    def get_current_move_state(self):
+        return self.api_get('rr_model?key=move').get('result', {})
+
     def execute_gcode(self, command: str):
         data = self.api_get(f'rr_gcode?gcode={command}')
         return data
@@ -14,6 +14,9 @@ from .utils import fix_rrf_filename
 _logger = logging.getLogger('obico.rrf_serial')
 
 class RepRapFirmware_Connection_Serial(RepRapFirmware_Connection_Base):
+    # Every M409 holds the serial line, and the status poll is skipped while it's held
+    max_telemetry_rate_hz = 1.0
+
     def __init__(self, app_config, on_event):
         self.id: str = 'rrfconn'
         self.app_config: Config = app_config
@@ -24,6 +27,7 @@ class RepRapFirmware_Connection_Serial(RepRapFirmware_Connection_Base):
         self.on_event = on_event
         self.serial_connection : Optional[Serial] = None
         self.reloadSettings = True
+        self.last_move = {}
         self.heater_strings = [b'T0:', b'B:', b'File opened']
         return
 
@@ -86,11 +90,14 @@ class RepRapFirmware_Connection_Serial(RepRapFirmware_Connection_Base):
 
     def update_heaters(self):
         resp = self.api_get('M409 K"heat"').get('result',{}).get('heaters', [])
+        read_ts = time.time()
         for heat in self.heaters:
             try:
                 heater = resp[heat.heater_idx]
                 heat.target = heater['active']
                 heat.actual = heater['current']
+                heat.state = heater.get('state')
+                heat.read_ts = read_ts
             except:
                 _logger.error("Unable to find heater")
 
@@ -156,6 +163,7 @@ class RepRapFirmware_Connection_Serial(RepRapFirmware_Connection_Base):
         rrf_state = self.api_get('M409 K"state"')['result']
         job_state = self.api_get('M409 K"job"')['result']
         move = self.api_get('M409 K"move"')['result']
+        self.last_move = move
         rrf_state = {**{'state': rrf_state}, **{'job': job_state},
                      **{'move': move}}  # merge the results to get a full status
         self.on_event(Event(name='status_update', sender="rrfconn", data=rrf_state))
@@ -243,6 +251,10 @@ class RepRapFirmware_Connection_Serial(RepRapFirmware_Connection_Base):
         self.update_heaters()
         return self.heaters
 
+    # The move model read by the last status poll, so live telemetry doesn't cost another round-trip
+    def get_current_move_state(self):
+        return self.last_move
+
     def request_set_temperature(self):
         return
 
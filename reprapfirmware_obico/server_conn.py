@@ -9,11 +9,12 @@ import json
 from collections import deque
 
 from .utils import ExpoBackoff
-from .ws import WebSocketClient, WebSocketConnectionException
+from .ws import new_websocket_client, WebSocketConnectionException
 from .config import Config
 from .printer import PrinterState
 from .webcam_capture import capture_jpeg
 from .lib import curlify
+from . import metrics
 
 
 _logger = logging.getLogger('obico.server_conn')
@@ -61,21 +62,25 @@ class ServerConn:
 
         while self.should_reconnect:
             try:
-                (data, as_binary) = self.message_queue_to_server.get()
+                (data, as_binary, serialized, enqueued_at) = self.message_queue_to_server.get()
+                metrics.latency('server_conn.queue_wait').record(time.monotonic() - enqueued_at)
 
                 if not self.ss or not self.ss.connected():
                     header = ["authorization: bearer " + self.config.server.auth_token]
-                    self.ss = WebSocketClient(
+                    self.ss = new_websocket_client(
                         self.config.server.ws_url(),
                         header=header,
                         on_ws_msg=on_message,
                         on_ws_open=on_server_ws_open,
                         on_ws_close=on_server_ws_close,)
 
-                if as_binary:
+                if serialized:
+                    raw = data
+                elif as_binary:
                     raw = bson.dumps(data)
                 else:
-                    _logger.debug("Sending to server: \n{}".format(data))
+                    if _logger.isEnabledFor(logging.DEBUG):
+                        _logger.debug("Sending to server: \n{}".format(data))
                     raw = json.dumps(data, default=str)
                 self.ss.send(raw, as_binary=as_binary)
                 server_ws_backoff.reset()
@@ -89,7 +94,14 @@ class ServerConn:
 
     def send_ws_msg_to_server(self, data, as_binary=False):
         try:
-            self.message_queue_to_server.put_nowait((data, as_binary))
+            self.message_queue_to_server.put_nowait((data, as_binary, False, time.monotonic()))
+        except queue.Full:
+            _logger.warning("Server message queue is full, msg dropped")
+
+    # For a json text message that is already serialized, so that it's sent as is.
+    def send_serialized_ws_msg_to_server(self, raw):
+        try:
+            self.message_queue_to_server.put_nowait((raw, False, True, time.monotonic()))
         except queue.Full:
             _logger.warning("Server message queue is full, msg dropped")
 
@@ -119,7 +131,7 @@ class ServerConn:
         files = None
         if attach_snapshot:
             try:
-                files = {'snapshot': capture_jpeg(self)}
+                files = {'snapshot': capture_jpeg(self.config.webcam)}
             except Exception as e:
                 _logger.warn('Failed to capture jpeg - ' + str(e))
                 pass
@@ -1,39 +1,77 @@
 import concurrent.futures
+import threading
 import time
 import logging
-import threading
 
+from . import metrics
 from .printer import PrinterState
 
 
 _logger = logging.getLogger('obico.state_transition')
 
+STATE_CHANGE_TIMEOUT_SECS = 30  # How long to wait for the underlying change to show up in the printer status
+
+FUNC_WORKERS = 4
+
+# Shared by all transitions. The func pool is separate so that a transition waiting on its func never takes the func's thread.
+_transition_executor = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix='state_transition')
+_func_executor = concurrent.futures.ThreadPoolExecutor(max_workers=FUNC_WORKERS, thread_name_prefix='state_transition_func')
+
+# A func that timed out can't be stopped, and keeps its thread until it returns, if ever
+_stuck_funcs = 0
+_stuck_funcs_mutex = threading.Lock()
+
+
+def _func_stuck(future):
+    global _stuck_funcs
+    with _stuck_funcs_mutex:
+        _stuck_funcs += 1
+        metrics.gauge('state_transition.stuck_funcs').set(_stuck_funcs)
+    future.add_done_callback(_func_unstuck)
+
+
+def _func_unstuck(future):
+    global _stuck_funcs
+    with _stuck_funcs_mutex:
+        _stuck_funcs -= 1
+        metrics.gauge('state_transition.stuck_funcs').set(_stuck_funcs)
+
+
 def call_func_with_state_transition(server_conn, printer_state, transient_state, func, timeout=5*60):
 
     def call_it():
+        started_at = time.monotonic()
+        state_before_transient = PrinterState.get_state_from_status(printer_state.status)
+        printer_state.set_transient_state(transient_state)
+        _logger.debug(f'Transient state started: {state_before_transient} -> {transient_state}')
+        server_conn.post_status_update_to_server()
+
+        try:
+            if _stuck_funcs >= FUNC_WORKERS:
+                # A func queued now would never start, and only time out after `timeout`
+                metrics.counter('state_transition.saturated').inc()
+                _logger.error(f'All {FUNC_WORKERS} threads are taken by stuck funcs. Giving up - printer_state: {printer_state} - func {func}')
+                return
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            state_before_transient = PrinterState.get_state_from_status(printer_state.status)
-            printer_state.set_transient_state(transient_state)
-            _logger.debug(f'Transient state started: {state_before_transient} -> {transient_state}')
+            future = _func_executor.submit(func)
+            future.result(timeout)
+            # Wait for the underlining change to happen to avoid race condition. Woken up by the first status update that has it.
+            if printer_state.wait_for_status(
+                    lambda status: PrinterState.get_state_from_status(status) != state_before_transient,
+                    STATE_CHANGE_TIMEOUT_SECS):
+                metrics.latency('state_transition.completion').record(time.monotonic() - started_at)
+            else:
+                metrics.counter('state_transition.unchanged').inc()
+        except concurrent.futures.TimeoutError:
+            metrics.counter('state_transition.timeouts').inc()
+            _logger.warning(f'Timed out - printer_state: {printer_state} - func {func}')
+            if not future.cancel():  # Still queued, it is simply dropped
+                _func_stuck(future)
+        except Exception as e:
+            _logger.warning(f'Failed - printer_state: {printer_state} - func {func} - {e}')
+        finally:
+            _logger.debug(f'Transient state ended')
+            printer_state.set_transient_state(None)
             server_conn.post_status_update_to_server()
 
-            future = executor.submit(func)
-            try:
-                result = future.result(timeout)
-                for i in range(30):  # Wait for up to 30s for the underlining change to happen to avoid race condition.
-                    if state_before_transient != PrinterState.get_state_from_status(printer_state.status):
-                        return
-                    time.sleep(1)
-            except concurrent.futures.TimeoutError:
-                _logger.warning(f'Timed out - printer_state: {printer_state} - func {func}')
-            finally:
-                _logger.debug(f'Transient state ended')
-                printer_state.set_transient_state(None)
-                server_conn.post_status_update_to_server()
-
-    thread = threading.Thread(
-        target=call_it
-    )
-    thread.daemon = True
-    thread.start()
+    _transition_executor.submit(call_it)
@@ -0,0 +1,142 @@
+import logging
+import math
+import struct
+import time
+
+from . import metrics
+from .printer import PrinterState
+
+_logger = logging.getLogger('obico.telemetry')
+
+# All frames start with HEADER: magic, version, frame type, sequence number (wraps at 65536), time.time()
+MAGIC = b'OBTM'
+VERSION = 1
+HEADER = struct.Struct('<4sBBHd')
+
+# FRAME_TELEMETRY: state, x, y, z, current layer (NO_LAYER if unknown), completion 0-1 (NaN if unknown), number of heaters.
+# Followed by (actual, target) for each heater, in the order of the latest FRAME_HEATER_NAMES.
+FRAME_TELEMETRY = 1
+TELEMETRY = struct.Struct('<BfffHfB')
+HEATER = struct.Struct('<ff')
+NO_LAYER = 0xFFFF
+
+# FRAME_HEATER_NAMES: utf-8 heater names, separated by '\n'
+FRAME_HEATER_NAMES = 2
+
+STATES = [
+    PrinterState.STATE_OFFLINE,
+    PrinterState.STATE_OPERATIONAL,
+    PrinterState.STATE_PRINTING,
+    PrinterState.STATE_PAUSING,
+    PrinterState.STATE_PAUSED,
+    PrinterState.STATE_RESUMING,
+    PrinterState.STATE_CANCELLING,
+]
+
+KEEPALIVE_SECS = 1.0  # Unchanged telemetry is re-sent this often, so the browser can tell the feed is alive
+HEATER_NAMES_INTERVAL_SECS = 5.0
+NOT_VIEWING_CHECK_SECS = 1.0
+
+
+def axis_position(status, letter):
+    for axis in status.get('move', {}).get('axes', []):
+        if axis.get('letter') == letter:
+            return float(axis.get('userPosition') or 0)
+    return 0.0
+
+
+class TelemetryPublisher:
+    """
+        While someone is viewing, pushes compact binary frames of temperatures and positions to the Janus printer data port,
+        which relays them to the browser over the WebRTC data channel. Heaters and positions are read on this thread's
+        own timer, so the status poll, and the status posts to the server that follow it, keep their usual rate.
+        The state, layer and completion come from the last polled status.
+    """
+
+    def __init__(self, app_model, rrfconn, janus):
+        self.app_model = app_model
+        self.config = app_model.config.telemetry
+        self.rrfconn = rrfconn
+        self.janus = janus
+        self.seq = 0
+        self.last_body = None
+        self.last_sent_ts = 0
+        self.last_heater_names = None
+        self.last_heater_names_ts = 0
+
+    def rate_hz(self):
+        max_rate_hz = self.rrfconn.max_telemetry_rate_hz
+        return min(self.config.rate_hz, max_rate_hz) if max_rate_hz else self.config.rate_hz
+
+    def run(self):
+        publishing = False
+        while True:
+            viewing = bool(self.app_model.remote_status.get('viewing'))
+            if viewing != publishing:
+                publishing = viewing
+                if publishing:
+                    _logger.debug('Viewing started. Publishing telemetry at {}Hz.'.format(self.rate_hz()))
+                    self.last_body = None
+                    self.last_heater_names = None
+                else:
+                    _logger.debug('Viewing stopped. Not publishing telemetry.')
+
+            if not publishing:
+                time.sleep(NOT_VIEWING_CHECK_SECS)
+                continue
+
+            started = time.monotonic()
+            try:
+                self.publish()
+            except Exception:
+                _logger.exception('Failed to publish telemetry')
+            time.sleep(max(1.0 / self.rate_hz() - (time.monotonic() - started), 0))
+
+    def publish(self):
+        heaters = list(self.rrfconn.get_current_heater_state())
+        status = self.app_model.printer_state.status
+        move = self.rrfconn.get_current_move_state()
+        if isinstance(move, dict) and move:
+            status = dict(status, move=move)
+        now = time.time()
+
+        names = '\n'.join(h.name for h in heaters)
+        if names != self.last_heater_names or now - self.last_heater_names_ts >= HEATER_NAMES_INTERVAL_SECS:
+            self.send(FRAME_HEATER_NAMES, names.encode('utf-8'), now)
+            self.last_heater_names = names
+            self.last_heater_names_ts = now
+
+        body = self.telemetry_body(status, heaters)
+        if body == self.last_body and now - self.last_sent_ts < KEEPALIVE_SECS:
+            metrics.counter('telemetry.unchanged_skips').inc()
+            return
+        self.send(FRAME_TELEMETRY, body, now)
+        self.last_body = body
+        self.last_sent_ts = now
+
+    def telemetry_body(self, status, heaters):
+        state = PrinterState.get_state_from_status(status)
+        job = status.get('job', {})
+        layer = job.get('layer')
+        try:
+            completion = job.get('filePosition', 0) / job['file']['size']
+        except (KeyError, TypeError, ZeroDivisionError):
+            completion = math.nan
+
+        body = TELEMETRY.pack(
+            STATES.index(state) if state in STATES else 0,
+            axis_position(status, 'X'),
+            axis_position(status, 'Y'),
+            axis_position(status, 'Z'),
+            layer if isinstance(layer, int) and 0 <= layer < NO_LAYER else NO_LAYER,
+            completion,
+            len(heaters),
+        )
+        return body + b''.join(HEATER.pack(h.actual or 0, h.target or 0) for h in heaters)
+
+    def send(self, frame_type, body, ts):
+        frame = HEADER.pack(MAGIC, VERSION, frame_type, self.seq, ts) + body
+        self.seq = (self.seq + 1) % 65536
+        if self.janus.janus_ws and self.janus.janus_ws.connected() and self.janus.send_printer_data(frame):
+            metrics.counter('telemetry.frames').inc()
+            metrics.counter('telemetry.bytes').inc(len(frame))
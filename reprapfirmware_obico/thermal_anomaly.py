@@ -0,0 +1,213 @@
+import logging
+import math
+import threading
+from typing import NamedTuple
+
+from . import metrics
+
+_logger = logging.getLogger('obico.thermal_anomaly')
+
+ANOMALY_NOT_HEATING = 'not_heating'
+ANOMALY_RUNAWAY = 'runaway'
+ANOMALY_UNCONTROLLED_HEATING = 'uncontrolled_heating'
+ANOMALY_UNSTABLE = 'unstable'
+ANOMALY_SENSOR = 'sensor'
+
+EWMA_TAU_SECS = 10.0  # Time constant of the rolling error and ramp rate statistics
+MAX_GAP_SECS = 30.0  # Readings further apart than this (agent or printer reconnected) restart the statistics
+TARGET_CHANGE_DEGREES = 0.5
+AMBIENT_MAX_DEGREES = 50.0  # Below this a heater that is off is not considered to be heating
+MIN_VALID_DEGREES = -20.0  # RRF reports -273.1 for an open-circuit sensor
+MAX_VALID_DEGREES = 500.0
+
+
+class HeaterLimits(NamedTuple):
+    band: float  # |actual - target| within which the heater is considered to be at temperature
+    watch_secs: float  # While heating up, the temperature must rise by watch_increase every watch_secs
+    watch_increase: float
+    runaway_drop: float  # Once at temperature, a mean error below -runaway_drop for runaway_secs is a runaway
+    runaway_secs: float
+    overshoot: float  # A mean error above overshoot, or heating at off_rate while off, for overshoot_secs
+    off_rate: float
+    overshoot_secs: float
+    unstable_std: float  # Once at temperature, an error standard deviation above unstable_std for unstable_secs
+    unstable_secs: float
+    spike: float  # A jump of more than this between two readings is a sensor problem
+
+
+LIMITS = {
+    'tool': HeaterLimits(band=3, watch_secs=30, watch_increase=2, runaway_drop=15, runaway_secs=20,
+                         overshoot=20, off_rate=0.5, overshoot_secs=15, unstable_std=4, unstable_secs=60, spike=30),
+    'bed': HeaterLimits(band=2, watch_secs=90, watch_increase=2, runaway_drop=10, runaway_secs=60,
+                        overshoot=15, off_rate=0.1, overshoot_secs=60, unstable_std=3, unstable_secs=120, spike=20),
+}
+
+
+class HeaterWatch:
+    """
+        Rolling statistics of one heater, updated in O(1) time and memory per reading: time-weighted EWMAs of the
+        actual-vs-target error, its variance, and the ramp rate. Each anomaly is reported once, until the target
+        changes or the condition clears.
+    """
+    __slots__ = ('limits', 'last_ts', 'last_actual', 'last_target', 'err_mean', 'err_var', 'rate',
+                 'settled', 'watch_ts', 'watch_temp', 'since', 'reported')
+
+    def __init__(self, limits):
+        self.limits = limits
+        self.last_ts = None
+        self.since = {}  # kind -> when its condition started to hold
+        self.reported = set()
+
+    def reset(self, actual, target, ts):
+        self.last_ts = ts
+        self.last_actual = actual
+        self.last_target = target
+        self.err_mean = actual - target
+        self.err_var = 0.0
+        self.rate = 0.0
+        self.settled = False
+        self.watch_ts = ts
+        self.watch_temp = actual
+        self.since.clear()
+
+    # target: The temperature the heater is driven to, 0 if it is off.
+    # Return: [(anomaly, message)] newly detected with this reading.
+    def update(self, actual, target, ts):
+        lim = self.limits
+        if not MIN_VALID_DEGREES <= actual <= MAX_VALID_DEGREES:
+            return self._report(ANOMALY_SENSOR, 'Temperature reading of {:.1f}°C is out of range. The thermistor may be disconnected or shorted.'.format(actual))
+
+        if self.last_ts is None or ts - self.last_ts > MAX_GAP_SECS:
+            self.reset(actual, target, ts)
+            return []
+        dt = ts - self.last_ts
+        if dt <= 0:
+            return []
+
+        found = []
+        jump = actual - self.last_actual
+        if abs(jump) > lim.spike:
+            found += self._report(ANOMALY_SENSOR, 'Temperature jumped by {:.1f}°C in {:.1f}s. The thermistor or its wiring may be faulty.'.format(jump, dt))
+            self.reset(actual, target, ts)  # Don't let one bad reading skew the statistics
+            return found
+
+        if abs(target - self.last_target) > TARGET_CHANGE_DEGREES:
+            self.settled = False
+            self.watch_ts = ts
+            self.watch_temp = actual
+            self.since.clear()
+            self.reported.difference_update((ANOMALY_NOT_HEATING, ANOMALY_RUNAWAY, ANOMALY_UNCONTROLLED_HEATING, ANOMALY_UNSTABLE))
+
+        alpha = 1.0 - math.exp(-dt / EWMA_TAU_SECS)
+        error = actual - target
+        delta = error - self.err_mean
+        self.err_mean += alpha * delta
+        self.err_var = (1.0 - alpha) * (self.err_var + alpha * delta * delta)
+        self.rate += alpha * (jump / dt - self.rate)
+        self.last_ts, self.last_actual, self.last_target = ts, actual, target
+
+        if target > 0:
+            if not self.settled and abs(error) <= lim.band:
+                self.settled = True
+
+            if not self.settled and error < -lim.band:
+                if ts - self.watch_ts >= lim.watch_secs:
+                    if actual - self.watch_temp < lim.watch_increase:
+                        found += self._report(ANOMALY_NOT_HEATING, 'Heating to {:.0f}°C, but the temperature rose only {:.1f}°C in the last {:.0f}s. The heater or its wiring may have failed.'.format(
+                            target, actual - self.watch_temp, ts - self.watch_ts))
+                    self.watch_ts = ts
+                    self.watch_temp = actual
+
+            if self._sustained(ANOMALY_RUNAWAY, self.settled and self.err_mean < -lim.runaway_drop, ts, lim.runaway_secs):
+                found += self._report(ANOMALY_RUNAWAY, 'Temperature dropped to {:.1f}°C, {:.0f}°C below the target of {:.0f}°C, while the heater is on. The thermistor may have come loose.'.format(
+                    actual, -self.err_mean, target))
+
+            if self._sustained(ANOMALY_UNSTABLE, self.settled and math.sqrt(self.err_var) > lim.unstable_std, ts, lim.unstable_secs):
+                found += self._report(ANOMALY_UNSTABLE, 'Temperature is swinging ±{:.1f}°C around the target of {:.0f}°C. The heater may need PID tuning, or a fan may be blowing on it.'.format(
+                    math.sqrt(self.err_var), target))
+
+            uncontrolled = self.err_mean > lim.overshoot and self.rate > 0
+        else:
+            self.settled = False
+            uncontrolled = actual > AMBIENT_MAX_DEGREES and self.rate > lim.off_rate
+
+        if self._sustained(ANOMALY_UNCONTROLLED_HEATING, uncontrolled, ts, lim.overshoot_secs):
+            found += self._report(ANOMALY_UNCONTROLLED_HEATING, 'Temperature is {:.1f}°C and still rising at {:.2f}°C/s above the target of {:.0f}°C. The heater may be stuck on.'.format(
+                actual, self.rate, target))
+
+        return found
+
+    def _sustained(self, kind, condition, ts, secs):
+        if not condition:
+            self.since.pop(kind, None)
+            if kind != ANOMALY_NOT_HEATING:
+                self.reported.discard(kind)
+            return False
+        return ts - self.since.setdefault(kind, ts) >= secs
+
+    def _report(self, kind, message):
+        if kind in self.reported:
+            return []
+        self.reported.add(kind)
+        return [(kind, message)]
+
+
+def effective_target(heater):
+    # A heater that is off still reports the temperature it would be set to when active
+    if heater.state in ('off', 'fault', 'offline'):
+        return 0.0
+    if heater.state not in (None, 'active'):  # standby or tuning: the setpoint isn't known here
+        return None
+    return float(heater.target or 0)
+
+
+class ThermalAnomalyDetector:
+    """
+        Watches every heater reading the printer connection collects, and posts a printer event as soon as
+        a heater doesn't heat up, runs away, heats while it should be off, or swings around its target.
+        Catches problems that RRF's own heater fault detection is not configured for, or catches too late.
+    """
+
+    def __init__(self, app_model, rrfconn, server_conn):
+        self.app_model = app_model
+        self.rrfconn = rrfconn
+        self.server_conn = server_conn
+        self.watches = {}
+
+    def start(self):
+        self.app_model.printer_state.add_status_listener(self.on_status_update)
+
+    def on_status_update(self, old_status, new_status):
+        if not new_status or not self.rrfconn:
+            return
+
+        # Heaters are the values last read, for a status post or for telemetry, so this adds no request to the printer.
+        # Each reading is stamped with when it was read, not with now, which can be a poll or more later.
+        for heater in list(self.rrfconn.heaters):
+            target = effective_target(heater)
+            if heater.actual is None or heater.read_ts is None or target is None:
+                continue
+
+            watch = self.watches.get(heater.name)
+            if watch is None:
+                watch = self.watches[heater.name] = HeaterWatch(LIMITS.get(heater.type, LIMITS['tool']))
+            if watch.last_ts is not None and heater.read_ts <= watch.last_ts:
+                continue  # Not read again since the last status update
+
+            for (kind, message) in watch.update(float(heater.actual), target, heater.read_ts):
+                self.post_anomaly(heater.name, kind, message)
+
+    def post_anomaly(self, heater_name, kind, message):
+        _logger.warning('Thermal anomaly on {}: {}'.format(heater_name, message))
+        metrics.counter('thermal_anomaly.{}'.format(kind)).inc()
+
+        thread = threading.Thread(
+            target=self.server_conn.post_printer_event_to_server,
+            args=('reprapfirmware-obico: {} Heater Problem ({})'.format(heater_name, kind.replace('_', ' ')), message),
+            kwargs=dict(
+                event_class='ERROR' if kind in (ANOMALY_RUNAWAY, ANOMALY_UNCONTROLLED_HEATING) else 'WARNING',
+                attach_snapshot=True,
+            ),
+        )
+        thread.daemon = True
+        thread.start()
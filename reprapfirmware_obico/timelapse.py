@@ -0,0 +1,356 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import threading
+import time
+
+import psutil
+import requests
+
+from .printer import PrinterState
+from .utils import ExpoBackoff
+from .webcam_capture import capture_jpeg
+from .webcam_stream import FFMPEG
+
+_logger = logging.getLogger('obico.timelapse')
+
+SEGMENT_FILE = 'frames.seg'
+INDEX_FILE = 'frames.idx'
+STATE_FILE = 'state.json'
+VIDEO_FILE = 'timelapse.mp4'
+FFMPEG_LOG_FILE = 'ffmpeg.log'
+
+INDEX_ENTRY = struct.Struct('<QQd')  # offset in the segment file, jpeg length, time.time() when captured
+
+STATUS_RECORDING = 'recording'
+STATUS_RECORDED = 'recorded'
+STATUS_ASSEMBLED = 'assembled'
+STATUS_UPLOADED = 'uploaded'
+STATUS_FAILED = 'failed'  # Given up on. Not retried, not even after a restart.
+
+MAX_FINISH_ATTEMPTS = 5  # Per print, across restarts
+
+# The server is expected to append each chunk at `offset`, so that an interrupted upload can resume where it stopped
+TIMELAPSE_UPLOAD_URI = '/api/v1/octo/timelapses/'
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+
+class FrameSegment:
+    """
+        An append-only file of jpegs, plus an index of fixed-size (offset, length, captured_at) entries.
+        A frame is written to the segment before its index entry, so the index never points at a partial jpeg,
+        even if the agent dies in the middle of a write.
+    """
+
+    def __init__(self, print_dir):
+        self.seg = open(os.path.join(print_dir, SEGMENT_FILE), 'ab')
+        self.idx = open(os.path.join(print_dir, INDEX_FILE), 'ab')
+
+    def append(self, jpeg, captured_at):
+        offset = self.seg.tell()
+        self.seg.write(jpeg)
+        self.seg.flush()
+        self.idx.write(INDEX_ENTRY.pack(offset, len(jpeg), captured_at))
+        self.idx.flush()
+
+    def close(self):
+        self.seg.close()
+        self.idx.close()
+
+    @staticmethod
+    def read_frames(print_dir):
+        seg_path = os.path.join(print_dir, SEGMENT_FILE)
+        with open(os.path.join(print_dir, INDEX_FILE), 'rb') as idx, open(seg_path, 'rb') as seg:
+            seg_size = os.path.getsize(seg_path)
+            while True:
+                entry = idx.read(INDEX_ENTRY.size)
+                if len(entry) < INDEX_ENTRY.size:
+                    return
+                (offset, length, _) = INDEX_ENTRY.unpack(entry)
+                if offset + length > seg_size:
+                    return
+                seg.seek(offset)
+                yield seg.read(length)
+
+
+class PermanentTimelapseError(Exception):
+    """
+        Retrying can't help, e.g. there are no frames, or the server rejected the upload.
+    """
+    pass
+
+
+def load_state(print_dir):
+    try:
+        with open(os.path.join(print_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_state(print_dir, state):
+    path = os.path.join(print_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.tmp', path)
+
+
+def dir_size(path):
+    total = 0
+    for entry in os.scandir(path):
+        if entry.is_file():
+            total += entry.stat().st_size
+    return total
+
+
+class TimelapseRecorder:
+    """
+        Records a timelapse of each print, one frame every min_interval seconds, read through the frame cache so that
+        a frame captured for a snapshot or a stream is reused rather than captured again.
+        Frames go to cache_dir/timelapse/<start ts>/ while printing. After the print, a worker thread assembles
+        them into a video with ffmpeg at the lowest CPU and IO priority, and uploads the video in resumable chunks.
+        Progress is kept in each print's state.json, so that both steps survive a restart.
+    """
+
+    def __init__(self, app_model, server_conn, sentry):
+        self.app_model = app_model
+        self.config = app_model.config.timelapse
+        self.server_conn = server_conn
+        self.sentry = sentry
+        self.root = os.path.join(app_model.config.cache_dir, 'timelapse')
+
+        self._mutex = threading.Lock()
+        self.print_dir = None
+        self.segment = None
+        self.over_budget = False
+        self.disk_usage = 0
+        self._stale_recordings = []  # Recording when the agent stopped. Resumed if the print is still going.
+        self._processing = None
+        self._finish_queue = queue.Queue()
+
+    def start(self):
+        os.makedirs(self.root, exist_ok=True)
+        for print_dir in self.print_dirs():
+            self.disk_usage += dir_size(print_dir)
+            state = load_state(print_dir) or {}
+            if state.get('status') == STATUS_RECORDING:
+                self._stale_recordings.append(print_dir)
+            elif state.get('status') in (STATUS_RECORDED, STATUS_ASSEMBLED):
+                self._finish_queue.put(print_dir)
+
+        self.app_model.printer_state.add_status_listener(self.on_status_update)
+
+        for target in (self.record_loop, self.finish_loop):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def print_dirs(self):
+        return sorted(
+            (os.path.join(self.root, d) for d in os.listdir(self.root) if d.isdigit()),
+            key=lambda d: int(os.path.basename(d)))
+
+    def on_status_update(self, old_status, new_status):
+        prev_state = PrinterState.get_state_from_status(old_status)
+        cur_state = PrinterState.get_state_from_status(new_status)
+
+        if cur_state == PrinterState.STATE_PRINTING and prev_state not in PrinterState.ACTIVE_STATES:
+            # Offline -> printing is the agent (re)connecting in the middle of a print
+            resume = prev_state == PrinterState.STATE_OFFLINE and self._stale_recordings
+            self.start_recording(self._stale_recordings.pop() if resume else None)
+        elif cur_state == PrinterState.STATE_OPERATIONAL and prev_state != PrinterState.STATE_OPERATIONAL:
+            self.stop_recording()
+            while self._stale_recordings:
+                self.finish(self._stale_recordings.pop())
+
+    def start_recording(self, print_dir=None):
+        with self._mutex:
+            if self.print_dir:
+                return
+            if print_dir is None:
+                print_dir = os.path.join(self.root, str(int(time.time())))
+                os.makedirs(print_dir, exist_ok=True)
+                save_state(print_dir, {'status': STATUS_RECORDING, 'started_at': time.time()})
+            _logger.info('Recording timelapse in {}'.format(print_dir))
+
+            self.print_dir = print_dir
+            self.segment = FrameSegment(print_dir)
+            self.over_budget = False
+
+    def stop_recording(self):
+        with self._mutex:
+            if not self.print_dir:
+                return
+            print_dir = self.print_dir
+            self.segment.close()
+            self.segment = None
+            self.print_dir = None
+        self.finish(print_dir)
+
+    def finish(self, print_dir):
+        state = load_state(print_dir) or {}
+        state['status'] = STATUS_RECORDED
+        print_ts = self.app_model.printer_state.current_print_ts
+        state['print_ts'] = print_ts if print_ts and print_ts > 0 else int(os.path.basename(print_dir))
+        save_state(print_dir, state)
+        self._finish_queue.put(print_dir)
+
+    def record_loop(self):
+        while True:
+            with self._mutex:
+                recording = self.segment is not None and not self.over_budget
+            if recording:
+                try:
+                    # A frame cached within the last half interval is recent enough
+                    self.add_frame(capture_jpeg(self.app_model.config.webcam, max_age=self.config.min_interval / 2))
+                except Exception as e:
+                    _logger.debug('Failed to capture timelapse frame - {}'.format(e))
+            time.sleep(self.config.min_interval)
+
+    def add_frame(self, jpeg):
+        with self._mutex:
+            if not self.segment or self.over_budget:
+                return
+
+            now = time.time()
+            if not self._make_room(len(jpeg)):
+                _logger.warning('Timelapse disk budget of {}MB is used up. Not recording more frames for this print.'.format(self.config.max_disk_mb))
+                self.over_budget = True
+                return
+
+            try:
+                self.segment.append(jpeg, now)
+            except OSError as e:
+                _logger.warning('Failed to write timelapse frame - {}'.format(e))
+                return
+            self.disk_usage += len(jpeg) + INDEX_ENTRY.size
+
+    def _make_room(self, num_bytes):
+        budget = self.config.max_disk_mb * 1024 * 1024
+        for print_dir in self.print_dirs():
+            if self.disk_usage + num_bytes <= budget:
+                break
+            if print_dir in (self.print_dir, self._processing) or print_dir in self._stale_recordings:
+                continue
+            _logger.info('Removing old timelapse {} to stay within the disk budget'.format(print_dir))
+            self.disk_usage -= dir_size(print_dir)
+            shutil.rmtree(print_dir, ignore_errors=True)
+        return self.disk_usage + num_bytes <= budget
+
+    def finish_loop(self):
+        finish_backoff = ExpoBackoff(600)
+        while True:
+            print_dir = self._finish_queue.get()
+            with self._mutex:
+                if not os.path.isdir(print_dir):
+                    continue
+                self._processing = print_dir
+
+            state = load_state(print_dir) or {}
+            try:
+                if state.get('status') == STATUS_RECORDED:
+                    self.assemble(print_dir, state)
+                if state.get('status') == STATUS_ASSEMBLED and self.config.upload:
+                    self.upload(print_dir, state)
+                finish_backoff.reset()
+            except Exception as e:
+                state['attempts'] = state.get('attempts', 0) + 1
+                if isinstance(e, PermanentTimelapseError) or state['attempts'] >= MAX_FINISH_ATTEMPTS:
+                    _logger.error('Giving up on timelapse {} after {} attempts - {}'.format(print_dir, state['attempts'], e))
+                    state['status'] = STATUS_FAILED
+                    state['error'] = str(e)
+                    save_state(print_dir, state)
+                    continue
+
+                self.sentry.captureException()
+                save_state(print_dir, state)
+                self._finish_queue.put(print_dir)
+                finish_backoff.more(e)
+            finally:
+                with self._mutex:
+                    self._processing = None
+
+    def assemble(self, print_dir, state):
+        video_path = os.path.join(print_dir, VIDEO_FILE)
+        tmp_path = video_path + '.part'
+        cmd = [
+            FFMPEG, '-loglevel', 'error', '-y',
+            '-f', 'image2pipe', '-framerate', str(self.config.fps), '-c:v', 'mjpeg', '-i', '-',
+            '-vf', 'scale=trunc(iw/2)*2:trunc(ih/2)*2', '-pix_fmt', 'yuv420p', '-f', 'mp4', tmp_path,
+        ]
+        _logger.debug('Popen: {}'.format(' '.join(cmd)))
+
+        try:
+            recorded = os.path.getsize(os.path.join(print_dir, INDEX_FILE)) // INDEX_ENTRY.size
+            os.path.getsize(os.path.join(print_dir, SEGMENT_FILE))
+        except OSError as e:
+            raise PermanentTimelapseError('Frames of timelapse {} are missing - {}'.format(print_dir, e))
+        if recorded == 0:
+            raise PermanentTimelapseError('Timelapse {} has no frames'.format(print_dir))
+
+        num_frames = 0
+        with open(os.path.join(print_dir, FFMPEG_LOG_FILE), 'wb') as log:
+            proc = psutil.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=log)
+            try:
+                proc.nice(19)
+                proc.ionice(psutil.IOPRIO_CLASS_IDLE)
+            except Exception:
+                pass
+
+            try:
+                for jpeg in FrameSegment.read_frames(print_dir):
+                    proc.stdin.write(jpeg)
+                    num_frames += 1
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass  # ffmpeg quit. Its exit code tells why.
+            returncode = proc.wait()
+
+        if num_frames == 0:  # The index points past the end of the segment
+            raise PermanentTimelapseError('Segment of timelapse {} is corrupt. None of its {} frames could be read.'.format(print_dir, recorded))
+        if returncode != 0:
+            raise Exception('Failed to assemble timelapse {} from {} frames. See {}'.format(print_dir, num_frames, FFMPEG_LOG_FILE))
+
+        os.replace(tmp_path, video_path)
+        with self._mutex:
+            for name in (SEGMENT_FILE, INDEX_FILE):
+                path = os.path.join(print_dir, name)
+                self.disk_usage -= os.path.getsize(path)
+                os.remove(path)
+            self.disk_usage += os.path.getsize(video_path)
+
+        state['status'] = STATUS_ASSEMBLED
+        state['num_frames'] = num_frames
+        save_state(print_dir, state)
+        _logger.info('Assembled timelapse {} from {} frames'.format(video_path, num_frames))
+
+    def upload(self, print_dir, state):
+        video_path = os.path.join(print_dir, VIDEO_FILE)
+        total_size = os.path.getsize(video_path)
+        offset = state.get('upload_offset', 0)
+
+        with open(video_path, 'rb') as f:
+            f.seek(offset)
+            while offset < total_size:
+                chunk = f.read(UPLOAD_CHUNK_SIZE)
+                data = dict(print_ts=state['print_ts'], offset=offset, total_size=total_size)
+                try:
+                    self.server_conn.send_http_request(
+                        'POST', TIMELAPSE_UPLOAD_URI, timeout=60, raise_exception=True, skip_debug_logging=True,
+                        data=data, files={'chunk': (VIDEO_FILE, chunk)})
+                except requests.exceptions.HTTPError as e:
+                    if e.response is not None and 400 <= e.response.status_code < 500:
+                        raise PermanentTimelapseError('Server rejected timelapse {} - {}'.format(video_path, e))
+                    raise
+
+                offset += len(chunk)
+                state['upload_offset'] = offset
+                save_state(print_dir, state)
+
+        state['status'] = STATUS_UPLOADED
+        save_state(print_dir, state)
+        _logger.info('Uploaded timelapse {}'.format(video_path))
@@ -0,0 +1,196 @@
+import array
+import base64
+import logging
+import sys
+import threading
+import time
+
+from . import metrics
+from .telemetry import axis_position
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+_logger = logging.getLogger('obico.timeseries')
+
+# (name, bucket seconds, capacity). Each resolution keeps the mean of every bucket of the one before it.
+# At the default 1s poll: 1 hour of raw samples, 1 day at 10s, 1 week at 1 minute.
+RESOLUTIONS = (
+    ('raw', 0, 3600),
+    ('10s', 10, 8640),
+    ('1m', 60, 10080),
+)
+AXES = ('X', 'Y', 'Z')
+MAX_SERIES = 64  # Heaters that come and go with config reloads shouldn't grow memory without bound
+
+
+def _alloc(typecode, capacity):
+    if np is not None:
+        return np.zeros(capacity, dtype=np.float64 if typecode == 'd' else np.float32)
+    return array.array(typecode, bytes(array.array(typecode).itemsize * capacity))
+
+
+class Ring:
+    """
+        Fixed-capacity (timestamp, value) samples. Timestamps are float64 seconds, values float32.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.ts = _alloc('d', capacity)
+        self.values = _alloc('f', capacity)
+        self.head = 0  # Where the next sample goes
+        self.size = 0
+
+    def append(self, ts, value):
+        self.ts[self.head] = ts
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+        self.size = min(self.size + 1, self.capacity)
+
+    def oldest_ts(self):
+        if self.size == 0:
+            return None
+        return self.ts[(self.head - self.size) % self.capacity]
+
+    # Return: (timestamps, values), oldest first, of the samples with start <= ts <= end
+    def range(self, start, end):
+        first = (self.head - self.size) % self.capacity
+        if np is not None:
+            order = np.roll(np.arange(self.capacity), -first)[:self.size]
+            ts = self.ts[order]
+            lo = np.searchsorted(ts, start, side='left')
+            hi = np.searchsorted(ts, end, side='right')
+            return ts[lo:hi], self.values[order[lo:hi]]
+
+        ts, values = array.array('d'), array.array('f')
+        for i in range(self.size):
+            idx = (first + i) % self.capacity
+            if start <= self.ts[idx] <= end:
+                ts.append(self.ts[idx])
+                values.append(self.values[idx])
+        return ts, values
+
+    def nbytes(self):
+        return self.capacity * (8 + 4)
+
+
+class Series:
+    """
+        One value over time, at every resolution in RESOLUTIONS. Coarser resolutions are updated incrementally,
+        from a running sum of the bucket in progress, so each sample costs O(1).
+    """
+
+    def __init__(self):
+        self.rings = [Ring(capacity) for (_, _, capacity) in RESOLUTIONS]
+        self.buckets = [None] * len(RESOLUTIONS)  # [bucket start, sum, count] for the downsampled resolutions
+
+    def append(self, ts, value):
+        self.rings[0].append(ts, value)
+        for i in range(1, len(RESOLUTIONS)):
+            bucket_secs = RESOLUTIONS[i][1]
+            bucket_start = ts - ts % bucket_secs
+            bucket = self.buckets[i]
+            if bucket is not None and bucket[0] != bucket_start:
+                self.rings[i].append(bucket[0], bucket[1] / bucket[2])
+                bucket = None
+            if bucket is None:
+                bucket = self.buckets[i] = [bucket_start, 0.0, 0]
+            bucket[1] += value
+            bucket[2] += 1
+
+
+class TimeSeries:
+    """
+        Recent heater temperatures and toolhead positions, recorded from every status update into fixed-size
+        ring buffers at several resolutions, so memory stays bounded however long a print runs.
+        Uses numpy when it is installed, and the array module otherwise.
+        Also a passthru target: get_range() returns a time range as base64-encoded float32 arrays.
+    """
+
+    def __init__(self, app_model, rrfconn):
+        self.app_model = app_model
+        self.rrfconn = rrfconn
+        self._mutex = threading.Lock()
+        self.series = {}
+
+    def start(self):
+        self.app_model.printer_state.add_status_listener(self.on_status_update)
+
+    def on_status_update(self, old_status, new_status):
+        if not new_status:
+            return
+
+        # Heaters are the values read for the previous status post. Reading them here would add a request per poll.
+        samples = []
+        for heater in list(self.rrfconn.heaters if self.rrfconn else []):
+            samples.append(('heater.{}.actual'.format(heater.name), heater.actual))
+            samples.append(('heater.{}.target'.format(heater.name), heater.target))
+        for letter in AXES:
+            samples.append(('axis.{}'.format(letter), axis_position(new_status, letter)))
+
+        self.record(time.time(), samples)
+
+    def record(self, ts, samples):
+        with self._mutex:
+            for (name, value) in samples:
+                if value is None:
+                    continue
+                series = self.series.get(name)
+                if series is None:
+                    if len(self.series) >= MAX_SERIES:
+                        continue
+                    series = self.series[name] = Series()
+                    metrics.gauge('timeseries.bytes').set(sum(r.nbytes() for s in self.series.values() for r in s.rings))
+                series.append(ts, float(value))
+
+    # Passthru: get_range(names=None, start=None, end=None, resolution=None)
+    # names: series names, e.g. "heater.Bed.actual" or "axis.Z". All of them if None.
+    # start, end: unix time. The last hour if start is None.
+    # resolution: "raw", "10s" or "1m". If None, the finest one that still has every sample since start.
+    # Return: {resolution, series: {name: {t0, ts, values}}}. ts are float32 seconds after t0.
+    def get_range(self, names=None, start=None, end=None, resolution=None):
+        end = time.time() if end is None else float(end)
+        start = end - 3600 if start is None else float(start)
+
+        resolution_names = [name for (name, _, _) in RESOLUTIONS]
+        if resolution is not None and resolution not in resolution_names:
+            return None, 'Unknown resolution {}. Valid values: {}'.format(resolution, resolution_names)
+
+        with self._mutex:
+            selected = {name: s for (name, s) in self.series.items() if names is None or name in names}
+            if resolution is None:
+                resolution = self._finest_covering(selected.values(), start)
+            level = resolution_names.index(resolution)
+
+            result = {}
+            for (name, series) in selected.items():
+                (ts, values) = series.rings[level].range(start, end)
+                t0 = ts[0] if len(ts) else start
+                result[name] = dict(
+                    t0=float(t0),
+                    ts=self._encode([t - t0 for t in ts] if np is None else ts - t0),
+                    values=self._encode(values),
+                )
+
+        return dict(resolution=resolution, series=result), None
+
+    def _finest_covering(self, series, start):
+        def covers(ring):
+            # A ring that has never wrapped has every sample since the agent started
+            return ring.size < ring.capacity or ring.oldest_ts() <= start
+
+        for level in range(len(RESOLUTIONS)):
+            if all(covers(s.rings[level]) for s in series):
+                return RESOLUTIONS[level][0]
+        return RESOLUTIONS[-1][0]
+
+    def _encode(self, values):
+        if np is not None:
+            return base64.b64encode(np.asarray(values, dtype='<f4').tobytes()).decode('ascii')
+        arr = array.array('f', values)
+        if sys.byteorder != 'little':
+            arr.byteswap()  # Always little-endian on the wire
+        return base64.b64encode(arr.tobytes()).decode('ascii')
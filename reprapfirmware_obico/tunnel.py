@@ -5,22 +5,108 @@ import threading
 import time
 import os
 import zlib
+import collections
 from urllib.parse import urljoin
 
-from .ws import WebSocketClient
+from .ws import new_websocket_client
+from .mjpeg_relay import route_to_relay
+from . import metrics
 
 COMPRESS_THRESHOLD = 1000
+MAX_PENDING_WS_FRAMES = 200
+WS_OPEN_TIMEOUT_SECS = 30
 
 _logger = logging.getLogger('obico.app.tunnel')
 
 
+class TunneledWebSocket(object):
+    """
+        A tunneled websocket that does not block the caller while hand-shaking.
+        Frames sent before the connection is open are buffered and flushed as soon as it opens.
+        If the buffer fills up first, the tunnel is closed, since a stream with frames missing is a corrupted one.
+    """
+
+    def __init__(self, ref, url, on_ws_msg, on_ws_close):
+        self._mutex = threading.RLock()
+        self.ref = ref
+        self.pending = collections.deque()
+        self.opened = False
+        self.closed = False
+        self.started_at = time.monotonic()
+
+        self.open_timer = threading.Timer(WS_OPEN_TIMEOUT_SECS, self._on_open_timeout)
+        self.open_timer.daemon = True
+
+        def on_ws_open(ws):
+            self._on_open()
+
+        def _on_ws_close(ws, **kwargs):
+            with self._mutex:
+                self.closed = True
+                self.pending.clear()
+            self.open_timer.cancel()
+            on_ws_close(ws, **kwargs)
+
+        # Hold the mutex so that on_ws_open, which runs in another thread, can't flush before self.ws is assigned
+        with self._mutex:
+            self.ws = new_websocket_client(
+                url,
+                on_ws_msg=on_ws_msg,
+                on_ws_close=_on_ws_close,
+                on_ws_open=on_ws_open,
+                wait_connected=False,
+            )
+            self.open_timer.start()
+
+    def _on_open(self):
+        self.open_timer.cancel()
+        with self._mutex:
+            if self.closed:
+                return
+            self.opened = True
+            open_latency = time.monotonic() - self.started_at
+            metrics.latency('tunnel.ws_open').record(open_latency)
+            _logger.debug('Tunneled WS opened in {:.3f}s. Flushing {} pending frames'.format(open_latency, len(self.pending)))
+
+            while self.pending:
+                self.ws.send(self.pending.popleft())
+
+    def _on_open_timeout(self):
+        _logger.warning('Tunneled WS not opened after {}s. Closing it.'.format(WS_OPEN_TIMEOUT_SECS))
+        self.close()
+
+    def send(self, data):
+        with self._mutex:
+            if self.closed:
+                return
+            if self.opened:
+                self.ws.send(data)
+                return
+            overflow = len(self.pending) >= MAX_PENDING_WS_FRAMES
+            if not overflow:
+                self.pending.append(data)
+                metrics.counter('tunnel.ws_frames_buffered').inc()
+
+        if overflow:
+            _logger.error('Tunneled WS pending buffer is full after {} frames. Closing it.'.format(MAX_PENDING_WS_FRAMES))
+            metrics.counter('tunnel.ws_buffer_overflows').inc()
+            self.close()
+
+    def close(self):
+        self.open_timer.cancel()
+        with self._mutex:
+            self.closed = True
+            self.pending.clear()
+        self.ws.close()
+
+
 class LocalTunnel(object):
     """
         Copied from Octoprint-Obico plugin source.
         Removed py2 and tunnel-v1 related parts.
     """
 
-    def __init__(self, tunnel_config, on_http_response, on_ws_message, sentry):
+    def __init__(self, tunnel_config, on_http_response, on_ws_message, sentry, webcam_config=None):
         self.base_url = ('https://' if tunnel_config.dest_is_ssl else 'http://') + \
                 tunnel_config.dest_host + \
                 '' if tunnel_config.dest_port == '80' else tunnel_config.dest_port
@@ -28,23 +114,23 @@ class LocalTunnel(object):
         self.on_http_response = on_http_response
         self.on_ws_message = on_ws_message
         self.sentry = sentry
+        self.webcam_config = webcam_config
         self.ref_to_ws = {}
         self.request_session = requests.Session()
 
     def send_ws_to_local(self, ref, path, data, type_):
-        ws = self.ref_to_ws.get(ref, None)
+        tunneled_ws = self.ref_to_ws.get(ref, None)
 
         if type_ == 'tunnel_close':
-            if ws is not None:
-                ws.close()
+            if tunneled_ws is not None:
+                tunneled_ws.close()
             return
 
-        if ws is None:
-            self.connect_octoprint_ws(ref, path)
-            time.sleep(1)  # Wait to make sure websocket is established before `send` is called
+        if tunneled_ws is None:
+            tunneled_ws = self.connect_octoprint_ws(ref, path)
 
         if data is not None:
-            ws.send(data)
+            tunneled_ws.send(data)  # Buffered until the websocket is open
 
     def connect_octoprint_ws(self, ref, path):
         def on_ws_close(ws, **kwargs):
@@ -68,22 +154,26 @@ class LocalTunnel(object):
         url = url.replace('http://', 'ws://')
         url = url.replace('https://', 'wss://')
 
-        ws = WebSocketClient(
+        tunneled_ws = TunneledWebSocket(
+            ref,
             url,
             on_ws_msg=on_ws_msg,
             on_ws_close=on_ws_close,
         )
-        self.ref_to_ws[ref] = ws
+        self.ref_to_ws[ref] = tunneled_ws
+        return tunneled_ws
 
     def close_all_octoprint_ws(self):
-        for ref, ws in self.ref_to_ws.items():
-            ws.close()
+        for ref, tunneled_ws in list(self.ref_to_ws.items()):
+            tunneled_ws.close()
 
     def send_http_to_local_v2(
             self, ref, method, path,
             params=None, data=None, headers=None, timeout=30):
 
         url = urljoin(self.base_url, path)
+        if self.webcam_config:
+            url = route_to_relay(self.webcam_config, url) or url  # Don't open another connection to the webcam
         headers['Accept-Encoding'] = 'identity'
 
         _logger.debug('Tunneling (v2) "{}"'.format(url))
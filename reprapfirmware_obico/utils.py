@@ -7,11 +7,11 @@ import random
 import platform
 import logging
 import tempfile
-from io import BytesIO
 from urllib.error import URLError, HTTPError
 import struct
 import threading
 import socket
+from collections import OrderedDict
 from contextlib import closing
 from typing import Union
 from sarge import run, Capture
@@ -54,6 +54,50 @@ class ExpoBackoff:
             time.sleep(delay)
 
 
+class ExpiringSet:
+    """
+        Remembers keys for ttl seconds. check_and_add is O(1) and safe to call from multiple threads.
+        As every key lives for the same ttl, insertion order is also expiry order, so expired keys are evicted from the front.
+    """
+
+    def __init__(self, ttl, max_size=10000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._mutex = threading.Lock()
+        self._entries = OrderedDict()  # key -> time.monotonic() when added
+        self.duplicate_hits = 0
+
+    # Return: True if key is new, False if it was already added within ttl seconds.
+    def check_and_add(self, key):
+        now = time.monotonic()
+        with self._mutex:
+            self._evict_expired(now)
+            if key in self._entries:
+                self.duplicate_hits += 1
+                return False
+
+            self._entries[key] = now
+            if len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            return True
+
+    def __contains__(self, key):
+        with self._mutex:
+            self._evict_expired(time.monotonic())
+            return key in self._entries
+
+    def __len__(self):
+        with self._mutex:
+            return len(self._entries)
+
+    def _evict_expired(self, now):
+        while self._entries:
+            (key, added_at) = next(iter(self._entries.items()))
+            if now - added_at < self.ttl:
+                return
+            self._entries.popitem(last=False)
+
+
 class SentryWrapper:
 
     def __init__(self, config) -> None:
@@ -151,66 +195,65 @@ class SentryWrapper:
         return tags
 
 
+JPEG_SOF_MARKERS = frozenset(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}  # 0xC4/0xC8/0xCC are DHT/JPG/DAC, not SOF
+JPEG_STANDALONE_MARKERS = frozenset(range(0xD0, 0xD8)) | {0x01}  # RSTn and TEM have no length field
+
+
 def get_image_info(data):
-    data_bytes = data
-    if not isinstance(data, str):
-        data = data.decode('iso-8859-1')
-    size = len(data)
+    # Walks the headers directly over a memoryview: no decoding or copying of the image data,
+    # and it stops at the first marker that carries the dimensions.
+    if isinstance(data, str):
+        data = data.encode('iso-8859-1')
+
     height = -1
     width = -1
     content_type = ''
 
-    # handle GIFs
-    if (size >= 10) and data[:6] in ('GIF87a', 'GIF89a'):
-        # Check to see if content_type is correct
-        content_type = 'image/gif'
-        w, h = struct.unpack("<HH", data[6:10])
-        width = int(w)
-        height = int(h)
-
-    # See PNG 2. Edition spec (http://www.w3.org/TR/PNG/)
-    # Bytes 0-7 are below, 4-byte chunk length, then 'IHDR'
-    # and finally the 4-byte width, height
-    elif ((size >= 24) and data.startswith('\211PNG\r\n\032\n')
-          and (data[12:16] == 'IHDR')):
-        content_type = 'image/png'
-        w, h = struct.unpack(">LL", data[16:24])
-        width = int(w)
-        height = int(h)
-
-    # Maybe this is for an older PNG version.
-    elif (size >= 16) and data.startswith('\211PNG\r\n\032\n'):
-        # Check to see if we have the right content type
-        content_type = 'image/png'
-        w, h = struct.unpack(">LL", data[8:16])
-        width = int(w)
-        height = int(h)
-
-    # handle JPEGs
-    elif (size >= 2) and data.startswith('\377\330'):
-        content_type = 'image/jpeg'
-        jpeg = BytesIO(data_bytes)
-        jpeg.read(2)
-        b = jpeg.read(1)
-        try:
-            while (b and ord(b) != 0xDA):
-                while (ord(b) != 0xFF):
-                    b = jpeg.read(1)
-                while (ord(b) == 0xFF):
-                    b = jpeg.read(1)
-                if (ord(b) >= 0xC0 and ord(b) <= 0xC3):
-                    jpeg.read(3)
-                    h, w = struct.unpack(">HH", jpeg.read(4))
-                    break
-                else:
-                    jpeg.read(int(struct.unpack(">H", jpeg.read(2))[0])-2)
-                b = jpeg.read(1)
-            width = int(w)
-            height = int(h)
-        except struct.error:
-            pass
-        except ValueError:
-            pass
+    with memoryview(data) as view:
+        size = len(view)
+
+        # handle GIFs
+        if (size >= 10) and view[:6] in (b'GIF87a', b'GIF89a'):
+            content_type = 'image/gif'
+            width, height = struct.unpack_from('<HH', view, 6)
+
+        # See PNG 2. Edition spec (http://www.w3.org/TR/PNG/)
+        # Bytes 0-7 are below, 4-byte chunk length, then 'IHDR'
+        # and finally the 4-byte width, height
+        elif (size >= 24) and view[:8] == b'\211PNG\r\n\032\n' and view[12:16] == b'IHDR':
+            content_type = 'image/png'
+            width, height = struct.unpack_from('>LL', view, 16)
+
+        # Maybe this is for an older PNG version.
+        elif (size >= 16) and view[:8] == b'\211PNG\r\n\032\n':
+            content_type = 'image/png'
+            width, height = struct.unpack_from('>LL', view, 8)
+
+        # handle JPEGs
+        elif (size >= 2) and view[0] == 0xFF and view[1] == 0xD8:
+            content_type = 'image/jpeg'
+            pos = 2
+            try:
+                while pos + 1 < size:
+                    if view[pos] != 0xFF:  # Not at a marker. Scan forward to the next one.
+                        pos += 1
+                        continue
+                    marker = view[pos + 1]
+                    if marker == 0xFF:  # Fill byte
+                        pos += 1
+                        continue
+                    if marker in (0xDA, 0xD9):  # Start of scan or end of image before any SOF
+                        break
+                    if marker in JPEG_STANDALONE_MARKERS:
+                        pos += 2
+                        continue
+                    if marker in JPEG_SOF_MARKERS:
+                        # marker(2), length(2), precision(1), height(2), width(2)
+                        height, width = struct.unpack_from('>HH', view, pos + 5)
+                        break
+                    pos += 2 + struct.unpack_from('>H', view, pos + 2)[0]
+            except struct.error:
+                pass
 
     return content_type, width, height
 
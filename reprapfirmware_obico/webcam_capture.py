@@ -1,5 +1,4 @@
 from __future__ import absolute_import
-import io
 import re
 import os
 from urllib.request import urlopen
@@ -11,133 +10,457 @@ import backoff
 import logging
 import time
 import threading
+from concurrent.futures import Future
+
+from . import metrics
+from .webcam_image import SnapshotTranscoder, SceneChangeGate, UploadBandwidthEstimator
 
 POST_PIC_INTERVAL_SECONDS = 10.0
 if os.environ.get('DEBUG'):
     POST_PIC_INTERVAL_SECONDS = 3.0
+LAYER_CHANGE_MIN_SPACING = 0.5  # Layer changes may post this fraction of the posting interval after the last post
+MAX_CAMERA_STAGGER_SECONDS = 2.0
 
 _logger = logging.getLogger('obico.webcam_capture')
 
 
+MAX_JPEG_SIZE = 5000000
+INITIAL_READ_BUFFER_SIZE = 256 * 1024
+
+MAX_MJPEG_LINE_SIZE = 8192
+MJPEG_SUBSCRIBER_IDLE_SECS = 30
+MJPEG_FRAME_TIMEOUT_SECS = 10
+MJPEG_STALE_FRAME_SECS = 5
+
+_frame_caches = {}
+_frame_caches_mutex = threading.Lock()
+_mjpeg_subscribers = {}
+_mjpeg_subscribers_mutex = threading.Lock()
+
+
+def capture_jpeg(webcam_config, force_stream_url=False, max_age=None):
+    # All consumers go through the frame cache so that concurrent/close-by captures share one camera request
+    return frame_cache_for(webcam_config).get(force_stream_url=force_stream_url, max_age=max_age)
+
+
+def frame_cache_for(webcam_config):
+    with _frame_caches_mutex:
+        key = id(webcam_config)  # WebcamConfig is not hashable
+        if key not in _frame_caches:
+            _frame_caches[key] = FrameCache(webcam_config)
+        return _frame_caches[key]
+
+
+class FrameCache:
+    """
+        Caches the last jpeg captured from each source (snapshot_url or stream_url) for up to max_age seconds.
+        Concurrent callers that miss the cache wait for the one fetch that is already in flight instead of starting their own.
+    """
+
+    def __init__(self, webcam_config):
+        self.webcam_config = webcam_config
+        self._mutex = threading.Lock()
+        self._frames = {}     # source -> (jpeg, captured_at)
+        self._in_flight = {}  # source -> Future of the fetch in flight
+        self.fetcher = fetch_jpeg  # Replaced when frames come from another process instead of the camera
+        self.frame_listeners = []  # Called with each freshly fetched jpeg
+
+    def get(self, force_stream_url=False, max_age=None):
+        from .mjpeg_relay import relay_running  # mjpeg_relay imports this module
+
+        # With the mjpeg relay, snapshots are taken from the stream connection the relay already holds
+        use_stream = force_stream_url or not self.webcam_config.snapshot_url or relay_running(self.webcam_config)
+        source = 'stream' if use_stream else 'snapshot'
+        if max_age is None:
+            max_age = self.webcam_config.snapshot_max_age
+
+        with self._mutex:
+            cached = self._frames.get(source)
+            if cached and time.monotonic() - cached[1] <= max_age:
+                metrics.counter('webcam.cache_hits').inc()
+                return cached[0]
+
+            fetch = self._in_flight.get(source)
+            is_fetcher = fetch is None
+            if is_fetcher:
+                fetch = Future()
+                self._in_flight[source] = fetch
+
+        if not is_fetcher:
+            metrics.counter('webcam.cache_shared_fetches').inc()
+            return fetch.result()
+
+        try:
+            start = time.monotonic()
+            jpeg = self.fetcher(self.webcam_config, force_stream_url=(source == 'stream'))
+            captured_at = time.monotonic()
+            metrics.latency('webcam.capture.' + source).record(captured_at - start)
+            for listener in self.frame_listeners:
+                listener(jpeg)
+
+            with self._mutex:
+                self._frames[source] = (jpeg, captured_at)
+            fetch.set_result(jpeg)
+            return jpeg
+        except Exception as e:
+            fetch.set_exception(e)
+            raise
+        finally:
+            with self._mutex:
+                self._in_flight.pop(source, None)
+
+
+def read_into_buffer(fileobj, size_hint=None, max_size=MAX_JPEG_SIZE):
+    # Reads into one preallocated buffer (sized by Content-Length when known) instead of concatenating chunks
+    if size_hint and size_hint > max_size:
+        raise Exception('Payload returned from the snapshot_url is too large. Did you configure stream_url as snapshot_url?')
+
+    buf = bytearray(size_hint or INITIAL_READ_BUFFER_SIZE)
+    size = 0
+    while True:
+        if size == len(buf):
+            if size_hint:
+                break
+            grown = bytearray(min(len(buf) * 2, max_size + 1))
+            grown[:size] = buf
+            buf = grown
+
+        with memoryview(buf) as view:
+            read = fileobj.readinto(view[size:])
+        if not read:
+            break
+        size += read
+        if size > max_size:
+            raise Exception('Payload returned from the snapshot_url is too large. Did you configure stream_url as snapshot_url?')
+
+    with memoryview(buf) as view:
+        return bytes(view[:size])
+
+
 @backoff.on_exception(backoff.expo, Exception, max_tries=3)
 @backoff.on_predicate(backoff.expo, max_tries=3)
-def capture_jpeg(webcam_config, force_stream_url=False):
-    MAX_JPEG_SIZE = 5000000
-
+def fetch_jpeg(webcam_config, force_stream_url=False):
     snapshot_url = webcam_config.snapshot_url
     if snapshot_url and not force_stream_url:
         snapshot_validate_ssl = webcam_config.snapshot_ssl_validation
 
         r = requests.get(snapshot_url, stream=True, timeout=5, verify=snapshot_validate_ssl)
-        r.raise_for_status()
-
-        response_content = b''
-        start_time = time.monotonic()
-        for chunk in r.iter_content(chunk_size=1024):
-            response_content += chunk
-            if len(response_content) > MAX_JPEG_SIZE:
-                r.close()
-                raise Exception('Payload returned from the snapshot_url is too large. Did you configure stream_url as snapshot_url?')
-
-        r.close()
-        return response_content
+        try:
+            r.raise_for_status()
+            r.raw.decode_content = True
+            content_length = r.headers.get('Content-Length')
+            size_hint = int(content_length) if content_length and content_length.isdigit() and not r.headers.get('Content-Encoding') else None
+            return read_into_buffer(r.raw, size_hint=size_hint)
+        finally:
+            r.close()
 
     else:
         stream_url = webcam_config.stream_url
         if not stream_url:
             raise Exception('Invalid Webcam snapshot URL "{}" or stream URL: "{}"'.format(webcam_config.snapshot_url, webcam_config.stream_url))
 
-        with closing(urlopen(stream_url)) as res:
-            chunker = MjpegStreamChunker()
+        return mjpeg_subscriber_for(stream_url).latest_frame()
+
+
+def mjpeg_subscriber_for(stream_url):
+    with _mjpeg_subscribers_mutex:
+        if stream_url not in _mjpeg_subscribers:
+            _mjpeg_subscribers[stream_url] = MjpegSubscriber(stream_url)
+        return _mjpeg_subscribers[stream_url]
+
+
+class MjpegSubscriber:
+    """
+        Keeps one connection to the mjpeg stream open for as long as frames keep being asked for,
+        and holds only the newest jpeg in a single slot. Reading a frame is then just a memory read.
+        The connection is closed after MJPEG_SUBSCRIBER_IDLE_SECS without readers.
+    """
+
+    def __init__(self, stream_url):
+        self.stream_url = stream_url
+        self._cond = threading.Condition()
+        self._frame = None  # (jpeg, received_at)
+        self._frame_seq = 0
+        self._last_wanted_ts = 0
+        self._thread = None
+
+    def latest_frame(self, timeout=MJPEG_FRAME_TIMEOUT_SECS):
+        return self.next_frame(0, timeout)[0]
+
+    # Wait for a fresh frame newer than after_seq. A reader that passes the seq of the last frame it got
+    # skips whatever frames arrived while it was busy, instead of falling behind.
+    # Return: (jpeg, seq)
+    def next_frame(self, after_seq, timeout=MJPEG_FRAME_TIMEOUT_SECS):
+        with self._cond:
+            self._last_wanted_ts = time.monotonic()
+            self._ensure_running()
+
+            def has_fresh_frame():
+                return self._frame is not None and self._frame_seq > after_seq and time.monotonic() - self._frame[1] < MJPEG_STALE_FRAME_SECS
+
+            if not self._cond.wait_for(has_fresh_frame, timeout):
+                raise Exception('No jpeg received from stream_url "{}" in {}s'.format(self.stream_url, timeout))
+            return (self._frame[0], self._frame_seq)
+
+    def _ensure_running(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _idle(self):
+        return time.monotonic() - self._last_wanted_ts > MJPEG_SUBSCRIBER_IDLE_SECS
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if self._idle():
+                    _logger.debug('No more readers for mjpeg stream. Disconnecting.')
+                    self._thread = None
+                    self._frame = None
+                    return
+
+            try:
+                self._read_stream()
+            except Exception as e:
+                _logger.warning('Error reading mjpeg stream - {}'.format(e))
+                time.sleep(1)
+
+    def _read_stream(self):
+        with closing(urlopen(self.stream_url, timeout=MJPEG_FRAME_TIMEOUT_SECS)) as res:
+            boundary = None
+            m = re.search(r'boundary="?([^";]+)"?', res.headers.get('Content-Type', ''))
+            if m:
+                boundary = m.group(1).encode('latin-1')
+                if not boundary.startswith(b'--'):
+                    boundary = b'--' + boundary
+
+            # Skip anything before the first boundary. Without a boundary in the headers, the first "--" line is the boundary.
+            while True:
+                line = res.readline(MAX_MJPEG_LINE_SIZE)
+                if not line:
+                    raise Exception('End of stream before the first boundary')
+                line = line.rstrip()
+                if (boundary and line == boundary) or (not boundary and line.startswith(b'--')):
+                    boundary = line
+                    break
+
+            while not self._idle():
+                jpeg = self._read_part(res, boundary)
+                with self._cond:
+                    self._frame = (jpeg, time.monotonic())
+                    self._frame_seq += 1
+                    self._cond.notify_all()
+
+    def _read_part(self, res, boundary):
+        content_length = None
+        while True:  # Part headers
+            line = res.readline(MAX_MJPEG_LINE_SIZE)
+            if not line:
+                raise Exception('End of stream in part headers')
+            line = line.strip()
+            if not line:
+                break
+            (k, _, v) = line.partition(b':')
+            if k.strip().lower() == b'content-length' and v.strip().isdigit():
+                content_length = int(v.strip())
+
+        if content_length is not None:
+            jpeg = read_into_buffer(res, size_hint=content_length)
+            if len(jpeg) < content_length:
+                raise Exception('End of stream in the middle of a jpeg')
+            while True:  # Skip the CRLF(s) up to the next boundary
+                line = res.readline(MAX_MJPEG_LINE_SIZE)
+                if not line:
+                    raise Exception('End of stream before the next boundary')
+                if line.rstrip() == boundary:
+                    return jpeg
+
+        # No Content-Length. Fall back to scanning for the next boundary.
+        lines = []
+        size = 0
+        while True:
+            line = res.readline()
+            if not line:
+                raise Exception('End of stream before the next boundary')
+            if line.rstrip() == boundary:
+                jpeg = b''.join(lines)
+                return jpeg[:-2] if jpeg.endswith(b'\r\n') else jpeg
+            size += len(line)
+            if size > MAX_JPEG_SIZE:
+                raise Exception('Reached the size cap before a valid jpeg is found.')
+            lines.append(line)
+
+
+class SnapshotScheduler:
+    """
+        Decides when JpegPoster should post the next snapshot, waking on events instead of polling:
+        a viewing boost request, the posting interval, or a layer change. A layer change posts early, but no sooner
+        than LAYER_CHANGE_MIN_SPACING of the posting interval after the last post. It takes the place of the next
+        timer post, which is pushed back by as much as it came early, so layer changes don't raise the posting rate.
+    """
+    VIEWING_BOOST = 'viewing_boost'
+    LAYER_CHANGE = 'layer_change'
+    TIMER = 'timer'
 
-            data_bytes = 0
+    def __init__(self, app_model):
+        self.app_model = app_model
+        self._cond = threading.Condition()
+        self._viewing_boost_requested = False
+        self._layer_changed = False
+        self._last_layer = None
+        self._borrowed_seconds = 0  # How early the last layer change post came. The next timer post waits that much longer.
+        self.last_post_ts = 0
+
+        app_model.printer_state.add_status_listener(self.on_status_update)
+
+    def request_viewing_boost(self):
+        with self._cond:
+            self._viewing_boost_requested = True
+            self._cond.notify_all()
+
+    def on_status_update(self, old_status, new_status):
+        layer = new_status.get('job', {}).get('layer')
+        with self._cond:
+            if layer is not None and self._last_layer is not None and layer != self._last_layer:
+                self._layer_changed = True
+            self._last_layer = layer
+            self._cond.notify_all()  # Printing state may have changed too
+
+    # Sleep for up to `seconds`, waking early if a viewing boost is requested. The request is left for wait_for_next().
+    # Return: True if a viewing boost is pending.
+    def sleep(self, seconds):
+        with self._cond:
+            self._cond.wait_for(lambda: self._viewing_boost_requested, seconds)
+            return self._viewing_boost_requested
+
+    def interval_seconds(self):
+        interval_seconds = POST_PIC_INTERVAL_SECONDS
+        if not self.app_model.remote_status['viewing'] and not self.app_model.remote_status['should_watch']:
+            interval_seconds *= 12      # Slow down jpeg posting if needed
+        return interval_seconds
+
+    def wait_for_next(self):
+        with self._cond:
             while True:
-                data = res.readline()
-                data_bytes += len(data)
-                if data == b'':
-                    raise Exception('End of stream before a valid jpeg is found')
-                if data_bytes > MAX_JPEG_SIZE:
-                    raise Exception('Reached the size cap before a valid jpeg is found.')
-
-                mjpg = chunker.findMjpegChunk(data)
-                if mjpg:
-                    res.close()
-
-                    mjpeg_headers_index = mjpg.find(b'\r\n'*2)
-                    if mjpeg_headers_index > 0:
-                        return mjpg[mjpeg_headers_index+4:]
+                if self._viewing_boost_requested:
+                    self._viewing_boost_requested = False
+                    return SnapshotScheduler.VIEWING_BOOST
+
+                timeout = None
+                if self.app_model.printer_state.is_printing():
+                    interval_seconds = self.interval_seconds()
+                    layer_seconds = interval_seconds * LAYER_CHANGE_MIN_SPACING
+                    layer_triggered = self.app_model.config.webcam.snapshot_on_layer_change and self._layer_changed
+                    layer_triggered = layer_triggered and not self._borrowed_seconds  # One early post per timer post
+                    timer_seconds = interval_seconds + min(self._borrowed_seconds, layer_seconds)  # The interval may have shrunk since
+                    since_last_post = time.time() - self.last_post_ts
+
+                    if since_last_post >= timer_seconds:
+                        reason = SnapshotScheduler.TIMER
+                        self._borrowed_seconds = 0
+                    elif layer_triggered and since_last_post >= layer_seconds:
+                        reason = SnapshotScheduler.LAYER_CHANGE
+                        self._borrowed_seconds = max(interval_seconds - since_last_post, 0)
                     else:
-                        raise Exception('Wrong mjpeg data format')
+                        reason = None
+
+                    if reason:
+                        self._layer_changed = False
+                        self.last_post_ts = time.time()
+                        return reason
+
+                    timeout = (layer_seconds if layer_triggered else timer_seconds) - since_last_post
+                else:
+                    self._layer_changed = False
+                    self._borrowed_seconds = 0
 
+                self._cond.wait(timeout)
 
-class MjpegStreamChunker:
 
-    def __init__(self):
-        self.boundary = None
-        self.current_chunk = io.BytesIO()
+class SnapshotUploader:
+    """
+        Captures and uploads the snapshots of one webcam.
+    """
 
-    def findMjpegChunk(self, line):
-        # Return: mjpeg chunk if found
-        #         None: in the middle of the chunk
-        # The first time endOfChunk should be called
-        # with 'boundary' text as input
-        if not self.boundary:
-            self.boundary = line
-            self.current_chunk.write(line)
-            return None
+    def __init__(self, webcam_config, server_conn, bandwidth, budget_share):
+        self.webcam_config = webcam_config
+        self.server_conn = server_conn
+        self.transcoder = SnapshotTranscoder(webcam_config, bandwidth=bandwidth, budget_share=budget_share)
+        self.scene_change_gate = SceneChangeGate(webcam_config)
 
-        if len(line) == len(self.boundary) and line == self.boundary:
-            # start of next chunk
-            return self.current_chunk.getvalue()
+    def post_pic_to_server(self, viewing_boost=False):
+        try:
+            # Someone just started watching. Show them the camera as it is now, not a frame cached for other callers.
+            jpeg = capture_jpeg(self.webcam_config, max_age=0 if viewing_boost else None)
+            if not viewing_boost and not self.scene_change_gate.should_upload(jpeg):
+                return
 
-        self.current_chunk.write(line)
-        return None
+            jpeg = self.transcoder.transcode(jpeg, viewing_boost=viewing_boost)
+            files = {'pic': jpeg}
+
+            data = {'viewing_boost': 'true'} if viewing_boost else {}
+            if self.webcam_config.name:
+                data['webcam_name'] = self.webcam_config.name
+            start = time.monotonic()
+            resp = self.server_conn.send_http_request('POST', '/api/v1/octo/pic/', timeout=60, files=files, data=data, raise_exception=True, skip_debug_logging=True)
+            self.transcoder.record_upload(len(jpeg), time.monotonic() - start)
+            if not viewing_boost:
+                self.scene_change_gate.commit(len(jpeg))
+            metrics.counter('webcam.upload_bytes').inc(len(jpeg))
+            _logger.debug('Jpeg posted to server - webcam: {0} - viewing_boost: {1} - {2}'.format(self.webcam_config.name or 'primary', viewing_boost, resp))
+        except (URLError, HTTPError, requests.exceptions.RequestException) as e:
+            _logger.warn('Failed to capture jpeg - ' + str(e))
+            return
 
 
 class JpegPoster:
+    """
+        Posts snapshots of the primary webcam, and of the additional webcams if post_additional_webcams is on,
+        from one thread. Periodic captures of different webcams are staggered over the posting interval,
+        and the webcams share one upload bandwidth estimate and split its budget evenly.
+    """
 
     def __init__(self, app_model, server_conn, sentry):
         self.config = app_model.config
         self.app_model = app_model
         self.server_conn = server_conn
         self.sentry = sentry
-        self.last_jpg_post_ts = 0
-        self.need_viewing_boost = threading.Event()
+        self.scheduler = SnapshotScheduler(app_model)
 
+        bandwidth = UploadBandwidthEstimator()
+        webcams = self.config.webcams
+        # Servers that don't file snapshots by webcam_name would take every webcam's for the primary one,
+        # which failure detection runs on
+        if len(webcams) > 1 and not self.config.webcam.post_additional_webcams:
+            _logger.warning('post_additional_webcams is off. Only the primary webcam is posted.')
+            webcams = webcams[:1]
+        self.uploaders = [SnapshotUploader(webcam_config, server_conn, bandwidth, 1.0 / len(webcams)) for webcam_config in webcams]
 
     def post_pic_to_server(self, viewing_boost=False):
-        try:
-            files = {'pic': capture_jpeg(self.config.webcam)}
+        stagger_seconds = min(self.scheduler.interval_seconds() / len(self.uploaders), MAX_CAMERA_STAGGER_SECONDS)
+        for (i, uploader) in enumerate(self.uploaders):
+            # A viewing boost posts all webcams right away, so there is no point finishing a periodic round
+            if i > 0 and not viewing_boost and self.scheduler.sleep(stagger_seconds):
+                return
 
-            data = {'viewing_boost': 'true'} if viewing_boost else {}
-            resp = self.server_conn.send_http_request('POST', '/api/v1/octo/pic/', timeout=60, files=files, data=data, raise_exception=True, skip_debug_logging=True)
-            _logger.debug('Jpeg posted to server - viewing_boost: {0} - {1}'.format(viewing_boost, resp))
-        except (URLError, HTTPError, requests.exceptions.RequestException) as e:
-            _logger.warn('Failed to capture jpeg - ' + str(e))
-            return
+            try:
+                uploader.post_pic_to_server(viewing_boost=viewing_boost)
+            except Exception:
+                self.sentry.captureException()
 
     def pic_post_loop(self):
         while True:
             try:
-                viewing_boost = self.need_viewing_boost.wait(1)
-                if viewing_boost:
-                    self.need_viewing_boost.clear()
+                reason = self.scheduler.wait_for_next()
+                if reason == SnapshotScheduler.VIEWING_BOOST:
                     repeats = 3 if self.app_model.linked_printer.get('is_pro') else 1 # Pro users get better viewing boost
                     for _ in range(repeats):
                         self.post_pic_to_server(viewing_boost=True)
                     continue
 
-                if not self.app_model.printer_state.is_printing():
-                    continue
-
-                interval_seconds = POST_PIC_INTERVAL_SECONDS
-                if not self.app_model.remote_status['viewing'] and not self.app_model.remote_status['should_watch']:
-                    interval_seconds *= 12      # Slow down jpeg posting if needed
-
-                if self.last_jpg_post_ts > time.time() - interval_seconds:
-                    continue
-
-                self.last_jpg_post_ts = time.time()
+                _logger.debug('Posting jpeg on {}'.format(reason))
                 self.post_pic_to_server(viewing_boost=False)
             except:
                 self.sentry.captureException()
@@ -0,0 +1,179 @@
+import io
+import logging
+import threading
+import time
+
+from . import metrics
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+_logger = logging.getLogger('obico.webcam_image')
+
+# (max_width, max_height, jpeg_quality), from best to smallest
+TRANSCODE_PROFILES = [
+    (1920, 1080, 85),
+    (1280, 720, 80),
+    (960, 540, 75),
+    (640, 360, 70),
+    (480, 270, 60),
+]
+VIEWING_BOOST_PROFILE = 1
+PERIODIC_PROFILE = 2
+
+# Aim to finish an upload within these many seconds at the measured bandwidth
+VIEWING_BOOST_UPLOAD_SECS = 1.0
+PERIODIC_UPLOAD_SECS = 3.0
+
+BANDWIDTH_EWMA_ALPHA = 0.3
+
+SCENE_THUMBNAIL_SIZE = (32, 24)
+
+
+class UploadBandwidthEstimator:
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self.bytes_per_sec = None
+
+    def record(self, num_bytes, seconds):
+        if seconds <= 0 or num_bytes <= 0:
+            return
+        sample = num_bytes / seconds
+        with self._mutex:
+            if self.bytes_per_sec is None:
+                self.bytes_per_sec = sample
+            else:
+                self.bytes_per_sec += BANDWIDTH_EWMA_ALPHA * (sample - self.bytes_per_sec)
+
+
+class SnapshotTranscoder:
+    """
+        Optionally downscales and recompresses snapshots before they are uploaded.
+        The target size depends on viewing_boost and the measured upload bandwidth.
+        When several webcams share the uplink, each gets budget_share of the upload time budget.
+    """
+
+    def __init__(self, webcam_config, bandwidth=None, budget_share=1.0):
+        self.webcam_config = webcam_config
+        self.bandwidth = bandwidth or UploadBandwidthEstimator()
+        self.budget_share = budget_share
+        self.last_output = None  # (num_bytes, num_pixels) of the last transcoded frame
+
+        if webcam_config.snapshot_transcode and Image is None:
+            _logger.warning('snapshot_transcode is enabled but Pillow is not installed. Uploading snapshots as is.')
+
+    def enabled(self):
+        return Image is not None and self.webcam_config.snapshot_transcode
+
+    def record_upload(self, num_bytes, seconds):
+        self.bandwidth.record(num_bytes, seconds)
+
+    def target_profile(self, viewing_boost):
+        profile_idx = VIEWING_BOOST_PROFILE if viewing_boost else PERIODIC_PROFILE
+        bytes_per_sec = self.bandwidth.bytes_per_sec
+        if bytes_per_sec is None or self.last_output is None:
+            return TRANSCODE_PROFILES[profile_idx]
+
+        # Step down until the estimated frame size fits in the upload time budget
+        budget = bytes_per_sec * (VIEWING_BOOST_UPLOAD_SECS if viewing_boost else PERIODIC_UPLOAD_SECS) * self.budget_share
+        (last_bytes, last_pixels) = self.last_output
+        while profile_idx < len(TRANSCODE_PROFILES) - 1:
+            (w, h, _) = TRANSCODE_PROFILES[profile_idx]
+            if last_bytes * (w * h) / last_pixels <= budget:
+                break
+            profile_idx += 1
+        return TRANSCODE_PROFILES[profile_idx]
+
+    def transcode(self, jpeg, viewing_boost=False):
+        if not self.enabled():
+            return jpeg
+
+        try:
+            with metrics.latency('webcam.transcode').time():
+                out = self._transcode(jpeg, *self.target_profile(viewing_boost))
+        except Exception as e:
+            _logger.warning('Failed to transcode snapshot - {}'.format(e))
+            return jpeg
+
+        if len(out) >= len(jpeg):
+            return jpeg
+        metrics.counter('webcam.transcode_bytes_saved').inc(len(jpeg) - len(out))
+        return out
+
+    def _transcode(self, jpeg, max_w, max_h, quality):
+        # The server applies rotation and flips when displaying the snapshot. So the bounding box is
+        # in the displayed orientation, and nothing is baked into the pixels here.
+        if self.webcam_config.rotation in (90, 270):
+            (max_w, max_h) = (max_h, max_w)
+
+        img = Image.open(io.BytesIO(jpeg))
+        img.draft('RGB', (max_w, max_h))  # Let the jpeg decoder do most of the downscaling in the DCT domain
+        img = img.convert('RGB')
+        img.thumbnail((max_w, max_h), Image.BILINEAR)
+
+        out = io.BytesIO()
+        img.save(out, format='JPEG', quality=quality)
+        out = out.getvalue()
+        self.last_output = (len(out), img.width * img.height)
+        return out
+
+
+class SceneChangeGate:
+    """
+        Skips periodic uploads of frames that look nearly the same as the last uploaded one,
+        by comparing downscaled luminance. A frame is always uploaded once the last upload is max_staleness old.
+        A frame only counts as uploaded once commit() is called, after the server has accepted it.
+    """
+
+    def __init__(self, webcam_config):
+        self.webcam_config = webcam_config
+        self.last_luma = None
+        self.last_upload_ts = 0
+        self.last_upload_size = 0
+        self.pending_luma = None  # Of the frame should_upload() last let through, until it is committed
+
+        if webcam_config.scene_change_gate and Image is None:
+            _logger.warning('scene_change_gate is enabled but Pillow is not installed. Uploading every snapshot.')
+
+    def enabled(self):
+        return Image is not None and self.webcam_config.scene_change_gate
+
+    def should_upload(self, jpeg):
+        self.pending_luma = None
+        if not self.enabled():
+            return True
+
+        try:
+            luma = self._luma(jpeg)
+        except Exception as e:
+            _logger.warning('Failed to compute luminance of snapshot - {}'.format(e))
+            return True
+
+        if self.last_luma is not None and time.monotonic() - self.last_upload_ts < self.webcam_config.scene_change_max_staleness:
+            diff = sum(abs(a - b) for (a, b) in zip(luma, self.last_luma)) / len(luma)
+            if diff < self.webcam_config.scene_change_threshold:
+                metrics.counter('webcam.scene_unchanged_skips').inc()
+                # The skipped frame isn't transcoded. The last upload, of a frame that looks the same, is what it would have cost.
+                metrics.counter('webcam.scene_unchanged_bytes_saved').inc(self.last_upload_size)
+                _logger.debug('Skipping snapshot upload. Mean luminance difference {:.2f} is below the threshold.'.format(diff))
+                return False
+
+        self.pending_luma = luma
+        return True
+
+    # num_bytes: The size of the jpeg as it was uploaded, after transcoding
+    def commit(self, num_bytes):
+        if self.pending_luma is None:
+            return
+        self.last_luma = self.pending_luma
+        self.last_upload_ts = time.monotonic()
+        self.last_upload_size = num_bytes
+        self.pending_luma = None
+
+    def _luma(self, jpeg):
+        img = Image.open(io.BytesIO(jpeg))
+        img.draft('L', (SCENE_THUMBNAIL_SIZE[0] * 2, SCENE_THUMBNAIL_SIZE[1] * 2))  # Decode only the DC coefficients when possible
+        return img.convert('L').resize(SCENE_THUMBNAIL_SIZE, Image.BILINEAR).tobytes()
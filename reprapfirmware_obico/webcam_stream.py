@@ -11,9 +11,14 @@ import psutil
 import backoff
 from urllib.error import URLError, HTTPError
 import requests
+import hashlib
+import json
+import platform
 
 from .utils import get_image_info, pi_version, to_unicode, ExpoBackoff
 from .webcam_capture import capture_jpeg
+from .mjpeg_relay import relay_running, relay_stream_url
+from . import metrics
 
 _logger = logging.getLogger('obico.webcam_stream')
 
@@ -21,6 +26,20 @@ JANUS_SERVER = os.getenv('JANUS_SERVER', '127.0.0.1')
 FFMPEG_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bin', 'ffmpeg')
 FFMPEG = os.path.join(FFMPEG_DIR, 'run.sh')
 
+H264_ENCODERS = ['h264_omx', 'h264_v4l2m2m','h264_nvmpi'] # todo h264_nvmpi documentation for jetson nano https://github.com/jocover/jetson-ffmpeg
+NO_SIGNAL_RESOLUTION = (640, 480)
+STREAM_READY_TIMEOUT_SECS = 15
+STREAM_READY_POLL_SECS = 0.5
+
+GOVERNOR_SAMPLE_SECS = 5
+GOVERNOR_CPU_HIGH = 80
+GOVERNOR_CPU_LOW = 40
+GOVERNOR_LAG_HIGH_SECS = 0.5
+GOVERNOR_LAG_LOW_SECS = 0.1
+GOVERNOR_STEP_DOWN_SAMPLES = 3    # 15s of sustained overload
+GOVERNOR_STEP_UP_SAMPLES = 24     # 2 min of sustained headroom
+GOVERNOR_COOLDOWN_SECS = 60
+
 PI_CAM_RESOLUTIONS = {
     'low': ((320, 240), (480, 270)),  # resolution for 4:3 and 16:9
     'medium': ((640, 480), (960, 540)),
@@ -39,6 +58,97 @@ def bitrate_for_dim(img_w, img_h):
     else:
         return 3000*1000
 
+def ffmpeg_build():
+    try:
+        return subprocess.run([FFMPEG, '-version'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, timeout=30).stdout.split(b'\n')[0].decode('utf-8', errors='replace')
+    except Exception:
+        return ''
+
+
+def encoder_cache_key():
+    # Whether a hardware encoder works depends on the ffmpeg build, the kernel and the hardware
+    try:
+        with open('/proc/device-tree/model', 'r') as f:
+            model = f.read().strip('\0\n ')
+    except Exception:
+        model = ''
+    key = dict(ffmpeg=ffmpeg_build(), kernel=platform.release(), machine=platform.machine(), model=model)
+    return hashlib.sha1(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def encoder_args(encoder):
+    if encoder == 'h264_omx':
+        return '-flags:v +global_header -c:v {} -bsf dump_extra'.format(encoder)  # Apparently OMX encoder needs extra param to get the stream to work
+    return '-c:v {}'.format(encoder)
+
+
+def probe_h264_encoder():
+    test_video = os.path.join(FFMPEG_DIR, 'test-video.mp4')
+    FNULL = open(os.devnull, 'w')
+    for encoder in H264_ENCODERS:
+        ffmpeg_cmd = '{} -re -i {} -pix_fmt yuv420p -vcodec {} -an -f rtp rtp://localhost:8014?pkt_size=1300'.format(FFMPEG, test_video, encoder)
+        _logger.info(ffmpeg_cmd)
+        _logger.debug('Popen: {}'.format(ffmpeg_cmd))
+        ffmpeg_test_proc = psutil.Popen(ffmpeg_cmd.split(' '), stdout=FNULL, stderr=FNULL)
+        if ffmpeg_test_proc.wait() == 0:
+            return encoder
+
+    raise Exception('No ffmpeg found, or ffmpeg does NOT support h264_omx/h264_v4l2m2m encoding.')
+
+
+class H264EncoderCache:
+    """
+        Persists the h264 encoder that passed the test encode, so that it doesn't have to be probed on every start.
+    """
+
+    def __init__(self, cache_dir):
+        self.path = os.path.join(cache_dir, 'h264_encoder.json')
+
+    def get(self, key):
+        try:
+            with open(self.path, 'r') as f:
+                cached = json.load(f)
+            if cached.get('key') == key and cached.get('encoder') in H264_ENCODERS:
+                return cached['encoder']
+        except (OSError, ValueError):
+            pass
+        return None
+
+    def put(self, key, encoder):
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'w') as f:
+                json.dump(dict(key=key, encoder=encoder), f)
+        except OSError as e:
+            _logger.warning('Failed to save h264 encoder cache - {}'.format(e))
+
+    def invalidate(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+
+def wait_for_stream_ready(webcam_config):
+    # crowsnest starts with a "NO SIGNAL" stream that is always 640x480. Poll the stream until it serves something else,
+    # instead of sleeping for the worst case. Return: (width, height) of the last frame, or None if no frame is received.
+    deadline = time.monotonic() + STREAM_READY_TIMEOUT_SECS
+    resolution = None
+    while True:
+        try:
+            (_, img_w, img_h) = get_image_info(capture_jpeg(webcam_config, force_stream_url=True, max_age=0))
+            if img_w > 0 and img_h > 0:
+                resolution = (img_w, img_h)
+                if resolution != NO_SIGNAL_RESOLUTION:
+                    return resolution
+        except Exception as e:
+            _logger.debug('Webcam stream not ready yet - {}'.format(e))
+
+        if time.monotonic() >= deadline:
+            return resolution
+        time.sleep(STREAM_READY_POLL_SECS)
+
+
 def cpu_watch_dog(watched_process, max, interval, server_conn):
 
     def watch_process_cpu(watched_process, max, interval, server_conn):
@@ -62,6 +172,128 @@ def cpu_watch_dog(watched_process, max, interval, server_conn):
     watch_thread.start()
 
 
+class StreamingGovernor:
+    """
+        Steps fps, bitrate and resolution down when ffmpeg uses too much CPU, or when the agent itself is being starved
+        (measured as how late the governor's own sleep wakes up), and back up once there is headroom again.
+        Stepping down needs GOVERNOR_STEP_DOWN_SAMPLES bad samples in a row, stepping up a much longer run of good ones,
+        and any change is followed by a cool-down, so ffmpeg isn't restarted back and forth.
+    """
+
+    # (resolution scale, fps scale, bitrate scale), from full quality down
+    LEVELS = [
+        (1.0, 1.0, 1.0),
+        (1.0, 0.6, 0.75),
+        (1.0, 0.4, 0.5),
+        (0.5, 0.4, 0.5),
+        (0.5, 0.25, 0.35),
+    ]
+
+    def __init__(self, streamer, stream_url, encoder_args, img_w, img_h, fps, bitrate_factor):
+        self.streamer = streamer
+        self.stream_url = stream_url
+        self.encoder_args = encoder_args
+        self.img_w = img_w
+        self.img_h = img_h
+        self.fps = fps
+        self.bitrate_factor = bitrate_factor
+        self.level = 0
+        self.last_change_ts = time.monotonic()
+        self.excessive_cpu_reported = False
+        self.restart_failed = False  # ffmpeg is down. Restarting it is retried every GOVERNOR_COOLDOWN_SECS.
+
+    def ffmpeg_args(self, level=None):
+        (res_scale, fps_scale, bitrate_scale) = StreamingGovernor.LEVELS[self.level if level is None else level]
+        w = int(self.img_w * res_scale) // 2 * 2  # h264 needs even dimensions
+        h = int(self.img_h * res_scale) // 2 * 2
+        fps = max(round(self.fps * fps_scale, 1), 1)
+        bitrate = int(bitrate_for_dim(w, h) * self.bitrate_factor * bitrate_scale)
+        return '-re -i {} -filter:v fps={} -b:v {} -pix_fmt yuv420p -s {}x{} {}'.format(self.stream_url, fps, bitrate, w, h, self.encoder_args)
+
+    def run(self):
+        high_samples = 0
+        low_samples = 0
+        sampled_proc = None
+        while not self.streamer.shutting_down:
+            sleep_start = time.monotonic()
+            time.sleep(GOVERNOR_SAMPLE_SECS)
+            lag = time.monotonic() - sleep_start - GOVERNOR_SAMPLE_SECS
+
+            if self.restart_failed:
+                if time.monotonic() - self.last_change_ts >= GOVERNOR_COOLDOWN_SECS:
+                    self.restart_ffmpeg()
+                continue
+
+            ffmpeg_proc = self.streamer.ffmpeg_proc
+            if ffmpeg_proc is None:
+                continue
+            try:
+                cpu_pct = ffmpeg_proc.cpu_percent(interval=None)
+            except psutil.Error:
+                continue
+
+            if ffmpeg_proc is not sampled_proc:
+                # The first reading of a new process, e.g. after a restart, is always 0.0. It only primes the next one.
+                sampled_proc = ffmpeg_proc
+                high_samples = 0
+                low_samples = 0
+                continue
+
+            metrics.gauge('webcam.governor.ffmpeg_cpu').set(cpu_pct)
+            metrics.latency('webcam.governor.agent_lag').record(lag)
+
+            high_samples = high_samples + 1 if cpu_pct > GOVERNOR_CPU_HIGH or lag > GOVERNOR_LAG_HIGH_SECS else 0
+            low_samples = low_samples + 1 if cpu_pct < GOVERNOR_CPU_LOW and lag < GOVERNOR_LAG_LOW_SECS else 0
+
+            if time.monotonic() - self.last_change_ts < GOVERNOR_COOLDOWN_SECS:
+                continue
+
+            if high_samples >= GOVERNOR_STEP_DOWN_SAMPLES:
+                high_samples = 0
+                if self.level < len(StreamingGovernor.LEVELS) - 1:
+                    self.change_level(self.level + 1, cpu_pct, lag)
+                elif not self.excessive_cpu_reported:
+                    self.excessive_cpu_reported = True
+                    self.streamer.server_conn.post_printer_event_to_server(
+                        'reprapfirmware-obico: Webcam Streaming Using Excessive CPU',
+                        'The webcam streaming uses excessive CPU. This may negatively impact your print quality, or cause webcam streaming issues.',
+                        event_class='WARNING',
+                        info_url='https://obico.io/docs/user-guides/webcam-streaming-resolution-framerate-klipper/',
+                    )
+            elif low_samples >= GOVERNOR_STEP_UP_SAMPLES and self.level > 0:
+                low_samples = 0
+                self.change_level(self.level - 1, cpu_pct, lag)
+
+    def change_level(self, level, cpu_pct, lag):
+        direction = 'down' if level > self.level else 'up'
+        _logger.info('Stepping webcam streaming {} to level {} - ffmpeg cpu: {:.0f}% - agent lag: {:.3f}s'.format(direction, level, cpu_pct, lag))
+        metrics.counter('webcam.governor.step_' + direction).inc()
+
+        previous_level = self.level
+        self.level = level
+        self.last_change_ts = time.monotonic()
+        metrics.gauge('webcam.governor.level').set(level)
+        try:
+            self.streamer.restart_ffmpeg(self.ffmpeg_args())
+        except Exception as e:
+            _logger.warning('Failed to restart ffmpeg at level {} - {}. Going back to level {}.'.format(level, e, previous_level))
+            self.level = previous_level
+            metrics.gauge('webcam.governor.level').set(previous_level)
+            self.restart_ffmpeg()
+
+    # Restarts ffmpeg at the current level. If that fails too, streaming is down until a later retry succeeds.
+    def restart_ffmpeg(self):
+        self.last_change_ts = time.monotonic()
+        try:
+            self.streamer.restart_ffmpeg(self.ffmpeg_args())
+            self.restart_failed = False
+        except Exception:
+            _logger.exception('Failed to restart ffmpeg at level {}. Retrying in {}s.'.format(self.level, GOVERNOR_COOLDOWN_SECS))
+            self.streamer.sentry.captureException()
+            metrics.counter('webcam.governor.restart_failures').inc()
+            self.restart_failed = True
+
+
 class WebcamStreamer:
 
     def __init__(self, app_model, server_conn, sentry):
@@ -99,22 +331,6 @@ class WebcamStreamer:
         def get_webcam_resolution(webcam_config):
             return get_image_info(capture_jpeg(webcam_config, force_stream_url=True))
 
-        def h264_encoder():
-            test_video = os.path.join(FFMPEG_DIR, 'test-video.mp4')
-            FNULL = open(os.devnull, 'w')
-            for encoder in ['h264_omx', 'h264_v4l2m2m','h264_nvmpi']: # todo h264_nvmpi documentation for jetson nano https://github.com/jocover/jetson-ffmpeg
-                ffmpeg_cmd = '{} -re -i {} -pix_fmt yuv420p -vcodec {} -an -f rtp rtp://localhost:8014?pkt_size=1300'.format(FFMPEG, test_video, encoder)
-                _logger.info(ffmpeg_cmd)
-                _logger.debug('Popen: {}'.format(ffmpeg_cmd))
-                ffmpeg_test_proc = psutil.Popen(ffmpeg_cmd.split(' '), stdout=FNULL, stderr=FNULL)
-                if ffmpeg_test_proc.wait() == 0:
-                    if encoder == 'h264_omx':
-                        return '-flags:v +global_header -c:v {} -bsf dump_extra'.format(encoder)  # Apparently OMX encoder needs extra param to get the stream to work
-                    else:
-                        return '-c:v {}'.format(encoder)
-
-            raise Exception('No ffmpeg found, or ffmpeg does NOT support h264_omx/h264_v4l2m2m encoding.')
-
         if self.app_model.linked_printer.get('is_pro'):
             # camera-stream is introduced in Crowsnest V4
             try:
@@ -122,6 +338,7 @@ class WebcamStreamer:
                 _logger.info('Trying to start ffmpeg using camera-streamer H.264 source')
                 # There seems to be a bug in camera-streamer that causes to close .mp4 connection after a random period of time. In that case, we rerun ffmpeg
                 self.start_ffmpeg('-re -i {} -c:v copy'.format(camera_streamer_mp4_url), retry_after_quit=True)
+                cpu_watch_dog(self.ffmpeg_proc, max=80, interval=20, server_conn=self.server_conn)
                 return
             except Exception as e:
                 _logger.info(f'No camera-stream H.264 source found. Continue to legacy streaming: {e}')
@@ -129,19 +346,21 @@ class WebcamStreamer:
 
         # The streaming mechansim for pre-1.0 OctoPi versions
 
-        encoder = h264_encoder()
+        encoder_cache = H264EncoderCache(self.config.cache_dir)
+        encoder = self.h264_encoder(encoder_cache)
 
         webcam_config = self.config.webcam
         stream_url = webcam_config.stream_url
 
         if not stream_url:
             raise Exception('stream_url not configured. Unable to stream the webcam.')
+        if relay_running(webcam_config):
+            stream_url = relay_stream_url(webcam_config)
 
-        # crowsnest starts with a "NO SIGNAL" stream that is always 640x480. Wait for a few seconds to make sure it has the time to start a real stream
-        time.sleep(15)
         (img_w, img_h) = (640, 480)
         try:
-            (_, img_w, img_h) = get_webcam_resolution(webcam_config)
+            ready_resolution = wait_for_stream_ready(webcam_config)
+            (img_w, img_h) = ready_resolution if ready_resolution else get_webcam_resolution(webcam_config)[1:]
             _logger.debug(f'Detected webcam resolution - w:{img_w} / h:{img_h}')
         except (URLError, HTTPError, requests.exceptions.RequestException):
             _logger.warn(f'Failed to connect to webcam to retrieve resolution. Using default.')
@@ -149,13 +368,37 @@ class WebcamStreamer:
             self.sentry.captureException()
             _logger.warn(f'Failed to detect webcam resolution due to unexpected error. Using default.')
 
-        bitrate = bitrate_for_dim(img_w, img_h)
         fps = webcam_config.target_fps
+        bitrate_factor = 1.0
         if not self.app_model.linked_printer.get('is_pro'):
             fps = min(8, fps) # For some reason, when fps is set to 5, it looks like 2FPS. 8fps looks more like 5
-            bitrate = int(bitrate/2)
+            bitrate_factor = 0.5
 
-        self.start_ffmpeg('-re -i {} -filter:v fps={} -b:v {} -pix_fmt yuv420p -s {}x{} {}'.format(stream_url, fps, bitrate, img_w, img_h, encoder))
+        governor = StreamingGovernor(self, stream_url, encoder_args(encoder), img_w, img_h, fps, bitrate_factor)
+        try:
+            self.start_ffmpeg(governor.ffmpeg_args())
+        except Exception:
+            encoder_cache.invalidate()  # Probe again on the next start in case the cached encoder is the culprit
+            raise
+
+        if webcam_config.streaming_governor:
+            governor_thread = Thread(target=governor.run)
+            governor_thread.daemon = True
+            governor_thread.start()
+        else:
+            cpu_watch_dog(self.ffmpeg_proc, max=80, interval=20, server_conn=self.server_conn)
+
+    def h264_encoder(self, encoder_cache):
+        key = encoder_cache_key()
+        encoder = encoder_cache.get(key)
+        if encoder:
+            # Not re-tested here. If it fails, start_ffmpeg raises and the cache is invalidated.
+            _logger.info('Using cached h264 encoder: {}'.format(encoder))
+            return encoder
+
+        encoder = probe_h264_encoder()
+        encoder_cache.put(key, encoder)
+        return encoder
 
     def start_ffmpeg(self, ffmpeg_args, retry_after_quit=False):
         ffmpeg_cmd = '{} -loglevel error {} -an -f rtp rtp://{}:17734?pkt_size=1300'.format(FFMPEG, ffmpeg_args, JANUS_SERVER)
@@ -174,19 +417,17 @@ class WebcamStreamer:
         except psutil.TimeoutExpired:
            pass
 
-        cpu_watch_dog(self.ffmpeg_proc, max=80, interval=20, server_conn=self.server_conn)
-
-        def monitor_ffmpeg_process(retry_after_quit=False):
+        def monitor_ffmpeg_process(ffmpeg_proc, retry_after_quit=False):
             # It seems important to drain the stderr output of ffmpeg, otherwise the whole process will get clogged
             ring_buffer = deque(maxlen=50)
             ffmpeg_backoff = ExpoBackoff(3)
             while True:
-                err = to_unicode(self.ffmpeg_proc.stderr.readline(), errors='replace')
+                err = to_unicode(ffmpeg_proc.stderr.readline(), errors='replace')
                 if not err:  # EOF when process ends?
-                    if self.shutting_down:
+                    if self.shutting_down or self.ffmpeg_proc is not ffmpeg_proc:  # Shut down, or replaced by restart_ffmpeg
                         return
 
-                    returncode = self.ffmpeg_proc.wait()
+                    returncode = ffmpeg_proc.wait()
                     msg = 'STDERR:\n{}\n'.format('\n'.join(ring_buffer))
                     _logger.debug(msg)
                     self.sentry.captureMessage('ffmpeg exited un-expectedly. Exit code: {}'.format(returncode))
@@ -195,17 +436,30 @@ class WebcamStreamer:
                         ffmpeg_backoff.more('ffmpeg exited un-expectedly. Exit code: {}'.format(returncode))
                         ring_buffer = deque(maxlen=50)
                         _logger.debug('Popen: {}'.format(ffmpeg_cmd))
-                        self.ffmpeg_proc = psutil.Popen(ffmpeg_cmd.split(' '), stdin=subprocess.PIPE, stdout=FNULL, stderr=subprocess.PIPE)
+                        ffmpeg_proc = psutil.Popen(ffmpeg_cmd.split(' '), stdin=subprocess.PIPE, stdout=FNULL, stderr=subprocess.PIPE)
+                        self.ffmpeg_proc = ffmpeg_proc
                     else:
                         return
                 else:
                     ring_buffer.append(err)
 
-        ffmpeg_thread = Thread(target=monitor_ffmpeg_process, kwargs=dict(retry_after_quit=retry_after_quit))
+        ffmpeg_thread = Thread(target=monitor_ffmpeg_process, args=(self.ffmpeg_proc,), kwargs=dict(retry_after_quit=retry_after_quit))
         ffmpeg_thread.daemon = True
         ffmpeg_thread.start()
 
 
+    def restart_ffmpeg(self, ffmpeg_args):
+        old_proc = self.ffmpeg_proc
+        self.ffmpeg_proc = None  # So that the monitor thread of the old process doesn't take its exit as a crash
+        if old_proc:
+            try:
+                old_proc.terminate()
+                old_proc.wait(timeout=5)
+            except Exception:
+                pass
+
+        self.start_ffmpeg(ffmpeg_args)
+
     def restore(self):
         self.shutting_down = True
 
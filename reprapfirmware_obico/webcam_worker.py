@@ -0,0 +1,396 @@
+import logging
+import logging.handlers
+import multiprocessing
+import os
+import signal
+import struct
+import threading
+import time
+
+from . import metrics
+from .config import Config
+from .printer import PrinterState
+from .server_conn import ServerConn
+from .utils import ExpoBackoff, SentryWrapper
+from .webcam_capture import JpegPoster, capture_jpeg, frame_cache_for, MAX_JPEG_SIZE
+from .webcam_stream import WebcamStreamer
+from .mjpeg_relay import set_relay_running, start_mjpeg_relay
+from .timelapse import TimelapseRecorder
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # Python < 3.8
+    shared_memory = None
+
+_logger = logging.getLogger('obico.webcam_worker')
+
+# seq (odd while the frame is being written), jpeg length, time.time() when the frame was captured
+FRAME_HEADER = struct.Struct('<QQd')
+FRAME_READ_RETRIES = 20
+
+SHARED_FRAME_MAX_AGE_SECS = 5
+CAPTURE_TIMEOUT_SECS = 30
+WORKER_HEALTHY_SECS = 300  # The restart backoff is reset once the worker has been up for this long
+WORKER_MAX_BACKOFF_SECS = 300
+METRICS_FORWARD_SECS = 30
+METRICS_PREFIX = 'webcam_worker.'
+
+
+def isolated_process_supported():
+    return shared_memory is not None
+
+
+class SharedFrameBuffer:
+    """
+        The latest jpeg, in shared memory, written by the worker process and read by the main process.
+        Writes are guarded by a sequence number (a seqlock) so readers never block the writer,
+        and retry when they catch a frame half written. The seqlock only holds with one writer at a time,
+        so writers in this process, e.g. the stream and snapshot fetches, take turns.
+    """
+
+    def __init__(self, name=None, capacity=MAX_JPEG_SIZE):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=FRAME_HEADER.size + capacity)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.buf = self.shm.buf
+        self.capacity = len(self.buf) - FRAME_HEADER.size
+        self._write_mutex = threading.Lock()
+
+    def write(self, jpeg):
+        if len(jpeg) > self.capacity:
+            _logger.warning('Jpeg of {} bytes does not fit in the shared frame buffer'.format(len(jpeg)))
+            return
+
+        with self._write_mutex:
+            (seq, _, _) = FRAME_HEADER.unpack_from(self.buf, 0)
+            FRAME_HEADER.pack_into(self.buf, 0, seq + 1, 0, 0.0)
+            self.buf[FRAME_HEADER.size:FRAME_HEADER.size + len(jpeg)] = jpeg
+            FRAME_HEADER.pack_into(self.buf, 0, seq + 2, len(jpeg), time.time())
+
+    # Return: (jpeg, captured_at), or None if no frame has been written yet.
+    def read(self):
+        for _ in range(FRAME_READ_RETRIES):
+            (seq, length, captured_at) = FRAME_HEADER.unpack_from(self.buf, 0)
+            if seq == 0:
+                return None
+            if seq % 2 == 1:
+                time.sleep(0.001)
+                continue
+
+            jpeg = bytes(self.buf[FRAME_HEADER.size:FRAME_HEADER.size + length])
+            if FRAME_HEADER.unpack_from(self.buf, 0)[0] == seq:
+                return (jpeg, captured_at)
+        return None
+
+    def close(self, unlink=False):
+        self.buf.release()
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+class WebcamWorker:
+    """
+        Runs JpegPoster and WebcamStreamer in a child process, so that jpeg handling and ffmpeg monitoring
+        don't share the GIL with the printer connection and the server connection.
+        Commands go to the child over a pipe, and the frames it captures come back through a SharedFrameBuffer.
+        The child is restarted, with backoff, whenever it dies.
+    """
+
+    def __init__(self, app_model, server_conn, sentry):
+        self.app_model = app_model
+        self.config = app_model.config
+        self.server_conn = server_conn
+        self.sentry = sentry
+        self.shutting_down = False
+        self.process = None
+
+        self._ctx = multiprocessing.get_context('spawn')  # Forking a process with this many threads is not safe
+        self._conn = None
+        self._send_mutex = threading.Lock()
+        self._streaming = False
+        self._forwarded_status = None
+        self._forwarded_print_ts = None
+
+        self._capture_cond = threading.Condition()
+        self._capture_req = 0
+        self._capture_results = {}  # req -> error message, or None when the capture succeeded
+
+        self.frames = SharedFrameBuffer()
+
+        self.log_queue = self._ctx.Queue()
+        self.log_listener = logging.handlers.QueueListener(self.log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        self.log_listener.start()
+
+        frame_cache_for(self.config.webcam).fetcher = self.fetch_jpeg
+        app_model.printer_state.add_status_listener(self.on_status_update)
+
+    def run_forever(self):
+        restart_backoff = ExpoBackoff(WORKER_MAX_BACKOFF_SECS)
+        while not self.shutting_down:
+            started_at = time.monotonic()
+            try:
+                self._start_process()
+                self._read_loop()
+            except Exception:
+                self.sentry.captureException()
+
+            exitcode = self._stop_process()
+            if self.shutting_down:
+                break
+
+            if time.monotonic() - started_at > WORKER_HEALTHY_SECS:
+                restart_backoff.reset()
+            restart_backoff.more(Exception('Webcam worker exited with code {}'.format(exitcode)))
+
+        self.frames.close(unlink=True)
+        self.log_listener.stop()
+
+    def shutdown(self):
+        self.shutting_down = True
+        self._send('shutdown')
+
+    def start_streaming(self):
+        self._streaming = True
+        self._send('start_streaming')
+
+    def update_remote_status(self, remote_status):
+        self._send('remote_status', dict(remote_status))
+
+    def on_status_update(self, old_status, new_status):
+        # Listeners run before the app sets or unsets current_print_ts, so a new one is sent with the next update,
+        # and the old one is still in place in the worker when the status that ends the print gets there.
+        current_print_ts = self.app_model.printer_state.current_print_ts
+        if current_print_ts != self._forwarded_print_ts:
+            self._forwarded_print_ts = current_print_ts
+            self._send('current_print_ts', current_print_ts)
+
+        # The worker only needs what SnapshotScheduler and TimelapseRecorder look at
+        status = {
+            'state': {'status': new_status.get('state', {}).get('status')},
+            'job': {'layer': new_status.get('job', {}).get('layer')},
+        }
+        if status != self._forwarded_status:
+            self._forwarded_status = status
+            self._send('status', status)
+
+    def fetch_jpeg(self, webcam_config, force_stream_url=False):
+        frame = self.frames.read()
+        if frame and time.time() - frame[1] <= SHARED_FRAME_MAX_AGE_SECS:
+            return frame[0]
+
+        with self._capture_cond:
+            self._capture_req += 1
+            req = self._capture_req
+
+        self._send('capture', dict(req=req, force_stream_url=force_stream_url))
+
+        with self._capture_cond:
+            if not self._capture_cond.wait_for(lambda: req in self._capture_results, CAPTURE_TIMEOUT_SECS):
+                raise Exception('Timed out waiting for the webcam worker to capture a jpeg')
+            error = self._capture_results.pop(req)
+
+        if error:
+            raise Exception(error)
+        frame = self.frames.read()
+        if frame is None:
+            raise Exception('No jpeg in the shared frame buffer')
+        return frame[0]
+
+    def _start_process(self):
+        (parent_conn, child_conn) = self._ctx.Pipe()
+        self.process = self._ctx.Process(
+            target=worker_main,
+            args=(self.config._config_path, self.config.logging.level, self.app_model.linked_printer, child_conn, self.log_queue, self.frames.name),
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()  # So that recv() raises EOFError when the child exits
+        _logger.info('Started webcam worker process (pid {})'.format(self.process.pid))
+
+        with self._send_mutex:
+            self._conn = parent_conn
+
+        # Bring a restarted worker up to date
+        self._send('remote_status', dict(self.app_model.remote_status))
+        if self._forwarded_print_ts is not None:
+            self._send('current_print_ts', self._forwarded_print_ts)
+        if self._forwarded_status:
+            self._send('status', self._forwarded_status)
+        if self._streaming:
+            self._send('start_streaming')
+
+    def _read_loop(self):
+        while True:
+            try:
+                (msg, payload) = self._conn.recv()
+            except (EOFError, OSError):
+                _logger.warning('Webcam worker process exited')
+                return
+
+            if msg == 'captured':
+                with self._capture_cond:
+                    self._capture_results[payload['req']] = payload['error']
+                    self._capture_cond.notify_all()
+            elif msg == 'printer_event':
+                thread = threading.Thread(target=self.server_conn.post_printer_event_to_server, args=payload['args'], kwargs=payload['kwargs'])
+                thread.daemon = True
+                thread.start()
+            elif msg == 'metrics':
+                metrics.set_remote_snapshot(METRICS_PREFIX, payload)
+            elif msg == 'mjpeg_relay':
+                set_relay_running(payload['port'], payload['running'])
+
+    def _send(self, msg, payload=None):
+        with self._send_mutex:
+            if self._conn is None:
+                return
+            try:
+                self._conn.send((msg, payload))
+            except (OSError, ValueError) as e:
+                _logger.debug('Failed to send {} to webcam worker - {}'.format(msg, e))
+
+    def _stop_process(self):
+        with self._send_mutex:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        set_relay_running(self.config.webcam.mjpeg_relay_port, False)  # The relay went down with the worker
+
+        if self.process is None or self.process.pid is None:
+            return None
+
+        self.process.join(5)
+        # ffmpeg started by the worker would otherwise outlive it and keep the RTP ports
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        self.process.join(1)
+        return self.process.exitcode
+
+
+class WorkerAppModel:
+
+    def __init__(self, config, linked_printer):
+        self.config = config
+        self.linked_printer = linked_printer
+        self.remote_status = {'viewing': False, 'should_watch': False}
+        self.printer_state = PrinterState(config)
+
+
+class WorkerServerConn(ServerConn):
+    """
+        Makes HTTP calls to the server directly, but leaves printer events to the main process,
+        which owns the websocket and remembers the events already posted.
+    """
+
+    def __init__(self, config, send_to_parent):
+        super().__init__(config, None, None, None)
+        self.send_to_parent = send_to_parent
+
+    def post_printer_event_to_server(self, *args, **kwargs):
+        self.send_to_parent('printer_event', dict(args=args, kwargs=kwargs))
+
+
+class WebcamWorkerProcess:
+
+    def __init__(self, config, linked_printer, conn, frames):
+        self.config = config
+        self.conn = conn
+        self.frames = frames
+        self._send_mutex = threading.Lock()
+
+        self.sentry = SentryWrapper(config=config)
+        self.app_model = WorkerAppModel(config, linked_printer)
+        self.server_conn = WorkerServerConn(config, self.send)
+        self.jpeg_poster = JpegPoster(self.app_model, self.server_conn, self.sentry)
+        self.webcam_streamer = None
+
+        frame_cache_for(config.webcam).frame_listeners.append(frames.write)
+        if config.webcam.mjpeg_relay:
+            relay = start_mjpeg_relay(config.webcam)
+            self.send('mjpeg_relay', dict(port=config.webcam.mjpeg_relay_port, running=relay is not None))
+        if config.timelapse.enabled:
+            TimelapseRecorder(self.app_model, self.server_conn, self.sentry).start()
+
+    def send(self, msg, payload=None):
+        with self._send_mutex:
+            try:
+                self.conn.send((msg, payload))
+            except (OSError, ValueError) as e:
+                _logger.debug('Failed to send {} to the main process - {}'.format(msg, e))
+
+    def run(self):
+        thread = threading.Thread(target=self.jpeg_poster.pic_post_loop)
+        thread.daemon = True
+        thread.start()
+
+        thread = threading.Thread(target=self.forward_metrics_loop)
+        thread.daemon = True
+        thread.start()
+
+        while True:
+            try:
+                (msg, payload) = self.conn.recv()
+            except (EOFError, OSError):
+                break  # The main process is gone
+
+            if msg == 'shutdown':
+                break
+            elif msg == 'status':
+                self.app_model.printer_state.update_status(payload)
+            elif msg == 'current_print_ts':
+                self.app_model.printer_state.set_current_print_ts(payload)  # Timelapses are tagged with it
+            elif msg == 'remote_status':
+                self.app_model.remote_status.update(payload)
+                if self.app_model.remote_status['viewing']:
+                    self.jpeg_poster.scheduler.request_viewing_boost()
+            elif msg == 'start_streaming' and self.webcam_streamer is None:
+                _logger.info('Starting webcam streamer')
+                self.webcam_streamer = WebcamStreamer(self.app_model, self.server_conn, self.sentry)
+                thread = threading.Thread(target=self.webcam_streamer.video_pipeline)
+                thread.daemon = True
+                thread.start()
+            elif msg == 'capture':
+                thread = threading.Thread(target=self.capture, args=(payload,))
+                thread.daemon = True
+                thread.start()
+
+        if self.webcam_streamer:
+            self.webcam_streamer.restore()
+
+    # Metrics recorded in this process are only readable in the main process
+    def forward_metrics_loop(self):
+        while True:
+            self.send('metrics', metrics.snapshot())
+            time.sleep(METRICS_FORWARD_SECS)
+
+    def capture(self, req):
+        error = None
+        try:
+            capture_jpeg(self.config.webcam, force_stream_url=req['force_stream_url'], max_age=0)  # frames.write() is called by the frame cache
+        except Exception as e:
+            error = 'Failed to capture jpeg - {}'.format(e)
+        self.send('captured', dict(req=req['req'], error=error))
+
+
+def worker_main(config_path, log_level, linked_printer, conn, log_queue, frame_buffer_name):
+    os.setpgrp()  # So that the main process can clean up ffmpeg along with this process
+
+    root_logger = logging.getLogger()
+    for hdlr in root_logger.handlers[:]:
+        root_logger.removeHandler(hdlr)
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(getattr(logging, log_level.upper(), logging.INFO))
+
+    config = Config(config_path)
+    frames = SharedFrameBuffer(name=frame_buffer_name)
+    try:
+        WebcamWorkerProcess(config, linked_printer, conn, frames).run()
+    except Exception:
+        _logger.exception('Webcam worker crashed')
+    finally:
+        frames.close()
@@ -9,12 +9,29 @@ import sys
 
 _logger = logging.getLogger('obico.ws')
 
+_use_asyncio_client = False
+
+
 class WebSocketConnectionException(Exception):
     pass
 
+
+def use_asyncio_client(enabled):
+    global _use_asyncio_client
+    _use_asyncio_client = enabled
+
+
+def new_websocket_client(*args, **kwargs):
+    # Same callback contract either way. The asyncio client shares one event loop thread among all connections.
+    if _use_asyncio_client:
+        from .ws_asyncio import AsyncioWebSocketClient
+        return AsyncioWebSocketClient(*args, **kwargs)
+    return WebSocketClient(*args, **kwargs)
+
+
 class WebSocketClient:
 
-    def __init__(self, url, header=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120):
+    def __init__(self, url, header=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120, wait_connected=True):
         self._mutex = threading.RLock()
 
         def on_error(ws, error):
@@ -68,6 +85,9 @@ class WebSocketClient:
         wst.daemon = True
         wst.start()
 
+        if not wait_connected:  # Caller relies on on_ws_open/on_ws_close instead of blocking for the hand-shaking
+            return
+
         for i in range(waitsecs * 10):  # Give it up to 120s for ws hand-shaking to finish
             if self.connected():
                 return
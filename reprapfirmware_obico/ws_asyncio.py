@@ -0,0 +1,298 @@
+# coding=utf-8
+
+import asyncio
+import base64
+import collections
+import hashlib
+import logging
+import os
+import ssl
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+
+from websocket import ABNF
+
+from .ws import WebSocketConnectionException
+from . import metrics
+
+_logger = logging.getLogger('obico.ws_asyncio')
+
+WS_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+PING_INTERVAL_SECS = 30
+CALLBACK_WORKERS = 8
+
+_shared_event_loop = None
+_shared_event_loop_mutex = threading.Lock()
+
+
+class EventLoopThread:
+    """
+        One asyncio event loop, running in one daemon thread, shared by all AsyncioWebSocketClient instances.
+        Callbacks run on a small thread pool so that a slow callback doesn't stall the loop.
+    """
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=CALLBACK_WORKERS)
+
+        thread = threading.Thread(target=self._run)
+        thread.daemon = True
+        thread.start()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+
+def shared_event_loop():
+    global _shared_event_loop
+
+    with _shared_event_loop_mutex:
+        if _shared_event_loop is None:
+            _shared_event_loop = EventLoopThread()
+        return _shared_event_loop
+
+
+class SerialCallbacks:
+    """
+        Runs callbacks on a shared executor, one at a time and in submission order,
+        which is what callers of WebSocketClient expect from its per-connection thread.
+    """
+
+    def __init__(self, executor):
+        self._executor = executor
+        self._mutex = threading.Lock()
+        self._queue = collections.deque()
+        self._running = False
+
+    def submit(self, func, *args, **kwargs):
+        with self._mutex:
+            self._queue.append((func, args, kwargs))
+            if self._running:
+                return
+            self._running = True
+
+        self._executor.submit(self._drain)
+
+    def _drain(self):
+        while True:
+            with self._mutex:
+                if not self._queue:
+                    self._running = False
+                    return
+                (func, args, kwargs) = self._queue.popleft()
+
+            try:
+                func(*args, **kwargs)
+            except Exception:
+                _logger.exception('Error in websocket callback')
+
+
+class AsyncioWebSocketClient:
+    """
+        Drop-in replacement for ws.WebSocketClient.
+        All connections share one asyncio event loop thread instead of each running its own run_forever thread.
+    """
+
+    def __init__(self, url, header=None, on_ws_msg=None, on_ws_close=None, on_ws_open=None, subprotocols=None, waitsecs=120, wait_connected=True, ping_interval=PING_INTERVAL_SECS):
+        self.ws = self  # So that callers can compare the `ws` passed to callbacks with client.ws, as they do with WebSocketClient
+        self.url = url
+        self.header = header or []
+        self.subprotocols = subprotocols
+        self.on_ws_msg = on_ws_msg
+        self.on_ws_close = on_ws_close
+        self.on_ws_open = on_ws_open
+        self.ping_interval = ping_interval
+        self.ping_latency = None
+
+        self._event_loop = shared_event_loop()
+        self.loop = self._event_loop.loop
+        self._callbacks = SerialCallbacks(self._event_loop.executor)
+        self._reader = None
+        self._writer = None
+        self._connected = False
+        self._closing = False
+        self._last_pong_ts = time.monotonic()
+        self._settled = threading.Event()  # Set when the hand-shaking succeeds or fails
+
+        _logger.debug('Connecting to websocket: {}'.format(url))
+        asyncio.run_coroutine_threadsafe(self._run(waitsecs), self.loop)
+
+        if not wait_connected:
+            return
+
+        self._settled.wait(waitsecs)
+        if self.connected():
+            return
+        self.close()
+        raise WebSocketConnectionException('Not connected to websocket server after {}s'.format(waitsecs))
+
+    def send(self, data, as_binary=False):
+        if not self.connected():
+            return
+
+        opcode = ABNF.OPCODE_BINARY if as_binary else ABNF.OPCODE_TEXT
+        frame = ABNF.create_frame(data, opcode).format()  # Masking is done in the caller's thread, not the loop's
+        self.loop.call_soon_threadsafe(self._write, frame)
+
+    def connected(self):
+        return self._connected
+
+    def close(self):
+        self._closing = True
+        self.loop.call_soon_threadsafe(self._close)
+
+    def _write(self, frame):
+        if self._writer is not None and not self._writer.is_closing():
+            self._writer.write(frame)
+
+    def _close(self):
+        if self._writer is None or self._writer.is_closing():
+            return
+
+        self._write(ABNF.create_frame(struct.pack('!H', ABNF.STATUS_NORMAL), ABNF.OPCODE_CLOSE).format())
+        self._writer.close()
+
+    async def _run(self, waitsecs):
+        close_status_code = None
+        ping_task = None
+        try:
+            await asyncio.wait_for(self._handshake(), waitsecs)
+            if self._closing:
+                return
+
+            self._connected = True
+            self._settled.set()
+            _logger.debug('WS Opened')
+            if self.on_ws_open:
+                self._callbacks.submit(self.on_ws_open, self)
+
+            if self.ping_interval:
+                ping_task = self.loop.create_task(self._ping_loop())
+
+            close_status_code = await self._read_loop()
+        except (asyncio.IncompleteReadError, ConnectionError, asyncio.TimeoutError, OSError, WebSocketConnectionException) as e:
+            if not self._closing:
+                _logger.warning('WS ERROR: {}'.format(e))
+        except Exception:
+            _logger.exception('Unexpected WS error')
+        finally:
+            self._connected = False
+            if ping_task:
+                ping_task.cancel()
+            if self._writer is not None and not self._writer.is_closing():
+                self._writer.close()
+            self._settled.set()
+
+            _logger.warning(f'WS Closed - {close_status_code}')
+            if self.on_ws_close:
+                self._callbacks.submit(self.on_ws_close, self, close_status_code=close_status_code)
+
+    async def _handshake(self):
+        parsed = urlparse(self.url)
+        is_ssl = parsed.scheme == 'wss'
+        port = parsed.port or (443 if is_ssl else 80)
+        ssl_context = ssl.create_default_context() if is_ssl else None
+
+        self._reader, self._writer = await asyncio.open_connection(parsed.hostname, port, ssl=ssl_context)
+
+        path = parsed.path or '/'
+        if parsed.query:
+            path += '?' + parsed.query
+        key = base64.b64encode(os.urandom(16)).decode()
+
+        lines = [
+            'GET {} HTTP/1.1'.format(path),
+            'Host: {}'.format(parsed.netloc),
+            'Upgrade: websocket',
+            'Connection: Upgrade',
+            'Sec-WebSocket-Key: {}'.format(key),
+            'Sec-WebSocket-Version: 13',
+        ]
+        if self.subprotocols:
+            lines.append('Sec-WebSocket-Protocol: {}'.format(','.join(self.subprotocols)))
+        lines.extend(self.header)
+        self._writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8'))
+
+        status_line = await self._reader.readline()
+        if status_line.split(b' ')[1:2] != [b'101']:
+            raise WebSocketConnectionException('Handshake status {}'.format(status_line.decode('latin-1').strip()))
+
+        headers = {}
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            (k, _, v) = line.decode('latin-1').partition(':')
+            headers[k.strip().lower()] = v.strip()
+
+        expected_accept = base64.b64encode(hashlib.sha1((key + WS_GUID).encode()).digest()).decode()
+        if headers.get('sec-websocket-accept') != expected_accept:
+            raise WebSocketConnectionException('Invalid Sec-WebSocket-Accept header')
+
+    async def _read_frame(self):
+        head = await self._reader.readexactly(2)
+        fin = head[0] & 0x80
+        opcode = head[0] & 0x0f
+        masked = head[1] & 0x80
+        length = head[1] & 0x7f
+        if length == 126:
+            (length,) = struct.unpack('!H', await self._reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack('!Q', await self._reader.readexactly(8))
+        mask_key = await self._reader.readexactly(4) if masked else None
+        payload = await self._reader.readexactly(length)
+        if mask_key:
+            payload = ABNF.mask(mask_key, payload)
+        return fin, opcode, payload
+
+    async def _read_loop(self):
+        fragments = []
+        msg_opcode = None
+        while True:
+            (fin, opcode, payload) = await self._read_frame()
+
+            if opcode == ABNF.OPCODE_CLOSE:
+                self._write(ABNF.create_frame(payload[:2], ABNF.OPCODE_CLOSE).format())  # Complete the closing handshake
+                return struct.unpack('!H', payload[:2])[0] if len(payload) >= 2 else None
+            if opcode == ABNF.OPCODE_PING:
+                self._write(ABNF.create_frame(payload, ABNF.OPCODE_PONG).format())
+                continue
+            if opcode == ABNF.OPCODE_PONG:
+                self._on_pong(payload)
+                continue
+
+            if opcode != ABNF.OPCODE_CONT:
+                msg_opcode = opcode
+                fragments = []
+            fragments.append(payload)
+            if not fin:
+                continue
+
+            data = b''.join(fragments)
+            fragments = []
+            if msg_opcode == ABNF.OPCODE_TEXT:
+                data = data.decode('utf-8')
+            if self.on_ws_msg:
+                self._callbacks.submit(self.on_ws_msg, self, data)
+
+    async def _ping_loop(self):
+        while True:
+            await asyncio.sleep(self.ping_interval)
+            if time.monotonic() - self._last_pong_ts > self.ping_interval * 3:
+                _logger.warning('No pong received in {}s. Closing WS.'.format(self.ping_interval * 3))
+                self._close()
+                return
+            self._write(ABNF.create_frame(struct.pack('!d', time.monotonic()), ABNF.OPCODE_PING).format())
+
+    def _on_pong(self, payload):
+        self._last_pong_ts = time.monotonic()
+        if len(payload) != 8:
+            return  # Unsolicited pong
+
+        (ping_ts,) = struct.unpack('!d', payload)
+        self.ping_latency = self._last_pong_ts - ping_ts
+        metrics.latency('ws.ping.' + urlparse(self.url).netloc).record(self.ping_latency)